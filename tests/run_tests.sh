@@ -58,6 +58,7 @@ time tests/test_fasta-nr.sh
 time tests/test_sample-tally.sh
 time tests/test_denoise.sh
 time tests/test_classify.sh
+time tests/test_index.sh
 time tests/test_marker_clash.sh
 time tests/test_assess.sh
 time tests/test_summary.sh
@@ -71,6 +71,13 @@ else
     # Check confusion matrix output to stdout works, also give one input as a directory name
     thapbi_pict assess -i $TMP/thapbi_blast $TMP/DNAMIX_S95_L001.identity.tsv --method blast --known identity -o $TMP/assess_blast_vs_identity.tsv -c - > $TMP/stdout.txt
     diff $TMP/stdout.txt $TMP/confusion_blast_vs_identity.tsv
+
+    echo "Checking BLAST database cache"
+    rm -rf $TMP/blast_cache $TMP/thapbi_blast_cached
+    mkdir -p $TMP/thapbi_blast_cached/
+    thapbi_pict classify -m blast -i tests/prepare-reads/DNAMIX_S95_L001.fasta -o $TMP/thapbi_blast_cached/ --blast-cache $TMP/blast_cache 2>&1 | grep "Cached ITS1 BLAST database"
+    thapbi_pict classify -m blast -i tests/prepare-reads/DNAMIX_S95_L001.fasta -o $TMP/thapbi_blast_cached/ --blast-cache $TMP/blast_cache 2>&1 | grep "Using cached ITS1 BLAST database"
+    diff $TMP/thapbi_blast_cached/DNAMIX_S95_L001.blast.tsv $TMP/thapbi_blast/DNAMIX_S95_L001.blast.tsv
 fi
 
 echo "$0 - test_assess.sh passed"
@@ -72,6 +72,13 @@ if [ "$(ls -1 $TMP/duo/*.identity.tsv | wc -l)" -ne "2" ]; then
     echo "Expected 4 files"
     false
 fi
+# Same again, but classifying the files in parallel:
+rm -rf $TMP/duo_cpu
+mkdir -p $TMP/duo_cpu
+thapbi_pict classify -m identity -d $DB -i $TMP/duo -o $TMP/duo_cpu --cpu 2
+for F in $TMP/duo/*.identity.tsv; do
+    diff $F $TMP/duo_cpu/$(basename $F)
+done
 
 # Test using sequences from a single isolate control,
 rm -rf $TMP/P-infestans-T30-4.*.tsv
@@ -125,6 +132,24 @@ for EXAMPLE in P_bilorbang P_vulcanica genus_boundary; do
         diff $TMP/${EXAMPLE}_query.$M.tsv tests/classifier/${EXAMPLE}_query.$M.tsv
         set +x
     done
+    echo "Checking ${EXAMPLE} example with onebp-hash matches onebp classifier"
+    set -x
+    thapbi_pict classify -d $DB -i tests/classifier/${EXAMPLE}_query.fasta -m onebp-hash -o $TMP
+    diff $TMP/${EXAMPLE}_query.onebp-hash.tsv tests/classifier/${EXAMPLE}_query.onebp.tsv
+    set +x
+    echo "Checking ${EXAMPLE} example with multi-threaded 1s5g classifier"
+    set -x
+    thapbi_pict classify -d $DB -i tests/classifier/${EXAMPLE}_query.fasta -m 1s5g -o $TMP --cpu 2
+    diff $TMP/${EXAMPLE}_query.1s5g.tsv tests/classifier/${EXAMPLE}_query.1s5g.tsv
+    set +x
+    echo "Checking ${EXAMPLE} example with prediction cache"
+    set -x
+    rm -rf $TMP/${EXAMPLE}_cache.sqlite
+    thapbi_pict classify -d $DB -i tests/classifier/${EXAMPLE}_query.fasta -m 1s5g -o $TMP --pred-cache $TMP/${EXAMPLE}_cache.sqlite 2>&1 | grep "cache had 0 hits"
+    diff $TMP/${EXAMPLE}_query.1s5g.tsv tests/classifier/${EXAMPLE}_query.1s5g.tsv
+    thapbi_pict classify -d $DB -i tests/classifier/${EXAMPLE}_query.fasta -m 1s5g -o $TMP --pred-cache $TMP/${EXAMPLE}_cache.sqlite 2>&1 | grep "misses" | grep " 0 misses"
+    diff $TMP/${EXAMPLE}_query.1s5g.tsv tests/classifier/${EXAMPLE}_query.1s5g.tsv
+    set +x
 done
 
 echo "$0 - test_classify.sh passed"
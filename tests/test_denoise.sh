@@ -47,6 +47,14 @@ else
         echo diff $TMP/after.fasta $AFTER
         diff $TMP/after.fasta $AFTER
 
+        echo "Checking via temp files rather than pipes"
+        rm -rf $TMP/vsearch_temp
+        mkdir $TMP/vsearch_temp
+        thapbi_pict denoise -i $BEFORE -o $TMP/after.fasta \
+            --denoise vsearch --minlen 60 -t 0 --temp $TMP/vsearch_temp
+        diff $TMP/after.fasta $AFTER
+        test -f $TMP/vsearch_temp/chimeras.tsv
+
         echo "Checking versus direct use of vsearch"
         python scripts/swarm2usearch.py $BEFORE > $TMP/before.fasta
         vsearch --sizein --sizeout \
@@ -26,4 +26,12 @@ thapbi_pict fasta-nr -i tests/prepare-reads/DNAMIX_S95_L001.fasta -o $TMP/all.fa
 # Should be identical bar no header lines, and loss of HMM names in FASTA descriptions
 diff --strip-trailing-cr $TMP/all.fasta <(grep -v "^#" tests/prepare-reads/DNAMIX_S95_L001.fasta | cut -f 1 -d " ")
 
+# Parsing in parallel should make no difference
+rm -rf $TMP/multi*.fasta
+thapbi_pict fasta-nr -i tests/read-correction/*.before.fasta \
+    -r tests/read-correction/chimeras.unoise.fasta -o $TMP/multi1.fasta --cpu 1
+thapbi_pict fasta-nr -i tests/read-correction/*.before.fasta \
+    -r tests/read-correction/chimeras.unoise.fasta -o $TMP/multi3.fasta --cpu 3
+diff $TMP/multi1.fasta $TMP/multi3.fasta
+
 echo "$0 - test_fasta-nr.sh passed"
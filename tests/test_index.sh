@@ -0,0 +1,49 @@
+#!/bin/bash
+
+# Copyright 2026 by Peter Cock, University of Strathclyde.
+# All rights reserved.
+# This file is part of the THAPBI Phytophthora ITS1 Classifier Tool (PICT),
+# and is released under the "MIT License Agreement". Please see the LICENSE
+# file that should have been included as part of this package.
+
+IFS=$'\n\t'
+set -eu
+set -o pipefail
+
+export TMP=${TMP:-/tmp/thapbi_pict}/index
+rm -rf $TMP
+mkdir -p $TMP
+
+echo "=============="
+echo "Checking index"
+echo "=============="
+for EXAMPLE in P_bilorbang P_vulcanica genus_boundary; do
+
+    DB=$TMP/${EXAMPLE}.sqlite
+    set -x
+    thapbi_pict import -d $DB -i tests/classifier/${EXAMPLE}.fasta -x -k ITS1 -l NNN -r NNN
+    thapbi_pict index -d $DB
+    test -f $DB.ITS1.index
+    set +x
+    for M in identity onebp onebp-hash 1s2g 1s5g; do
+        echo "Checking ${EXAMPLE} example with $M classifier using index"
+        E=$M
+        if [ "$M" == "onebp-hash" ]; then E=onebp; fi
+        set -x
+        thapbi_pict classify -d $DB -i tests/classifier/${EXAMPLE}_query.fasta -m $M -o $TMP
+        diff $TMP/${EXAMPLE}_query.$M.tsv tests/classifier/${EXAMPLE}_query.$E.tsv
+        set +x
+    done
+done
+
+echo "Checking stale index is rebuilt"
+DB=$TMP/P_bilorbang.sqlite
+set -x
+thapbi_pict import -d $DB -i tests/classifier/P_vulcanica.fasta -x -k ITS1 -l NNN -r NNN
+thapbi_pict classify -d $DB -i tests/classifier/P_vulcanica_query.fasta -m identity -o $TMP 2>&1 \
+    | grep "Rebuilding stale index"
+thapbi_pict classify -d $DB -i tests/classifier/P_vulcanica_query.fasta -m identity -o $TMP 2> $TMP/stderr.txt
+if grep "Rebuilding stale index" $TMP/stderr.txt; then echo "Wrong, index not updated"; false; fi
+set +x
+
+echo "$0 - test_index.sh passed"
@@ -48,6 +48,13 @@ if [ "$(grep -c "^>" $TMP/ITS1/DNAMIX_S95_L001.fasta)" -ne "822" ]; then
     false
 fi
 
+# Merged cache is content addressed (not named by sample), with a manifest
+if [ "$(ls $TMP/merged_cache/ | grep -c '^[0-9a-f]\{32\}.fasta.gz$')" -ne "1" ]; then
+    echo "Wrong merged cache contents"
+    false
+fi
+test -f $TMP/merged_cache/manifest.sqlite
+
 rm -rf $TMP/ITS1
 # Reusing the pre-primer-trim pre-abundance cache here:
 thapbi_pict prepare-reads -o $TMP -i tests/reads/DNAMIX_S95_L001_*.fastq.gz \
@@ -57,6 +64,25 @@ if [ "$(grep -c "^>" $TMP/ITS1/DNAMIX_S95_L001.fasta)" -ne "27" ]; then
     false
 fi
 
+rm -rf $TMP/ITS1 $TMP/raw
+# Unusable MD5SUM.txt lines should be ignored, falling back on computing MD5:
+mkdir $TMP/raw
+cp tests/reads/DNAMIX_S95_L001_*.fastq.gz $TMP/raw/
+echo "" > $TMP/raw/MD5SUM.txt
+echo "00000000000000000000000000000000  raw/DNAMIX_S95_L001_R1_001.fastq.gz" >> $TMP/raw/MD5SUM.txt
+echo "00000000000000000000000000000000  with space_R1.fastq.gz" >> $TMP/raw/MD5SUM.txt
+echo "not a checksum line" >> $TMP/raw/MD5SUM.txt
+thapbi_pict prepare-reads -o $TMP -i $TMP/raw/DNAMIX_S95_L001_*.fastq.gz \
+    --merged-cache $TMP/merged_cache/ -a 5 -d $DB
+if [ "$(grep -c "^>" $TMP/ITS1/DNAMIX_S95_L001.fasta)" -ne "27" ]; then
+    echo "Wrong FASTA output count"
+    false
+fi
+if [ "$(ls $TMP/merged_cache/ | grep -c '^[0-9a-f]\{32\}.fasta.gz$')" -ne "1" ]; then
+    echo "Wrong merged cache contents"
+    false
+fi
+
 rm -rf $TMP/ITS1
 thapbi_pict prepare-reads -o $TMP -i tests/reads/DNAMIX_S95_L001_*.fastq.gz \
     -a 5 -d $DB --database '-'
@@ -129,10 +155,39 @@ thapbi_pict prepare-reads --database $DB \
     -i tests/nematodes/sample_R*.fastq.gz -a 10 --flip -o $TMP/
 diff $TMP/Nema/sample.fasta tests/nematodes/sample_flip_a10.fasta
 
+echo "Testing --trimmer in-process matches cutadapt"
+rm -rf $TMP/Nema
+thapbi_pict prepare-reads --database $DB --trimmer in-process \
+    -i tests/nematodes/sample_R*.fastq.gz -a 10 --flip -o $TMP/
+diff $TMP/Nema/sample.fasta tests/nematodes/sample_flip_a10.fasta
+
+echo "Testing --merger in-process matches flash"
+rm -rf $TMP/Nema
+thapbi_pict prepare-reads --database $DB --merger in-process \
+    -i tests/nematodes/sample_R*.fastq.gz -a 10 --flip -o $TMP/
+diff $TMP/Nema/sample.fasta tests/nematodes/sample_flip_a10.fasta
+rm -rf $TMP/ITS1
+thapbi_pict prepare-reads -o $TMP -i tests/reads/DNAMIX_S95_L001_*.fastq.gz \
+    --merger in-process --trimmer in-process -a 0 -f 0 -d $TMP/w32_on_primer.sqlite
+if [ "$(grep -c "^>" $TMP/ITS1/DNAMIX_S95_L001.fasta)" -ne "822" ]; then
+    echo "Wrong FASTA output count"
+    false
+fi
+
 echo "Testing pathological trimming example"
 rm -rf $TMP/ITS1
 thapbi_pict prepare-reads -i tests/reads/6e847180a4da6eed316e1fb98b21218f_R?.fastq \
     -o $TMP/ -a 1
 diff $TMP/ITS1/6e847180a4da6eed316e1fb98b21218f.fasta tests/prepare-reads/6e847180a4da6eed316e1fb98b21218f.fasta
 
+echo "Checking scheduling under --cpu does not change the output"
+for CPU in 1 2 3 6; do
+    rm -rf $TMP/cpu$CPU
+    mkdir $TMP/cpu$CPU
+    thapbi_pict prepare-reads -i tests/reads/ -o $TMP/cpu$CPU -a 1 --cpu $CPU
+done
+for CPU in 2 3 6; do
+    diff -r $TMP/cpu1 $TMP/cpu$CPU
+done
+
 echo "$0 - test_prepare-reads.sh passed"
@@ -51,6 +51,34 @@ else
         <(cut -f 1,3 $TMP/x.tsv | grep ^ITS1)
 fi
 
+echo "Checking empty input (default DB has spike-ins)"
+touch $TMP/empty.fasta
+thapbi_pict sample-tally -i $TMP/empty.fasta -a 100 -f 0 -o $TMP/empty.tsv
+if [ $(grep -c -v "^#" $TMP/empty.tsv) -ne 0 ]; then
+    echo "Wrong ASV count from empty input"
+    false
+fi
+
+echo "Checking adding samples to an existing tally"
+thapbi_pict sample-tally -i tests/prepare-reads/DNAMIX_S95_L001.fasta \
+    tests/prepare-reads/SRR6303948_sample_default.fasta \
+    tests/prepare-reads/6e847180a4da6eed316e1fb98b21218f.fasta -o $TMP/all.tsv
+thapbi_pict sample-tally -i tests/prepare-reads/SRR6303948_sample_default.fasta \
+    tests/prepare-reads/6e847180a4da6eed316e1fb98b21218f.fasta \
+    --existing $TMP/x.tsv -o $TMP/more.tsv
+diff $TMP/all.tsv $TMP/more.tsv
+set +o pipefail
+thapbi_pict sample-tally -i tests/prepare-reads/DNAMIX_S95_L001.fasta \
+    --existing $TMP/x.tsv 2>&1 | grep "already in"
+set -o pipefail
+
+echo "Checking memory limited mode gives same output"
+thapbi_pict sample-tally -i tests/prepare-reads/DNAMIX_S95_L001.fasta \
+    tests/prepare-reads/SRR6303948_sample_default.fasta \
+    tests/prepare-reads/6e847180a4da6eed316e1fb98b21218f.fasta \
+    --max-memory 1 -o $TMP/spilled.tsv
+diff $TMP/all.tsv $TMP/spilled.tsv
+
 echo "----------------"
 echo "Checking denoise"
 echo "----------------"
@@ -70,6 +98,11 @@ for AFTER in tests/read-correction/*.unoise.fasta; do
         --minlen 60 -a 0 -f 0 --denoise unoise-l
     echo diff $TMP/after.fasta $AFTER
     diff $TMP/after.fasta $AFTER
+
+    thapbi_pict sample-tally -i $BEFORE --max-memory 1 \
+        -o $TMP/after.tally.tsv --fasta $TMP/after.fasta \
+        --minlen 60 -a 0 -f 0 --denoise unoise-l
+    diff $TMP/after.fasta $AFTER
 done
 
 echo "$0 - test_sample-tally.sh passed"
@@ -229,6 +229,19 @@ def conflicts(args=None):
     )
 
 
+def index(args=None):
+    """Subcommand to write classifier index files for a database."""
+    from .index import main
+
+    db = expand_database_argument(args.database, exist=True, hyphen_default=True)
+    session = connect_to_db(db)
+    markers = sorted(_.name for _ in session.query(MarkerDef))
+    markers = validate_markers(markers, args.markers)
+    session.close()
+
+    return main(db_url=db, markers=markers, debug=args.verbose)
+
+
 def prepare_reads(args=None):
     """Subcommand to prepare FASTA files from paired FASTQ reads."""
     from .prepare import main
@@ -254,6 +267,9 @@ def prepare_reads(args=None):
         min_abundance_fraction=args.abundance_fraction,
         ignore_prefixes=tuple(args.ignore_prefixes),
         merged_cache=args.merged_cache,
+        merged_cache_size=int(args.merged_cache_size * 1024**3),
+        trimmer=args.trimmer,
+        merger=args.merger,
         tmp_dir=args.temp,
         debug=args.verbose,
         cpu=check_cpu(args.cpu),
@@ -282,6 +298,7 @@ def fasta_nr(args=None):
         min_length=args.minlen,
         max_length=args.maxlen,
         debug=args.verbose,
+        cpu=check_cpu(args.cpu),
     )
 
 
@@ -321,6 +338,7 @@ def sample_tally(args=None):
         marker=args.marker,
         spike_genus=args.synthetic,
         fasta=args.fasta,
+        existing=args.existing,
         min_abundance=args.abundance,
         min_abundance_fraction=args.abundance_fraction,
         total_min_abundance=args.total,
@@ -330,6 +348,7 @@ def sample_tally(args=None):
         unoise_gamma=args.unoise_gamma,
         denoise_algorithm=args.denoise,
         tmp_dir=args.temp,
+        max_memory=args.max_memory,
         biom=args.biom,
         debug=args.verbose,
         cpu=check_cpu(args.cpu),
@@ -360,6 +379,8 @@ def classify(args=None):
         min_abundance=args.abundance,
         tmp_dir=args.temp,
         biom=args.biom,
+        blast_cache=args.blast_cache,
+        pred_cache=args.pred_cache,
         debug=args.verbose,
         cpu=check_cpu(args.cpu),
     )
@@ -508,6 +529,9 @@ def pipeline(args=None):
         min_abundance_fraction=0.0,
         ignore_prefixes=tuple(args.ignore_prefixes),
         merged_cache=args.merged_cache,
+        merged_cache_size=int(args.merged_cache_size * 1024**3),
+        trimmer=args.trimmer,
+        merger=args.merger,
         tmp_dir=args.temp,
         debug=args.verbose,
         cpu=check_cpu(args.cpu),
@@ -587,6 +611,8 @@ def pipeline(args=None):
             ignore_prefixes=tuple(args.ignore_prefixes),  # not really needed
             min_abundance=args.abundance,
             biom=args.biom,
+            blast_cache=args.blast_cache,
+            pred_cache=args.pred_cache,
             tmp_dir=args.temp,
             debug=args.verbose,
             cpu=check_cpu(args.cpu),
@@ -801,7 +827,41 @@ ARG_MERGED_CACHE = dict(  # noqa: C408
     metavar="DIRNAME",
     help="Advanced option. Cache directory for temporary per-sample FASTA "
     "file after overlap merging (usually the slowest step), but before "
-    "primer trimming and abundance threshold.",
+    "primer trimming and abundance threshold. Files are named by the "
+    "checksums of the FASTQ pair (using any MD5SUM.txt or *.md5 files) and "
+    "the merger version, so the cache can be shared between projects.",
+)
+
+# "--merged-cache-size",
+ARG_MERGED_CACHE_SIZE = dict(  # noqa: C408
+    type=float,
+    default=0,
+    metavar="GB",
+    help="Advanced option. Maximum size of the merged cache in gigabytes, "
+    "removing the least recently used files when over this. Default 0 "
+    "meaning no limit.",
+)
+
+# "--blast-cache",
+ARG_BLAST_CACHE = dict(  # noqa: C408
+    type=str,
+    required=False,
+    default="",
+    metavar="DIRNAME",
+    help="Advanced option. Cache directory for BLAST databases built for the "
+    "blast classifier, reused while the marker sequences are unchanged. "
+    "Default is next to the SQLite database, e.g. 'example.sqlite.blast'.",
+)
+
+# "--pred-cache",
+ARG_PRED_CACHE = dict(  # noqa: C408
+    type=str,
+    required=False,
+    default="",
+    metavar="FILENAME",
+    help="Advanced option. SQLite file to cache classifier predictions between "
+    "runs, so only previously unseen sequences are classified. Predictions are "
+    "reused only with the same database file, marker, and method.",
 )
 
 # "-t", "--temp",
@@ -881,6 +941,28 @@ ARG_FLIP = dict(  # noqa: C408
     help="Also check reverse complement strand for primers.",
 )
 
+# "--trimmer",
+ARG_TRIMMER = dict(  # noqa: C408
+    type=str,
+    default="cutadapt",
+    choices=["cutadapt", "in-process"],
+    help="How to primer trim the overlap merged reads. Default 'cutadapt' "
+    "runs the cutadapt command line tool on each sample, while 'in-process' "
+    "uses the cutadapt library directly on the unique merged reads "
+    "(same results, but faster).",
+)
+
+# "--merger",
+ARG_MERGER = dict(  # noqa: C408
+    type=str,
+    default="flash",
+    choices=["flash", "in-process"],
+    help="How to overlap merge the paired reads. Default 'flash' runs the "
+    "FLASH command line tool on each sample, while 'in-process' uses our "
+    "own vectorised implementation of the same algorithm (same results, "
+    "and FLASH need not be installed).",
+)
+
 # Read-correction / denoise arguments
 # ===================================
 
@@ -890,7 +972,8 @@ ARG_DENOISE = dict(  # noqa: C408
     default="-",
     help="Optional read-correction algorithm, default '-' for none. "
     "Use 'unoise-l' for built-in reimplementation of the Levenshtein distance "
-    "UNOISE algorithm as described in Edgar (2016). Use 'usearch' to "
+    "UNOISE algorithm as described in Edgar (2016), plus built-in UCHIME3 "
+    "style de novo chimera flagging. Use 'usearch' to "
     "call external tool `usearch -unoise3 ...` and the original "
     "author's UNOISE3 implementation. Use 'vsearch' to call "
     "external tool `vsearch --cluster_unoise ...` and their UNOISE3 "
@@ -1168,6 +1251,8 @@ def main(args=None):
     subcommand_parser.add_argument("-k", "--markers", **ARG_MARKER_PICK_SOME)
     subcommand_parser.add_argument("--synthetic", **ARG_SYNTHETIC_SPIKE)
     subcommand_parser.add_argument("--flip", **ARG_FLIP)
+    subcommand_parser.add_argument("--trimmer", **ARG_TRIMMER)
+    subcommand_parser.add_argument("--merger", **ARG_MERGER)
     subcommand_parser.add_argument("--denoise", **ARG_DENOISE)
     subcommand_parser.add_argument(
         "-α", "--unoise_alpha", "--unoise-alpha", **ARG_UNOISE_ALPHA
@@ -1183,6 +1268,9 @@ def main(args=None):
     subcommand_parser.add_argument("-g", "--metagroups", **ARG_METAGROUPS)
     subcommand_parser.add_argument("--metafields", **ARG_METAFIELDS)
     subcommand_parser.add_argument("--merged-cache", **ARG_MERGED_CACHE)
+    subcommand_parser.add_argument("--merged-cache-size", **ARG_MERGED_CACHE_SIZE)
+    subcommand_parser.add_argument("--blast-cache", **ARG_BLAST_CACHE)
+    subcommand_parser.add_argument("--pred-cache", **ARG_PRED_CACHE)
     subcommand_parser.add_argument("-q", "--requiremeta", **ARG_REQUIREMETA)
     subcommand_parser.add_argument("-u", "--unsequenced", **ARG_UNSEQUENCED)
     subcommand_parser.add_argument("-b", "--biom", **ARG_BIOM)
@@ -1420,6 +1508,22 @@ def main(args=None):
     subcommand_parser.set_defaults(func=conflicts)
     del subcommand_parser
 
+    # index
+    subcommand_parser = subparsers.add_parser(
+        "index",
+        description="Write classifier index files for a marker database.",
+        epilog="Writes an index file for each marker next to the SQLite database, "
+        "e.g. `thapbi_pict index -d example.sqlite` gives `example.sqlite.ITS1.index` "
+        "for marker ITS1. The classifiers use an up to date index file if present, "
+        "and rebuild a stale index file if the database has since changed.",
+        formatter_class=cmd_formatter,
+    )
+    subcommand_parser.add_argument("-d", "--database", **ARG_DB_INPUT)
+    subcommand_parser.add_argument("-k", "--markers", **ARG_MARKER_PICK_SOME)
+    subcommand_parser.add_argument("-v", "--verbose", **ARG_VERBOSE)
+    subcommand_parser.set_defaults(func=index)
+    del subcommand_parser
+
     # prepare reads
     subcommand_parser = subparsers.add_parser(
         "prepare-reads",
@@ -1450,7 +1554,10 @@ def main(args=None):
     subcommand_parser.add_argument("-d", "--database", **ARG_DB_INPUT)
     subcommand_parser.add_argument("-k", "--markers", **ARG_MARKER_PICK_SOME)
     subcommand_parser.add_argument("--flip", **ARG_FLIP)
+    subcommand_parser.add_argument("--trimmer", **ARG_TRIMMER)
+    subcommand_parser.add_argument("--merger", **ARG_MERGER)
     subcommand_parser.add_argument("--merged-cache", **ARG_MERGED_CACHE)
+    subcommand_parser.add_argument("--merged-cache-size", **ARG_MERGED_CACHE_SIZE)
     subcommand_parser.add_argument("-t", "--temp", **ARG_TEMPDIR)
     subcommand_parser.add_argument("-v", "--verbose", **ARG_VERBOSE)
     subcommand_parser.add_argument("--cpu", **ARG_CPU)
@@ -1503,6 +1610,7 @@ def main(args=None):
     )
     subcommand_parser.add_argument("--minlen", **ARG_MIN_LENGTH)
     subcommand_parser.add_argument("--maxlen", **ARG_MAX_LENGTH)
+    subcommand_parser.add_argument("--cpu", **ARG_CPU)
     subcommand_parser.add_argument("-v", "--verbose", **ARG_VERBOSE)
     subcommand_parser.set_defaults(func=fasta_nr)
 
@@ -1619,6 +1727,14 @@ def main(args=None):
         metavar="FILENAME",
         help="Optional BIOM format output. ",
     )
+    subcommand_parser.add_argument(
+        "--existing",
+        type=str,
+        metavar="FILENAME",
+        help="Optional previous sample-tally TSV output to add the new "
+        "samples to, rather than re-tallying all the FASTA files. Must use "
+        "the same settings, and does not support denoising or -t / --total.",
+    )
     subcommand_parser.add_argument("-d", "--database", **ARG_DB_INPUT)
     subcommand_parser.add_argument("--synthetic", **ARG_SYNTHETIC_SPIKE)
     subcommand_parser.add_argument("-a", "--abundance", **ARG_FASTQ_MIN_ABUNDANCE)
@@ -1641,6 +1757,18 @@ def main(args=None):
         "-γ", "--unoise_gamma", "--unoise-gamma", **ARG_UNOISE_GAMMA
     )
     subcommand_parser.add_argument("--temp", **ARG_TEMPDIR)
+    subcommand_parser.add_argument(
+        "--max-memory",
+        type=int,
+        default=0,
+        metavar="MB",
+        help="Approximate memory limit in MB for the sequence by sample counts, "
+        "beyond which they are spilled to sorted files in the temp folder and "
+        "combined with an external merge. Default 0 for no limit (all in "
+        "memory). Excludes the counts for each input file as it is loaded "
+        "(one per CPU), and the unique sequence totals when denoising. "
+        "Does not support BIOM output.",
+    )
     subcommand_parser.add_argument("--cpu", **ARG_CPU)
     subcommand_parser.add_argument("-v", "--verbose", **ARG_VERBOSE)
     subcommand_parser.set_defaults(func=sample_tally)
@@ -1678,6 +1806,8 @@ def main(args=None):
         "each input file. Use '-' for stdout.",
     )
     subcommand_parser.add_argument("-b", "--biom", **ARG_BIOM)
+    subcommand_parser.add_argument("--blast-cache", **ARG_BLAST_CACHE)
+    subcommand_parser.add_argument("--pred-cache", **ARG_PRED_CACHE)
     subcommand_parser.add_argument("-t", "--temp", **ARG_TEMPDIR)
     subcommand_parser.add_argument("-v", "--verbose", **ARG_VERBOSE)
     subcommand_parser.add_argument("--cpu", **ARG_CPU)
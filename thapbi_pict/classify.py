@@ -10,17 +10,24 @@ This implements the ``thapbi_pict classify ...`` command.
 
 from __future__ import annotations
 
+import hashlib
 import os
 import shutil
 import sys
 import tempfile
+from collections.abc import Collection
 from collections.abc import Iterable
 from collections.abc import Iterator
 from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_all_start_methods
+from multiprocessing import get_context
 from typing import Callable
 
 from Bio.SeqIO.FastaIO import SimpleFastaParser
 from numpy import int8
+from numpy import nonzero
+from numpy import where
 from rapidfuzz.distance import Levenshtein
 from rapidfuzz.process import cdist
 
@@ -28,6 +35,18 @@ from .db_orm import MarkerDef
 from .db_orm import MarkerSeq
 from .db_orm import SeqSource
 from .db_orm import Taxonomy
+from .index import add_deletion_index
+from .index import add_qgram_index
+from .index import db_filename
+from .index import deletion_candidates
+from .index import index_seqs
+from .index import index_taxonomy
+from .index import load_index
+from .index import qgram_candidates
+from .pred_cache import evict_predictions
+from .pred_cache import lookup_predictions
+from .pred_cache import open_pred_cache
+from .pred_cache import store_predictions
 from .utils import abundance_from_read_name
 from .utils import export_sample_biom
 from .utils import export_sample_tsv
@@ -35,6 +54,7 @@ from .utils import file_to_sample_name
 from .utils import find_requested_files
 from .utils import genus_species_name
 from .utils import load_fasta_header
+from .utils import md5_hexdigest
 from .utils import md5seq
 from .utils import parse_sample_tsv
 from .utils import run
@@ -43,10 +63,25 @@ from .versions import check_rapidfuzz
 from .versions import check_tools
 
 MIN_BLAST_COVERAGE = 0.85  # percentage of query length
-
-db_seqs = None  # global dict (seq to genus) for onebp and 1s?g distance classifiers
+MAX_DIST_MATRIX = 2**26  # cells in each query vs DB chunk, int8 so 64MB
+PIGEONHOLE_PIECES = (64, 48, 32, 24)  # piece lengths for the pigeonhole index
+PIGEONHOLE_MIN_DB = 5000  # smaller DBs are faster with the full distance matrix
+
+# global dict of DB sequence to consolidated (genus, species, taxid) entries:
+db_seqs: dict[str, list[tuple[str, str, int]]] | None = None
+db_seq_list: list[str] = []  # global list of DB sequences, in index order
+db_arrays: dict = {}  # global dict of index arrays, see the index module
+db_md5_seqs: dict[str, str] = {}  # global dict of DB MD5 to sequence, for BLAST
+blast_cache_dir = ""  # global setting for BLAST classifier, see main function
+blast_db = ""  # global variable for BLAST classifier, path to database
 max_dist_genus = None  # global variable for 1s?g distance classifiers
-genus_taxid = {}  # global variable to cache taxids for genus names
+onebp_hash = False  # global variable for onebp-hash classifier
+# global pigeonhole index for 1s?g distance classifiers, see setup_pigeonhole:
+db_pigeonhole: tuple[dict[int, dict[str, list[tuple[int, int]]]], list[int]] | None = (
+    None
+)
+genus_taxid: dict[str, int] = {}  # global variable to cache taxids for genus names
+setup_pending: Callable | None = None  # global variable, method setup when needed
 
 
 def unique_or_separated(values: Sequence[str | int], sep: str = ";") -> str:
@@ -126,9 +161,20 @@ def taxid_and_sp_lists(
     string instead (in the same order so you can match taxid to species, sorting
     on the genus-species string).
     """
-    tax = consoliate_and_sort_taxonomy(
+    return taxid_and_sp_summary(
         {(t.genus, t.species, t.ncbi_taxid) for t in taxon_entries}
     )
+
+
+def taxid_and_sp_summary(
+    genus_species_taxid: Iterable[tuple[str, str, int]],
+) -> tuple[int | str, str, str]:
+    """Return semi-colon separated summary of (genus, species, taxid) tuples.
+
+    As per the ``taxid_and_sp_lists`` function, but working on plain tuples
+    rather than taxonomy objects from the DB.
+    """
+    tax = consoliate_and_sort_taxonomy(genus_species_taxid)
     if not tax:
         return 0, "", "No DB match"
     return (
@@ -138,6 +184,20 @@ def taxid_and_sp_lists(
     )
 
 
+def taxid_and_sp_for_seqs(seqs: Iterable[str]) -> tuple[int | str, str, str]:
+    """Return taxid, genus_species, note for the given DB sequences.
+
+    Uses the pre-loaded global dict of DB sequences to taxonomy entries,
+    combining the entries for all the sequences. Note consolidating the
+    already consolidated per-sequence entries gives the same result as
+    consolidating all the original taxonomy entries.
+    """
+    assert db_seqs is not None
+    return taxid_and_sp_summary(
+        {entry for seq in seqs for entry in db_seqs.get(seq, [])}
+    )
+
+
 def perfect_match_in_db(
     session, marker_name: str, seq: str, debug: bool = False
 ) -> tuple[int | str, str, str]:
@@ -146,17 +206,10 @@ def perfect_match_in_db(
     If the 100% matches in the DB give multiple species, then taxid and
     genus_species will be semi-colon separated strings.
     """
+    assert db_seqs is not None
     assert seq == seq.upper(), seq
     # Now, does this equal any of the marker sequences in our DB?
-    return taxid_and_sp_lists(
-        session.query(Taxonomy)
-        .join(SeqSource)
-        .join(MarkerDef, SeqSource.marker_definition)
-        .filter(MarkerDef.name == marker_name)
-        .join(MarkerSeq)
-        .filter(MarkerSeq.sequence == seq)
-        .distinct()
-    )
+    return taxid_and_sp_for_seqs([seq])
 
 
 def perfect_substr_in_db(
@@ -166,24 +219,25 @@ def perfect_substr_in_db(
 
     If the matches containing the sequence as a substring give multiple species,
     then taxid and genus_species will be semi-colon separated strings.
+
+    Uses the q-gram index if available, where any match must contain every
+    q-gram of the query, so need only check the DB sequences with the least
+    common q-gram in the query.
     """
     assert db_seqs is not None
     assert seq == seq.upper(), seq
+    candidates: Collection[str] = db_seqs
+    if "qgram_codes" in db_arrays:
+        seq_ids = qgram_candidates(seq, db_arrays)
+        if seq_ids is not None:
+            candidates = [db_seq_list[_] for _ in seq_ids.tolist()]
     matches = set()
-    for db_seq in db_seqs:
+    for db_seq in candidates:
         if seq in db_seq:
             matches.add(db_seq)
     if not matches:
         return 0, "", ""
-    return taxid_and_sp_lists(
-        session.query(Taxonomy)
-        .join(SeqSource)
-        .join(MarkerDef, SeqSource.marker_definition)
-        .filter(MarkerDef.name == marker_name)
-        .join(MarkerSeq)
-        .filter(MarkerSeq.sequence.in_(matches))
-        .distinct()
-    )
+    return taxid_and_sp_for_seqs(matches)
 
 
 def apply_method_to_seqs(
@@ -219,7 +273,8 @@ def method_identity(
     """Classify using perfect identity.
 
     This is a deliberately simple approach, in part for testing
-    purposes. It looks for a perfect identical entry in the database.
+    purposes. It looks for a perfect identical entry in the database
+    (using the pre-loaded dict of DB sequences to taxonomy).
     """
     return apply_method_to_seqs(
         perfect_match_in_db,
@@ -260,29 +315,50 @@ def method_substr(
 def setup_seqs(
     session, marker_name: str, shared_tmp_dir: str, debug: bool = False, cpu: int = 0
 ) -> None:
-    """Prepare a set of all the DB marker sequences as upper case strings.
+    """Prepare a dict of all the DB marker sequences as upper case strings.
+
+    The values are the consolidated taxonomy entries for each sequence as a
+    list of (genus, species, taxid) tuples, meaning the classifiers can
+    resolve their matches with dictionary lookups rather than per-sequence
+    database queries.
 
-    Also setup set of sequences in the DB, and dict of genus to NCBI taxid.
+    Also setup dict of genus to NCBI taxid.
+
+    Uses the pre-computed index file for this marker if present and fresh,
+    see the ``thapbi_pict index`` command, otherwise queries the DB.
     """
-    global db_seqs
+    global db_arrays, db_seq_list, db_seqs
     global genus_taxid
 
+    header, db_arrays = load_index(session, marker_name, debug=debug)
+    db_seq_list = index_seqs(db_arrays)
     db_seqs = {
-        marker.sequence.upper()
-        for marker in session.query(MarkerSeq.sequence)
-        .join(SeqSource)
-        .join(MarkerDef, SeqSource.marker_definition)
-        .filter(MarkerDef.name == marker_name)
-        .distinct()
+        seq: consoliate_and_sort_taxonomy(entries)
+        for seq, entries in zip(db_seq_list, index_taxonomy(header, db_arrays))
     }
+    if debug:
+        sys.stderr.write(
+            f"DEBUG: Loaded {len(db_seqs)} {marker_name} sequences and taxonomy\n"
+        )
 
     # Cache all genus to taxid mappings
-    genus_taxid = {
-        _.genus: _.ncbi_taxid
-        for _ in session.query(Taxonomy)
-        .filter(Taxonomy.species == "")
-        .filter(Taxonomy.ncbi_taxid != 0)
-    }
+    genus_taxid = header["genus_taxid"]
+
+
+def setup_substr(
+    session, marker_name: str, shared_tmp_dir: str, debug: bool = False, cpu: int = 0
+) -> None:
+    """Prepare a q-gram index of all the DB marker sequences.
+
+    This maps each q-gram to the DB sequences containing it.
+    """
+    setup_seqs(session, marker_name, shared_tmp_dir, debug=False, cpu=0)
+    add_qgram_index(db_arrays, db_seq_list)
+    if debug:
+        sys.stderr.write(
+            f"DEBUG: Indexed {len(db_arrays['qgram_codes'])} q-grams"
+            f" from {len(db_seq_list)} DB sequences\n"
+        )
 
 
 def setup_onebp(
@@ -295,6 +371,29 @@ def setup_onebp(
     max_dist_genus = 1
 
 
+def setup_onebp_hash(
+    session, marker_name: str, shared_tmp_dir: str, debug: bool = False, cpu: int = 0
+) -> None:
+    """Prepare a hash table of all 1bp deletions of the DB sequences; set dist to 1.
+
+    This is a deletion neighbourhood index (as used in SymSpell), storing
+    just the hash of each variant (collisions are harmless as all candidate
+    matches are checked), rather than all the 1bp substitutions, deletions
+    and insertions of each DB sequence. See the ``index`` module.
+    """
+    global onebp_hash, max_dist_genus
+    check_rapidfuzz()
+    setup_seqs(session, marker_name, shared_tmp_dir, debug=False, cpu=0)
+    max_dist_genus = 1
+    onebp_hash = True
+    add_deletion_index(db_arrays, db_seq_list)
+    if debug:
+        sys.stderr.write(
+            f"DEBUG: Hashed {len(db_arrays['deletion_hashes'])} 1bp deletions"
+            f" of {len(db_seq_list)} DB sequences\n"
+        )
+
+
 def setup_dist2(
     session, marker_name: str, shared_tmp_dir: str, debug: bool = False, cpu: int = 0
 ) -> None:
@@ -303,6 +402,7 @@ def setup_dist2(
     check_rapidfuzz()
     setup_seqs(session, marker_name, shared_tmp_dir, debug=False, cpu=0)
     max_dist_genus = 2
+    setup_pigeonhole(debug)
 
 
 def setup_dist3(
@@ -313,6 +413,7 @@ def setup_dist3(
     check_rapidfuzz()
     setup_seqs(session, marker_name, shared_tmp_dir, debug=False, cpu=0)
     max_dist_genus = 3
+    setup_pigeonhole(debug)
 
 
 def setup_dist4(
@@ -323,6 +424,7 @@ def setup_dist4(
     check_rapidfuzz()
     setup_seqs(session, marker_name, shared_tmp_dir, debug=False, cpu=0)
     max_dist_genus = 4
+    setup_pigeonhole(debug)
 
 
 def setup_dist5(
@@ -333,6 +435,7 @@ def setup_dist5(
     check_rapidfuzz()
     setup_seqs(session, marker_name, shared_tmp_dir, debug=False, cpu=0)
     max_dist_genus = 5
+    setup_pigeonhole(debug)
 
 
 def setup_dist6(session, marker_name, shared_tmp_dir, debug=False, cpu=0):
@@ -341,6 +444,7 @@ def setup_dist6(session, marker_name, shared_tmp_dir, debug=False, cpu=0):
     check_rapidfuzz()
     setup_seqs(session, marker_name, shared_tmp_dir, debug=False, cpu=0)
     max_dist_genus = 6
+    setup_pigeonhole(debug)
 
 
 def setup_dist7(session, marker_name, shared_tmp_dir, debug=False, cpu=0):
@@ -349,6 +453,7 @@ def setup_dist7(session, marker_name, shared_tmp_dir, debug=False, cpu=0):
     check_rapidfuzz()
     setup_seqs(session, marker_name, shared_tmp_dir, debug=False, cpu=0)
     max_dist_genus = 7
+    setup_pigeonhole(debug)
 
 
 def setup_dist8(session, marker_name, shared_tmp_dir, debug=False, cpu=0):
@@ -357,6 +462,7 @@ def setup_dist8(session, marker_name, shared_tmp_dir, debug=False, cpu=0):
     check_rapidfuzz()
     setup_seqs(session, marker_name, shared_tmp_dir, debug=False, cpu=0)
     max_dist_genus = 8
+    setup_pigeonhole(debug)
 
 
 def setup_dist9(session, marker_name, shared_tmp_dir, debug=False, cpu=0):
@@ -365,6 +471,181 @@ def setup_dist9(session, marker_name, shared_tmp_dir, debug=False, cpu=0):
     check_rapidfuzz()
     setup_seqs(session, marker_name, shared_tmp_dir, debug=False, cpu=0)
     max_dist_genus = 9
+    setup_pigeonhole(debug)
+
+
+def build_pigeonhole_index(
+    seqs: Sequence[str], max_dist: int
+) -> tuple[dict[int, dict[str, list[tuple[int, int]]]], list[int]]:
+    """Build pigeonhole index of the sequences for the given maximum edit distance.
+
+    If two sequences are within edit distance k, then cutting one of them into
+    k+1 non-overlapping pieces, at least one piece must be untouched by the edits
+    and so found exactly in the other sequence, offset by at most k positions.
+
+    Returns a dict keyed on piece length, of dicts mapping each piece to a list
+    of (sequence index, offset) tuples. Sequences too short for pieces of any of
+    the lengths in PIGEONHOLE_PIECES are returned as a list of their indexes,
+    which must always be treated as candidates.
+    """
+    index: dict[int, dict[str, list[tuple[int, int]]]] = {}
+    unindexed: list[int] = []
+    for i, seq in enumerate(seqs):
+        step = len(seq) // (max_dist + 1)
+        length = next((_ for _ in PIGEONHOLE_PIECES if _ <= step), 0)
+        if not length:
+            unindexed.append(i)
+            continue
+        pieces = index.setdefault(length, {})
+        for offset in range(0, step * (max_dist + 1), step):
+            pieces.setdefault(seq[offset : offset + length], []).append((i, offset))
+    return index, unindexed
+
+
+def pigeonhole_candidates(
+    seq: str,
+    seqs: Sequence[str],
+    index: dict[int, dict[str, list[tuple[int, int]]]],
+    unindexed: list[int],
+    max_dist: int,
+) -> set[int]:
+    """Return indexes of sequences which might be within the maximum edit distance.
+
+    >>> seqs = ["ACGTACGTAAAAAAAACCCCCCCCGGGGGGGGTTTTTTTTACGTACGTACGTAAAA" * 2]
+    >>> index, unindexed = build_pigeonhole_index(seqs, 2)
+    >>> pigeonhole_candidates(seqs[0][3:], seqs, index, unindexed, 2)
+    set()
+    >>> pigeonhole_candidates(seqs[0][2:], seqs, index, unindexed, 2)
+    {0}
+    """
+    candidates = set(unindexed)
+    query_len = len(seq)
+    for length, pieces in index.items():
+        for start in range(query_len - length + 1):
+            for i, offset in pieces.get(seq[start : start + length], ()):
+                if (
+                    abs(start - offset) <= max_dist
+                    and abs(len(seqs[i]) - query_len) <= max_dist
+                ):
+                    candidates.add(i)
+    return candidates
+
+
+def setup_pigeonhole(debug: bool = False) -> None:
+    """Prepare pigeonhole index of DB sequences for the 1s?g distance classifiers.
+
+    Only worthwhile with a large DB, and if most of the DB sequences are long
+    enough to be cut into selective pieces given the maximum distance.
+    """
+    global db_pigeonhole
+    assert db_seqs is not None
+    assert max_dist_genus
+    db_pigeonhole = None
+    if len(db_seqs) < PIGEONHOLE_MIN_DB:
+        return
+    index, unindexed = build_pigeonhole_index(db_seq_list, max_dist_genus)
+    if len(unindexed) * 2 > len(db_seqs):
+        if debug:
+            sys.stderr.write(
+                f"DEBUG: DB sequences too short for pigeonhole index at"
+                f" distance {max_dist_genus}\n"
+            )
+        return
+    db_pigeonhole = index, unindexed
+    if debug:
+        sys.stderr.write(
+            f"DEBUG: Pigeonhole index of {len(db_seqs)} DB sequences using"
+            f" {sum(len(_) for _ in index.values())} pieces\n"
+        )
+
+
+def min_dist_hits_indexed(
+    query_seqs: Sequence[str],
+    db_list: Sequence[str],
+    max_dist: int,
+    index: dict[int, dict[str, list[tuple[int, int]]]],
+    unindexed: list[int],
+) -> Iterator[tuple[int, list[tuple[int, str]]]]:
+    """Yield minimum edit distance and closest DB hits for each query sequence.
+
+    Gives the same results as the ``min_dist_hits`` function, but only computes
+    the edit distance to the candidates from the pigeonhole index.
+    """
+    for seq in query_seqs:
+        hits = []
+        for i in pigeonhole_candidates(seq, db_list, index, unindexed, max_dist):
+            dist = Levenshtein.distance(seq, db_list[i], score_cutoff=max_dist)
+            if dist <= max_dist:
+                hits.append((dist, db_list[i]))
+        row_min = min((d for d, _ in hits), default=max_dist + 1)
+        # After any perfect matches, what is the next best distance?
+        level = (
+            min((d for d, _ in hits if d), default=max_dist + 1)
+            if row_min == 0
+            else row_min
+        )
+        yield row_min, [(d, s) for (d, s) in hits if d <= level]
+
+
+def onebp_hash_hits(
+    query_seqs: Sequence[str],
+) -> Iterator[tuple[int, list[tuple[int, str]]]]:
+    """Yield minimum edit distance and DB hits up to 1bp away for each query.
+
+    Gives the same results as the ``min_dist_hits`` function with maximum
+    distance one, but uses hash lookups of the query and its 1bp deletions
+    against the DB sequences and their 1bp deletions.
+    """
+    assert db_seqs is not None
+    for seq in query_seqs:
+        hits = [(0, seq)] if seq in db_seqs else []
+        for i in deletion_candidates(seq, db_arrays).tolist():
+            db_seq = db_seq_list[i]
+            if db_seq != seq and Levenshtein.distance(seq, db_seq, score_cutoff=1) == 1:
+                hits.append((1, db_seq))
+        yield (hits[0][0] if hits else 2), hits
+
+
+def min_dist_hits(
+    query_seqs: Sequence[str],
+    db_list: Sequence[str],
+    max_dist: int,
+    cpu: int = 0,
+    chunk_size: int = 0,
+) -> Iterator[tuple[int, list[tuple[int, str]]]]:
+    """Yield minimum edit distance and closest DB hits for each query sequence.
+
+    The queries are compared to the DB sequences in chunks, so that the full
+    query by DB distance matrix is never held in memory. Each chunk is reduced
+    to a list of (distance, DB sequence) tuples for each query straight away,
+    with the hits at the minimum distance - plus when there is a perfect
+    match, the hits at the next best distance too.
+
+    If the minimum distance is over the maximum distance, reports the
+    maximum distance plus one, and an empty hit list.
+    """
+    if not chunk_size:
+        # Aim to cap the distance matrix size, but want at least one row per thread
+        chunk_size = max(MAX_DIST_MATRIX // max(len(db_list), 1), cpu, 1)
+    for start in range(0, len(query_seqs), chunk_size):
+        dists = cdist(
+            query_seqs[start : start + chunk_size],
+            db_list,
+            scorer=Levenshtein.distance,
+            dtype=int8,
+            score_cutoff=max_dist,
+            workers=cpu if cpu else 1,
+        )
+        row_min = dists.min(axis=1)
+        # After any perfect matches, what is the next best distance?
+        row_next = where(dists == 0, max_dist + 1, dists).min(axis=1)
+        level = where(row_min == 0, row_next, row_min)
+        rows, cols = nonzero((dists <= level[:, None]) & (dists <= max_dist))
+        hits: list[list[tuple[int, str]]] = [[] for _ in row_min]
+        for row, col in zip(rows.tolist(), cols.tolist()):
+            hits[row].append((int(dists[row, col]), db_list[col]))
+        del dists, rows, cols
+        yield from zip((int(_) for _ in row_min), hits)
 
 
 def method_dist(
@@ -385,18 +666,19 @@ def method_dist(
         # Shortcut
         return
 
-    # Compute all the query vs DB distances in one call
-    all_dists = cdist(
-        input_seqs.values(),
-        db_seqs,
-        scorer=Levenshtein.distance,
-        dtype=int8,
-        score_cutoff=max_dist_genus,
-    )
+    if onebp_hash and max_dist_genus == 1:
+        all_hits = onebp_hash_hits(list(input_seqs.values()))
+    elif db_pigeonhole and max_dist_genus > 1:
+        all_hits = min_dist_hits_indexed(
+            list(input_seqs.values()), db_seq_list, max_dist_genus, *db_pigeonhole
+        )
+    else:
+        all_hits = min_dist_hits(
+            list(input_seqs.values()), db_seq_list, max_dist_genus, cpu
+        )
 
     results: dict[str, tuple[int | str, str, str]] = {}
-    for (idn, seq), dists in zip(input_seqs.items(), all_dists):
-        min_dist = min(dists)
+    for (idn, seq), (min_dist, hits) in zip(input_seqs.items(), all_hits):
         results[idn] = 0, "", f"No matches up to distance {max_dist_genus}"
         if min_dist == 0:
             assert seq in db_seqs, (
@@ -404,27 +686,19 @@ def method_dist(
             )
             # If seq in db_seqs might be genus only, and
             # we'd prefer a species level match 1bp away:
-            taxid, genus_species, note = perfect_match_in_db(session, marker_name, seq)
+            taxid, genus_species, note = taxid_and_sp_for_seqs([seq])
             results[idn] = taxid, genus_species, note
             if any(species_level(_) for _ in genus_species.split(";")):
                 # Found 100% identical match(es) in DB at species level, done :)
                 continue
             # What's next if we ignore the perfect genus-only match?
-            min_dist = min(d for d in dists if d != 0)
+            min_dist = min((d for d, _ in hits if d != 0), default=max_dist_genus + 1)
         if min_dist == 1:
             # No species level exact matches, so do we have 1bp off match(es)?
             # What if the 1bp genus differ from any 0bp genus? Take both!
-            matches = {s for (s, d) in zip(db_seqs, dists) if d <= min_dist}
+            matches = {s for (d, s) in hits if d <= min_dist}
             assert matches
-            taxid, genus_species, _ = taxid_and_sp_lists(
-                session.query(Taxonomy)
-                .join(SeqSource)
-                .join(MarkerDef, SeqSource.marker_definition)
-                .filter(MarkerDef.name == marker_name)
-                .join(MarkerSeq)
-                .filter(MarkerSeq.sequence.in_(matches))
-                .distinct()
-            )
+            taxid, genus_species, _ = taxid_and_sp_for_seqs(matches)
             assert genus_species
             results[idn] = taxid, genus_species, ""
         elif min_dist <= max_dist_genus and not results[idn][1]:
@@ -432,21 +706,10 @@ def method_dist(
             # We now come to the genus-only fall back for 1sXg if relevant:
             results[idn] = 0, "?", "Skipped"
             # Nothing within 1bp, take genus only info from Xbp away:
-            matches = {s for (s, d) in zip(db_seqs, dists) if d <= min_dist}
+            matches = {s for (d, s) in hits if d <= min_dist}
             assert matches
             note = f"{len(matches)} matches at distance {min_dist}"
-            genus = sorted(
-                {
-                    _.genus
-                    for _ in session.query(Taxonomy.genus)
-                    .join(SeqSource)
-                    .join(MarkerDef, SeqSource.marker_definition)
-                    .filter(MarkerDef.name == marker_name)
-                    .join(MarkerSeq)
-                    .filter(MarkerSeq.sequence.in_(matches))
-                    .distinct()
-                }
-            )
+            genus = sorted({entry[0] for s in matches for entry in db_seqs[s]})
             assert genus
             results[idn] = (
                 ";".join(str(genus_taxid.get(g, 0)) for g in genus),
@@ -463,27 +726,85 @@ def method_dist(
 def setup_blast(
     session, marker_name: str, shared_tmp_dir: str, debug: bool = False, cpu: int = 0
 ):
-    """Prepare a BLAST DB from the marker sequence DB entries."""
-    view = (
-        session.query(MarkerSeq)
+    """Prepare a BLAST DB from the marker sequence DB entries.
+
+    The BLAST DB is cached in a sub-folder named after the marker and the MD5
+    checksum of its sequences, within the ``blast_cache_dir`` folder (default
+    next to the SQLite DB file), so ``makeblastdb`` is only run if the marker
+    sequences have changed. Each BLAST DB is built in a private temporary
+    folder which is then renamed into place, so concurrent jobs are safe (one
+    of them will discard their copy). Falls back on using the shared temp
+    folder without caching if the cache folder is not writable.
+    """
+    global blast_db, db_md5_seqs
+    setup_seqs(session, marker_name, shared_tmp_dir, debug=False, cpu=0)
+    records = sorted(
+        (marker.md5, marker.sequence)
+        for marker in session.query(MarkerSeq)
         .join(SeqSource)
         .join(MarkerDef, SeqSource.marker_definition)
         .filter(MarkerDef.name == marker_name)
     )
-    db_fasta = os.path.join(shared_tmp_dir, "blast_db.fasta")
-    blast_db = os.path.join(shared_tmp_dir, "blast_db")
-    count = 0
-    with open(db_fasta, "w") as handle:
-        for marker in view:
-            md5 = marker.md5
-            marker_seq = marker.sequence
-            handle.write(f">{md5}\n{marker_seq}\n")
-            count += 1
-    sys.stderr.write(
-        f"Wrote {count} unique sequences from DB to FASTA file for BLAST database.\n"
-    )
-    cmd = ["makeblastdb", "-dbtype", "nucl", "-in", db_fasta, "-out", blast_db]
-    run(cmd, debug)
+    db_md5_seqs = {md5: marker_seq.upper() for md5, marker_seq in records}
+    fasta = "".join(f">{md5}\n{marker_seq}\n" for md5, marker_seq in records)
+
+    cache_dir = blast_cache_dir
+    if not cache_dir:
+        db_file = db_filename(session)
+        cache_dir = f"{db_file}.blast" if db_file else ""
+    if cache_dir:
+        checksum = hashlib.md5(fasta.encode("ascii")).hexdigest()
+        cached = os.path.join(cache_dir, f"{marker_name}_{checksum}")
+        blast_db = os.path.join(cached, "blast_db")
+        if os.path.isdir(cached):
+            sys.stderr.write(f"Using cached {marker_name} BLAST database {cached}\n")
+            return
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            build_dir = tempfile.mkdtemp(prefix=f"{marker_name}_", dir=cache_dir)
+        except OSError as err:
+            if blast_cache_dir or debug:
+                # Only warn if explicitly requested, the default is best efforts
+                sys.stderr.write(f"WARNING: Not caching BLAST database, {err}\n")
+            cache_dir = ""
+    if not cache_dir:
+        build_dir = shared_tmp_dir
+
+    try:
+        db_fasta = os.path.join(build_dir, "blast_db.fasta")
+        with open(db_fasta, "w") as handle:
+            handle.write(fasta)
+        sys.stderr.write(
+            f"Wrote {len(records)} unique sequences from DB to FASTA file"
+            " for BLAST database.\n"
+        )
+        cmd = [
+            "makeblastdb",
+            "-dbtype",
+            "nucl",
+            "-in",
+            db_fasta,
+            "-out",
+            os.path.join(build_dir, "blast_db"),
+        ]
+        run(cmd, debug)
+        if not cache_dir:
+            blast_db = os.path.join(build_dir, "blast_db")
+            return
+        try:
+            # Temporary folders are private, but want the usual permissions
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(build_dir, 0o777 & ~umask)
+            os.rename(build_dir, cached)
+            sys.stderr.write(f"Cached {marker_name} BLAST database as {cached}\n")
+        except OSError:
+            # Another process has cached this BLAST DB since we checked
+            if debug:
+                sys.stderr.write(f"DEBUG: Discarding duplicate of {cached}\n")
+    finally:
+        if cache_dir and os.path.isdir(build_dir):
+            shutil.rmtree(build_dir)
 
 
 def method_blast(
@@ -504,8 +825,7 @@ def method_blast(
     assert os.path.isdir(tmp_dir)
     assert os.path.isdir(shared_tmp_dir)
 
-    blast_out = os.path.join(shared_tmp_dir, "blast.tsv")
-    blast_db = os.path.join(shared_tmp_dir, "blast_db")
+    blast_out = os.path.join(tmp_dir, "blast.tsv")
     if not (
         os.path.isfile(blast_db + ".nhr")
         and os.path.isfile(blast_db + ".nin")
@@ -581,14 +901,8 @@ def method_blast(
         if idn in blast_hits:
             db_md5s = blast_hits[idn]
             score = blast_score[idn]
-            taxid, genus_species, note = taxid_and_sp_lists(
-                session.query(Taxonomy)
-                .join(SeqSource)
-                .join(MarkerDef, SeqSource.marker_definition)
-                .filter(MarkerDef.name == marker_name)
-                .join(MarkerSeq)
-                .filter(MarkerSeq.md5.in_(db_md5s))
-                .distinct()
+            taxid, genus_species, note = taxid_and_sp_for_seqs(
+                db_md5_seqs[_] for _ in db_md5s
             )
             note = (f"{len(db_md5s)} BLAST hits (bit score {score}). {note}").strip()
         else:
@@ -604,8 +918,16 @@ def method_cleanup() -> None:
     Currently no need to generalise this for the different classifiers, but
     could if for example we also needed to delete any files on disk.
     """
-    global db_seqs, max_dist_genus
-    db_seqs = None  # global variable for onbep and 1s?g classifiers
+    global blast_db, db_arrays, db_seq_list, db_seqs, db_md5_seqs, db_pigeonhole
+    global max_dist_genus, onebp_hash, setup_pending
+    blast_db = ""  # global variable for BLAST classifier
+    setup_pending = None  # global variable for all the classifiers
+    db_arrays = {}  # global variable for all the classifiers
+    db_seq_list = []  # global variable for all the classifiers
+    db_seqs = None  # global variable for all the classifiers
+    db_md5_seqs = {}  # global variable for BLAST classifier
+    onebp_hash = False  # global variable for onebp-hash classifier
+    db_pigeonhole = None  # global variable for 1s?g distance classifiers
     max_dist_genus = None  # global variable for 1s?g distance classifier
 
 
@@ -613,6 +935,7 @@ method_tool_check: dict[str, list[str]] = {
     "blast": ["makeblastdb", "blastn"],
     "identity": [],
     "onebp": [],
+    "onebp-hash": [],
     "1s2g": [],
     "1s3g": [],
     "1s4g": [],
@@ -628,6 +951,7 @@ method_classify_file = {
     "blast": method_blast,
     "identity": method_identity,
     "onebp": method_dist,
+    "onebp-hash": method_dist,
     "1s2g": method_dist,
     "1s3g": method_dist,
     "1s4g": method_dist,
@@ -642,7 +966,9 @@ method_classify_file = {
 # Not all methods define a setup function:
 method_setup = {
     "blast": setup_blast,
+    "identity": setup_seqs,
     "onebp": setup_onebp,
+    "onebp-hash": setup_onebp_hash,
     "1s2g": setup_dist2,
     "1s3g": setup_dist3,
     "1s4g": setup_dist4,
@@ -651,10 +977,243 @@ method_setup = {
     "1s7g": setup_dist7,
     "1s8g": setup_dist8,
     "1s9g": setup_dist9,
-    "substr": setup_seqs,
+    "substr": setup_substr,
 }
 
 
+def classify_file(
+    filename: str,
+    session,
+    marker_name: str,
+    method: str,
+    output_name: str | None,
+    output_biom: str | None,
+    shared_tmp: str,
+    min_abundance: int = 0,
+    pred_cache: str = "",
+    db_md5: str = "",
+    debug: bool = False,
+    cpu: int = 0,
+) -> tuple[int, int, int, int]:
+    """Classify a single FASTA or tally TSV input file, and write the output.
+
+    Any method specific setup is expected to have been done already, or be
+    pending in the ``setup_pending`` global. Returns the number of unique
+    sequences, the number with a genus/species prediction, and the number
+    of prediction cache hits and misses.
+    """
+    global setup_pending
+    stem = os.path.basename(filename)
+    if stem.endswith(".tally.tsv"):
+        stem = stem[:-10]
+    else:
+        stem = os.path.splitext(stem)[0]
+
+    if filename.endswith(".fasta"):
+        sample = file_to_sample_name(filename)
+        # Populate as if this was a single sample tally TSV input:
+        input_seqs: dict[str, str] = {}
+        seq_meta: dict[tuple[str, str], dict] = {}
+        md5_count: dict[str, int] = {}
+        tally_counts: dict[tuple[str, str, str], int] = {}
+        # TODO - avoid repeated definition here, in summary code, and sample-tally:
+        stats_fields = (
+            "Raw FASTQ",
+            "Flash",
+            "Cutadapt",
+            "Threshold pool",
+            "Threshold",
+            "Control",
+            "Max non-spike",
+            "Max spike-in",
+            "Singletons",
+        )
+        header = load_fasta_header(filename)
+        sample_meta = {
+            sample: {
+                key: header[key.lower().replace(" ", "_")]
+                for key in stats_fields
+                if key.lower().replace(" ", "_") in header
+            }
+        }
+        with open(filename) as handle:
+            for title, seq in SimpleFastaParser(handle):
+                abundance = abundance_from_read_name(title.split(None, 1)[0])
+                if min_abundance and abundance < min_abundance:
+                    continue
+                seq = seq.upper()
+                md5 = md5seq(seq)
+                if md5 in md5_count:
+                    # Remove old entry
+                    del input_seqs[f"{md5}_{md5_count[md5]}"]
+                    # Merge counts
+                    abundance += md5_count[md5]
+                    sys.stderr.write(
+                        f"WARNING: Duplicate seq from {title} (merging abundance)\n"
+                    )
+                md5_count[md5] = abundance
+                input_seqs[f"{md5}_{abundance}"] = seq
+                tally_counts[marker_name, md5, sample] = abundance
+        del sample
+    elif filename.endswith(".tsv"):
+        # Refactor to match the FASTA naming
+        seqs, seq_meta, sample_meta, tally_counts = parse_sample_tsv(
+            filename, min_abundance
+        )
+        md5_count = {}
+        input_seqs = {}
+        for (marker, md5, _), a in tally_counts.items():
+            if marker != marker_name:
+                sys.exit(
+                    f"ERROR: Found marker {marker_name} in {filename}, not {marker}"
+                )
+            md5_count[md5] = md5_count.get(md5, 0) + a
+        # Drop the marker from the key, use md5_abundance
+        for (marker, md5), seq in seqs.items():
+            assert marker == marker_name
+            input_seqs[f"{md5}_{md5_count[md5]}"] = seq.upper()
+        del seqs
+        assert sample_meta
+    else:
+        sys.exit(f"ERROR: Unexpected extension in classifier input: {filename}")
+
+    sys.stderr.write(
+        f"Running {method} classifier on {filename}, {len(input_seqs)} sequences\n"
+    )
+    if debug:
+        sys.stderr.write(f"DEBUG: Output {output_name}\n")
+
+    tmp = os.path.join(shared_tmp, stem)
+    if not os.path.isdir(tmp):
+        # If using tempfile.TemporaryDirectory() for shared_tmp
+        # this will be deleted automatically, otherwise user must:
+        os.mkdir(tmp)
+
+    if debug:
+        sys.stderr.write(f"DEBUG: Temp folder of {stem} is {tmp}\n")
+
+    idn_md5 = {idn: md5seq(seq) for idn, seq in input_seqs.items()}
+    predictions: dict[str, tuple[str, str, str]] = {}
+    cache = open_pred_cache(pred_cache) if pred_cache else None
+    if cache is not None:
+        predictions = lookup_predictions(
+            cache, db_md5, marker_name, method, idn_md5.values()
+        )
+    cache_hits = len(predictions)
+    new_seqs = {
+        idn: seq for idn, seq in input_seqs.items() if idn_md5[idn] not in predictions
+    }
+    if new_seqs:
+        if setup_pending:
+            # There are some sequences to classify, do setup now (once only)
+            setup_pending(session, marker_name, shared_tmp, debug, cpu)
+            setup_pending = None
+        new_predictions = {
+            idn_md5[idn]: (taxid, genus_species, note)
+            for idn, taxid, genus_species, note in method_classify_file[method](
+                new_seqs,
+                session,
+                marker_name,
+                tmp,
+                shared_tmp,
+                min_abundance=min_abundance,
+                debug=debug,
+                cpu=cpu,
+            )
+        }
+        if cache is not None:
+            store_predictions(cache, db_md5, marker_name, method, new_predictions)
+        predictions.update(new_predictions)
+        del new_predictions
+    if cache is not None:
+        cache.close()
+    cache_misses = len(new_seqs)
+    del new_seqs
+
+    # Add the predictions to the seq_meta dict
+    seq_count = match_count = 0
+    for md5, (taxid, genus_species, _) in predictions.items():
+        if (marker_name, md5) in seq_meta:
+            seq_meta[marker_name, md5]["taxid"] = taxid
+            seq_meta[marker_name, md5]["genus-species"] = genus_species
+        else:
+            seq_meta[marker_name, md5] = {
+                "taxid": taxid,
+                "genus-species": genus_species,
+            }
+        seq_count += 1
+        if genus_species:
+            match_count += 1
+
+    # Using same file names, but in tmp folder:
+    tmp_pred = "-" if output_name is None else os.path.join(tmp, f"{stem}.{method}.tsv")
+
+    export_sample_tsv(
+        tmp_pred,
+        # Re-insert the marker into the sequence dict keys, and use md5:
+        {(marker_name, md5seq(seq)): seq for seq in input_seqs.values()},
+        seq_meta,
+        sample_meta,
+        tally_counts,
+    )
+
+    if output_name is not None:
+        # Move our temp file into position...
+        shutil.move(tmp_pred, output_name)
+
+    if output_biom is not None:
+        if export_sample_biom(
+            tmp_pred,
+            # Re-insert the marker into the sequence dict keys, and use md5:
+            {(marker_name, md5seq(seq)): seq for seq in input_seqs.values()},
+            seq_meta,
+            sample_meta,
+            tally_counts,
+        ):
+            # Move our temp file into position...
+            shutil.move(tmp_pred, output_biom)
+            if debug:
+                sys.stderr.write(f"DEBUG: Wrote {output_biom}\n")
+        else:
+            sys.exit("ERROR: Missing optional Python library for BIOM output")
+
+    return seq_count, match_count, cache_hits, cache_misses
+
+
+def _classify_file_worker(
+    filename: str,
+    marker_name: str,
+    method: str,
+    output_name: str | None,
+    output_biom: str | None,
+    shared_tmp: str,
+    min_abundance: int = 0,
+    pred_cache: str = "",
+    db_md5: str = "",
+    debug: bool = False,
+    cpu: int = 0,
+) -> tuple[int, int, int, int]:
+    """Classify a single input file in a forked worker process.
+
+    The worker inherits the method setup (module level globals) from the
+    parent process, so has no need for the database session.
+    """
+    return classify_file(
+        filename,
+        None,
+        marker_name,
+        method,
+        output_name,
+        output_biom,
+        shared_tmp,
+        min_abundance=min_abundance,
+        pred_cache=pred_cache,
+        db_md5=db_md5,
+        debug=debug,
+        cpu=cpu,
+    )
+
+
 def main(
     inputs: list[str],
     session,
@@ -665,6 +1224,8 @@ def main(
     tmp_dir: str,
     min_abundance: int = 0,
     biom=False,
+    blast_cache: str = "",
+    pred_cache: str = "",
     debug: bool = False,
     cpu: int = 0,
 ) -> list[str | None]:
@@ -676,8 +1237,15 @@ def main(
     The input files should have been prepared with the same or a lower minimum
     abundance - this acts as an additional filter useful if exploring the best
     threshold.
+
+    The blast_cache folder is used to store the BLAST databases for the blast
+    classifier, default next to the SQLite DB file.
+
+    The optional pred_cache SQLite file is used to store predictions between
+    runs, keyed on the DB file checksum, marker, method, and sequence MD5.
+    Only sequences not already in the cache are classified.
     """
-    global genus_taxid
+    global blast_cache_dir, genus_taxid, setup_pending
     assert isinstance(inputs, list)
 
     if method not in method_classify_file:
@@ -685,11 +1253,10 @@ def main(
             f"ERROR: Invalid method name {method!r},"
             f" should be one of: {', '.join(sorted(method_classify_file))}\n"
         )
-    classify_file_fn = method_classify_file[method]
     try:
-        setup_fn = method_setup[method]
+        setup_pending = method_setup[method]
     except KeyError:
-        setup_fn = None
+        setup_pending = None
     try:
         req_tools = method_tool_check[method]
     except KeyError:
@@ -702,6 +1269,7 @@ def main(
     if not count:
         sys.exit("ERROR: Taxonomy table empty, cannot classify anything.\n")
     genus_taxid = {}  # reset any values from a previous DB
+    blast_cache_dir = blast_cache
 
     if not marker_name:
         view = session.query(MarkerDef)
@@ -781,16 +1349,22 @@ def main(
     if debug:
         sys.stderr.write(f"DEBUG: Shared temp folder {shared_tmp}\n")
 
+    db_md5 = ""
+    if pred_cache:
+        db_file = db_filename(session)
+        if db_file:
+            db_md5 = md5_hexdigest(db_file, chunk_size=2**20)
+            # Create the cache now, rather than in parallel in worker processes
+            open_pred_cache(pred_cache).close()
+        else:
+            sys.stderr.write("WARNING: Prediction cache requires an SQLite DB file\n")
+            pred_cache = ""
+
     classifier_output = []  # return value
 
-    abundance: int = 0
-    seq_count: int = 0
-    match_count: int = 0
     skipped_samples: set[str] = set()
+    jobs = []
     for filename in input_files:
-        sys.stdout.flush()
-        sys.stderr.flush()
-
         folder, stem = os.path.split(filename)
         if stem.endswith(".tally.tsv"):
             stem = stem[:-10]
@@ -815,155 +1389,79 @@ def main(
             )
 
         classifier_output.append(output_name)
+        jobs.append((filename, output_name, output_biom))
 
-        if setup_fn:
-            # There are some files still to process, do setup now (once only)
-            setup_fn(session, marker_name, shared_tmp, debug, cpu)
-            setup_fn = None
-
-        if filename.endswith(".fasta"):
-            sample = file_to_sample_name(filename)
-            # Populate as if this was a single sample tally TSV input:
-            input_seqs: dict[str, str] = {}
-            seq_meta: dict[tuple[str, str], dict] = {}
-            md5_count: dict[str, int] = {}
-            tally_counts: dict[tuple[str, str, str], int] = {}
-            # TODO - avoid repeated definition here, in summary code, and sample-tally:
-            stats_fields = (
-                "Raw FASTQ",
-                "Flash",
-                "Cutadapt",
-                "Threshold pool",
-                "Threshold",
-                "Control",
-                "Max non-spike",
-                "Max spike-in",
-                "Singletons",
-            )
-            header = load_fasta_header(filename)
-            sample_meta = {
-                sample: {
-                    key: header[key.lower().replace(" ", "_")]
-                    for key in stats_fields
-                    if key.lower().replace(" ", "_") in header
-                }
-            }
-            with open(filename) as handle:
-                for title, seq in SimpleFastaParser(handle):
-                    abundance = abundance_from_read_name(title.split(None, 1)[0])
-                    if min_abundance and abundance < min_abundance:
-                        continue
-                    seq = seq.upper()
-                    md5 = md5seq(seq)
-                    if md5 in md5_count:
-                        # Remove old entry
-                        del input_seqs[f"{md5}_{md5_count[md5]}"]
-                        # Merge counts
-                        abundance += md5_count[md5]
-                        sys.stderr.write(
-                            f"WARNING: Duplicate seq from {title} (merging abundance)\n"
-                        )
-                    md5_count[md5] = abundance
-                    input_seqs[f"{md5}_{abundance}"] = seq
-                    tally_counts[marker_name, md5, sample] = abundance
-            del sample
-        elif filename.endswith(".tsv"):
-            # Refactor to match the FASTA naming
-            seqs, seq_meta, sample_meta, tally_counts = parse_sample_tsv(
-                filename, min_abundance
-            )
-            md5_count = {}
-            input_seqs = {}
-            for (marker, md5, _), a in tally_counts.items():
-                if marker != marker_name:
-                    sys.exit(
-                        f"ERROR: Found marker {marker_name} in {filename}, not {marker}"
-                    )
-                md5_count[md5] = md5_count.get(md5, 0) + a
-            # Drop the marker from the key, use md5_abundance
-            for (marker, md5), seq in seqs.items():
-                assert marker == marker_name
-                input_seqs[f"{md5}_{md5_count[md5]}"] = seq.upper()
-            del seqs
-            assert sample_meta
-        else:
-            sys.exit(f"ERROR: Unexpected extension in classifier input: {filename}")
-
-        sys.stderr.write(
-            f"Running {method} classifier on {filename}, {len(input_seqs)} sequences\n"
-        )
+    if (
+        cpu > 1
+        and len(jobs) > 1
+        and out_dir != "-"
+        and "fork" in get_all_start_methods()
+    ):
+        # Do setup once, and share with the forked worker processes
+        workers = min(cpu, len(jobs))
+        if setup_pending:
+            setup_pending(session, marker_name, shared_tmp, debug, cpu)
+            setup_pending = None
         if debug:
-            sys.stderr.write(f"DEBUG: Output {output_name}\n")
-
-        tmp = os.path.join(shared_tmp, stem)
-        if not os.path.isdir(tmp):
-            # If using tempfile.TemporaryDirectory() for shared_tmp
-            # this will be deleted automatically, otherwise user must:
-            os.mkdir(tmp)
+            sys.stderr.write(f"DEBUG: Classifying files using {workers} processes\n")
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=get_context("fork")
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _classify_file_worker,
+                    filename,
+                    marker_name,
+                    method,
+                    output_name,
+                    output_biom,
+                    shared_tmp,
+                    min_abundance=min_abundance,
+                    pred_cache=pred_cache,
+                    db_md5=db_md5,
+                    debug=debug,
+                    cpu=max(1, cpu // workers),
+                )
+                for filename, output_name, output_biom in jobs
+            ]
+            results = [_.result() for _ in futures]
+    else:
+        results = []
+        for filename, output_name, output_biom in jobs:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            results.append(
+                classify_file(
+                    filename,
+                    session,
+                    marker_name,
+                    method,
+                    output_name,
+                    output_biom,
+                    shared_tmp,
+                    min_abundance=min_abundance,
+                    pred_cache=pred_cache,
+                    db_md5=db_md5,
+                    debug=debug,
+                    cpu=cpu,
+                )
+            )
+    seq_count = sum(_[0] for _ in results)
+    match_count = sum(_[1] for _ in results)
+    cache_hits = sum(_[2] for _ in results)
+    cache_misses = sum(_[3] for _ in results)
 
-        if debug:
-            sys.stderr.write(f"DEBUG: Temp folder of {stem} is {tmp}\n")
-
-        # Add the predictions to the seq_meta dict
-        for idn, taxid, genus_species, _ in classify_file_fn(
-            input_seqs,
-            session,
-            marker_name,
-            tmp,
-            shared_tmp,
-            min_abundance=min_abundance,
-            debug=debug,
-            cpu=cpu,
-        ):
-            md5 = md5seq(input_seqs[idn])  # convert to md5
-            if (marker_name, md5) in seq_meta:
-                seq_meta[marker_name, md5]["taxid"] = taxid
-                seq_meta[marker_name, md5]["genus-species"] = genus_species
-            else:
-                seq_meta[marker_name, md5] = {
-                    "taxid": taxid,
-                    "genus-species": genus_species,
-                }
-            seq_count += 1
-            if genus_species:
-                match_count += 1
-
-        # Using same file names, but in tmp folder:
-        tmp_pred = (
-            "-" if output_name is None else os.path.join(tmp, f"{stem}.{method}.tsv")
-        )
+    method_cleanup()
 
-        export_sample_tsv(
-            tmp_pred,
-            # Re-insert the marker into the sequence dict keys, and use md5:
-            {(marker_name, md5seq(seq)): seq for seq in input_seqs.values()},
-            seq_meta,
-            sample_meta,
-            tally_counts,
+    if pred_cache:
+        cache = open_pred_cache(pred_cache)
+        evicted = evict_predictions(cache)
+        cache.close()
+        sys.stderr.write(
+            f"Prediction cache had {cache_hits} hits and {cache_misses} misses"
+            + (f", evicted {evicted} old entries\n" if evicted else "\n")
         )
 
-        if output_name is not None:
-            # Move our temp file into position...
-            shutil.move(tmp_pred, output_name)
-
-        if output_biom is not None:
-            if export_sample_biom(
-                tmp_pred,
-                # Re-insert the marker into the sequence dict keys, and use md5:
-                {(marker_name, md5seq(seq)): seq for seq in input_seqs.values()},
-                seq_meta,
-                sample_meta,
-                tally_counts,
-            ):
-                # Move our temp file into position...
-                shutil.move(tmp_pred, output_biom)
-                if debug:
-                    sys.stderr.write(f"DEBUG: Wrote {output_biom}\n")
-            else:
-                sys.exit("ERROR: Missing optional Python library for BIOM output")
-
-    method_cleanup()
-
     if skipped_samples:
         sys.stderr.write(
             f"Skipped {len(skipped_samples)} previously classified samples\n"
@@ -14,24 +14,169 @@ from __future__ import annotations
 
 import gzip
 import os
+import subprocess
 import sys
 import tempfile
+import threading
+from bisect import bisect_right
 from collections import Counter
 from collections import defaultdict
+from collections.abc import Iterator
+from itertools import groupby
 from math import floor
 from math import log2
 from time import time
+from typing import IO
 
+import numpy as np
 from Bio.SeqIO.FastaIO import SimpleFastaParser
 from rapidfuzz.distance import Levenshtein
-from rapidfuzz.process import extract
-from rapidfuzz.process import extract_iter
+from rapidfuzz.process import cpdist
 
+from .utils import cmd_as_string
 from .utils import md5seq
 from .utils import run
 from .utils import split_read_name_abundance
 from .versions import check_tools
 
+_MAX_PAIRS = 1_000_000  # limit on number of distances calculated per batch
+_QGRAM = 4  # for the q-gram filter, giving 256 possible q-grams over ACGT
+_CHIMERA_KMER = 8  # for finding candidate parents of potential chimeras
+_QGRAM_CODES = np.full(256, 4, np.int64)  # 4 for anything but ACGT
+for _code, _letter in enumerate("ACGT"):
+    _QGRAM_CODES[ord(_letter)] = _QGRAM_CODES[ord(_letter.lower())] = _code
+del _code, _letter
+
+
+def _qgram_profile(seq: str) -> tuple[np.ndarray, int]:
+    """Count the q-grams of only A, C, G, and T in the sequence.
+
+    Returns an array of counts for each of the possible q-grams, and the
+    total (the number of q-grams in the sequence excluding any with other
+    letters like N).
+
+    >>> counts, total = _qgram_profile("ACGTNACGTA")
+    >>> total, int(counts[0b00011011]), int(counts.max())
+    (3, 2, 2)
+    """
+    index = _kmer_codes(seq, _QGRAM)
+    index = index[index >= 0]
+    return np.bincount(index, minlength=4**_QGRAM).astype(np.uint16), len(index)
+
+
+def _kmer_codes(seq: str, k: int) -> np.ndarray:
+    """Encode each k-mer of the sequence as an integer, or -1 if not all ACGT.
+
+    Returns an array with an entry for each start position in the sequence:
+
+    >>> _kmer_codes("AACGTNA", 2).tolist()
+    [0, 1, 6, 11, -1, -1]
+    """
+    codes = _QGRAM_CODES[np.frombuffer(seq.encode("ascii"), np.uint8)]
+    count = len(codes) - k + 1
+    if count < 1:
+        return np.zeros(0, np.int64)
+    index = codes[:count] & 3
+    for i in range(1, k):
+        index = index * 4 + (codes[i : i + count] & 3)
+    if (codes == 4).any():
+        # Flag any k-mer including a non-ACGT letter
+        bad = np.concatenate([[0], np.cumsum(codes == 4)])
+        index[bad[k:] != bad[:count]] = -1
+    return index
+
+
+def _add_centroid(
+    seq: str,
+    a: int,
+    centroid_seqs: list[str],
+    centroid_neg_a: list[int],
+    centroid_lens: np.ndarray,
+    centroid_valid: np.ndarray,
+    centroid_qgrams: np.ndarray,
+    qgrams: np.ndarray,
+    valid: int,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Record a new centroid, which must not be more abundant than the others.
+
+    The length, valid q-gram count and q-gram profile arrays are doubled in
+    size when full, so returns them (which may be new arrays).
+    """
+    assert not centroid_neg_a or centroid_neg_a[-1] <= -a
+    i = len(centroid_seqs)
+    if i == len(centroid_lens):
+        centroid_lens, centroid_valid, centroid_qgrams = (
+            np.concatenate([_, np.zeros_like(_)])
+            for _ in (centroid_lens, centroid_valid, centroid_qgrams)
+        )
+    centroid_seqs.append(seq)
+    centroid_neg_a.append(-a)
+    centroid_lens[i] = len(seq)
+    centroid_valid[i] = valid
+    centroid_qgrams[i] = qgrams
+    return centroid_lens, centroid_valid, centroid_qgrams
+
+
+def _unoise_choice(
+    query: str,
+    a: int,
+    within: list[tuple[int, str]],
+    counts: dict[str, int],
+    unoise_alpha: float,
+    abundance_based: bool,
+    debug: bool = False,
+) -> str | None:
+    """Pick the centroid for a UNOISE query, or None to make a new centroid.
+
+    Argument within is a list of candidate centroids with their distance to
+    the query (at most the cutoff), in order of decreasing abundance.
+    """
+    if abundance_based:
+        # size ordered abundance-based greedy clustering (AGC),
+        # where choices are sorted by decreasing abundance.
+        for dist, choice in within:
+            # UNOISE merges query into centroid if skew(M,C) <= beta(d),
+            #   (query abundance) / (centroid abundance) <= 1 / 2**(alpha*dist +1)
+            #   (query abundance) * 2**(alpha*dist + 1) <= centroid abundance
+            if a * 2 ** (unoise_alpha * dist + 1) <= counts[choice]:
+                if debug:
+                    sys.stderr.write(
+                        f"DEBUG: unoise-agc C:{md5seq(choice)}_{counts[choice]} "
+                        f"<-- Q:{md5seq(query)}_{a} dist {dist}\n"
+                    )
+                return choice
+        return None
+    # distance-based greedy clustering (DGC), must consider all distances
+    # in order to sort on them, as the closest may not pass the dynamic
+    # threshold.
+    candidates = sorted(
+        [
+            (dist, choice)
+            for (dist, choice) in within
+            if a * 2 ** (unoise_alpha * dist + 1) <= counts[choice]
+        ],
+        key=lambda x: (x[0], counts[x[1]], x[1]),
+    )
+    if not candidates:
+        return None
+    if debug:
+        sys.stderr.write(
+            f"DEBUG: unoise-dgc {md5seq(query)} has {len(candidates)} candidates\n"
+        )
+        if len(candidates) > 1:
+            for i, (dist, choice) in enumerate(candidates):
+                sys.stderr.write(
+                    f"DEBUG: #{i + 1} {md5seq(choice)}_{counts[choice]} dist {dist}\n"
+                )
+    # Take the closest one - tie break on abundance then sequence
+    dist, choice = candidates[0]
+    if debug:
+        sys.stderr.write(
+            f"DEBUG: unoise-dgc C:{md5seq(choice)}_{counts[choice]} "
+            f"<-- Q:{md5seq(query)}_{a} dist {dist}\n"
+        )
+    return choice
+
 
 def unoise(
     counts: dict[str, int],
@@ -39,6 +184,7 @@ def unoise(
     unoise_gamma: int | None = 4,
     abundance_based: bool = False,
     debug: bool = False,
+    cpu: int = 0,
 ) -> tuple[dict[str, str], dict[str, str]]:
     """Apply UNOISE2 algorithm.
 
@@ -48,8 +194,17 @@ def unoise(
     If not specified (i.e. set to zero or None), unoise_alpha defaults to 2.0
     and unoise_gamma to 4.
 
-    Returns a dict mapping input sequences to centroid sequences, and an empty
-    dict (no chimera detection performed).
+    Sequences with the same abundance can't be merged into each other, so
+    each tier of equal abundance queries has the same candidate centroids,
+    and their distances are calculated in batches (using multiple threads
+    if cpu is more than one). The assignments are then made in order, so the
+    results match handling one query at a time.
+
+    The denoised sequences are then checked for chimeras (using their totals
+    after read correction) with our UCHIME3 style de novo method.
+
+    Returns a dict mapping input sequences to centroid sequences, and a dict
+    of any chimeras detected.
     """
     debug = False  # too noisy otherwise
     if not counts:
@@ -60,108 +215,356 @@ def unoise(
         unoise_gamma = 4
 
     top_a = max(counts.values())  # will become first centroid
-    last_a = None
-    cutoff = 0
     centroids: dict[str, set[str]] = defaultdict(set)
-    high_abundance_centroids = None
+    # As sequences are processed by decreasing abundance, the centroids are
+    # added in that order, so those abundant enough are a prefix of the list.
+    # Recording negated abundances as an ascending list for use with bisect:
+    centroid_seqs: list[str] = []
+    centroid_neg_a: list[int] = []
+    # The length and q-gram profile of each centroid, for a cheap lower bound
+    # on the Levenshtein distance to filter candidates before calculating it:
+    queries = sorted(
+        ((a, seq) for (seq, a) in counts.items() if a >= unoise_gamma),
+        key=lambda x: (-x[0], x[1]),
+    )
+    # Sized for the centroids (grown as needed), not all the queries:
+    capacity = max(1, min(len(queries), 1024))
+    centroid_lens = np.zeros(capacity, np.int64)
+    centroid_valid = np.zeros(capacity, np.int64)
+    centroid_qgrams = np.zeros((capacity, 4**_QGRAM), np.uint16)
     if abundance_based:
         sys.stderr.write("Starting UNOISE abundance-based greedy clustering (AGC)\n")
     else:
         sys.stderr.write("Starting UNOISE distance-based greedy clustering (DGC)\n")
-    # Start by sorting sequences by abundance, largest first
-    for a, query in sorted(
-        ((a, seq) for (seq, a) in counts.items() if a >= unoise_gamma),
-        key=lambda x: (-x[0], x[1]),
-    ):
-        if debug:
-            sys.stderr.write(f"DEBUG: UNOISE on {query}_{a}\n")
-        # All the larger abundances have been processed already
-        # Towards the end have lots of entries with the same abundance
-        # so cache these dynamic thresholds use to narrow search pool
-        if a != last_a:
-            last_a = a
-            # Fist centroid is largest, so gives upper bound on d
-            cutoff = min(
-                floor((log2(top_a / a) - 1) / unoise_alpha) if a * 2 < top_a else 0, 10
-            )
-            # dist = 1 is a lower bound
-            high_abundance_centroids = [
-                seq for seq in centroids if counts[seq] >= a * 2 ** (unoise_alpha + 1)
-            ]
-        if abundance_based:
-            # size ordered abundance-based greedy clustering (AGC),
-            # where choices are sorted by decreasing abundance.
-            # Don't need to calculate all the distances:
-            for choice, dist, _index in extract_iter(
-                query,
-                high_abundance_centroids,
+    # Start by sorting sequences by abundance, largest first, and then take
+    # each tier of queries with the same abundance (all the larger abundances
+    # have been processed already).
+    for a, tier in groupby(queries, key=lambda x: x[0]):
+        # Fist centroid is largest, so gives upper bound on d
+        cutoff = min(
+            floor((log2(top_a / a) - 1) / unoise_alpha) if a * 2 < top_a else 0, 10
+        )
+        # dist = 1 is a lower bound
+        high_abundance = bisect_right(centroid_neg_a, -a * 2 ** (unoise_alpha + 1))
+        # Towards the end have lots of entries with the same abundance,
+        # so batch them to limit the memory needed for the distances:
+        tier_queries = [query for _, query in tier]
+        batch_size = max(1, _MAX_PAIRS // max(1, high_abundance))
+        for start in range(0, len(tier_queries), batch_size):
+            batch = tier_queries[start : start + batch_size]
+            profiles = [_qgram_profile(query) for query in batch]
+            # Levenshtein distance is at least the length difference, and each
+            # edit can remove at most q of the (valid) q-grams in common:
+            close = []
+            for query, (query_qgrams, query_valid) in zip(batch, profiles):
+                indexes = np.flatnonzero(
+                    np.abs(centroid_lens[:high_abundance] - len(query)) <= cutoff
+                )
+                close.append(
+                    indexes[
+                        np.minimum(centroid_qgrams[indexes], query_qgrams).sum(axis=1)
+                        >= np.maximum(centroid_valid[indexes], query_valid)
+                        - _QGRAM * cutoff
+                    ]
+                )
+            # Calculate all the query and candidate centroid pair distances:
+            pairs = np.concatenate(close)
+            distances = cpdist(
+                [query for query, _ in zip(batch, close) for _ in _],
+                [centroid_seqs[_] for _ in pairs.tolist()],
                 scorer=Levenshtein.distance,
                 score_cutoff=cutoff,
+                workers=max(1, cpu),
+                dtype=np.int32,
+            )
+            offsets = np.cumsum([0] + [len(_) for _ in close]).tolist()
+            for i, (query, (query_qgrams, query_valid)) in enumerate(
+                zip(batch, profiles)
             ):
-                # UNOISE merges query into centroid if skew(M,C) <= beta(d),
-                #   (query abundance) / (centroid abundance) <= 1 / 2**(alpha*dist +1)
-                #   (query abundance) * 2**(alpha*dist + 1) <= centroid abundance
-                if a * 2 ** (unoise_alpha * dist + 1) <= counts[choice]:
+                # Candidates within the cutoff, in order of decreasing abundance
+                query_distances = distances[offsets[i] : offsets[i + 1]]
+                within = [
+                    (int(query_distances[j]), centroid_seqs[close[i][j]])
+                    for j in np.flatnonzero(query_distances <= cutoff).tolist()
+                ]
+                choice = _unoise_choice(
+                    query, a, within, counts, unoise_alpha, abundance_based, debug
+                )
+                if choice:
                     centroids[choice].add(query)
-                    if debug:
-                        sys.stderr.write(
-                            f"DEBUG: unoise-agc C:{md5seq(choice)}_{counts[choice]} "
-                            f"<-- Q:{md5seq(query)}_{a} dist {dist}\n"
-                        )
-                    break
-            else:
-                # New centroid
-                centroids[query].add(query)
-                # print(query, "new")
-        else:
-            # distance-based greedy clustering (DGC), must compute all distances
-            # in order to sort on them. Can't use ``extractOne`` as the single
-            # entry it picks may not pass the dynamic threshold.
-            candidates = sorted(
-                [
-                    (dist, choice)
-                    for (choice, dist, _index) in extract(
+                else:
+                    # New centroid (only available to later tiers)
+                    centroids[query].add(query)
+                    centroid_lens, centroid_valid, centroid_qgrams = _add_centroid(
                         query,
-                        high_abundance_centroids,
-                        scorer=Levenshtein.distance,
-                        score_cutoff=cutoff,
-                        limit=None,
+                        a,
+                        centroid_seqs,
+                        centroid_neg_a,
+                        centroid_lens,
+                        centroid_valid,
+                        centroid_qgrams,
+                        query_qgrams,
+                        query_valid,
                     )
-                    if a * 2 ** (unoise_alpha * dist + 1) <= counts[choice]
-                ],
-                key=lambda x: (x[0], counts[x[1]], x[1]),
-            )
-            if candidates:
-                if debug:
-                    sys.stderr.write(
-                        f"DEBUG: unoise-dgc {md5seq(query)} has "
-                        f"{len(candidates)} candidates\n"
-                    )
-                    if len(candidates) > 1:
-                        for i, (dist, choice) in enumerate(candidates):
-                            sys.stderr.write(
-                                f"DEBUG: #{i + 1} {md5seq(choice)}_{counts[choice]} "
-                                f"dist {dist}\n"
-                            )
-                # Take the closest one - tie break on abundance then sequence
-                dist, choice = candidates[0]
-                centroids[choice].add(query)
-                if debug:
-                    sys.stderr.write(
-                        f"DEBUG: unoise-dgc C:{md5seq(choice)}_{counts[choice]} "
-                        f"<-- Q:{md5seq(query)}_{a} dist {dist}\n"
-                    )
-            else:
-                # New centroid
-                centroids[query].add(query)
-                # print(query, "new")
 
     corrections: dict[str, str] = {}
     for seq, choices in centroids.items():
         for _ in choices:
             corrections[_] = seq
         assert corrections[seq] == seq, "Centroid missing"
-    return corrections, {}
+    chimeras = uchime_denovo(
+        {seq: sum(counts[_] for _ in choices) for seq, choices in centroids.items()},
+        debug=debug,
+    )
+    return corrections, chimeras
+
+
+def _edit_positions(query: str, parent: str) -> np.ndarray:
+    """Flag query positions which differ from the parent in a global alignment.
+
+    Returns an array one longer than the query, where the extra final entry
+    is for any additional bases at the end of the parent:
+
+    >>> _edit_positions("ACGTAC", "ACCTACG").tolist()
+    [0, 0, 1, 0, 0, 0, 1]
+    """
+    diffs = np.zeros(len(query) + 1, np.int64)
+    diffs[[op.src_pos for op in Levenshtein.editops(query, parent)]] = 1
+    return diffs
+
+
+class _KmerIndex:
+    """Index of the distinct k-mers in each of a growing list of sequences.
+
+    New entries are only indexed when first needed by a lookup, in bulk as
+    a block listing the entries for each k-mer. Smaller blocks are merged
+    into larger blocks as they accumulate, so there are only ever a few
+    blocks to search.
+    """
+
+    def __init__(self, k: int) -> None:
+        """Initialize an empty index for k-mers encoded as by _kmer_codes."""
+        self.size = 4**k  # number of possible k-mer codes
+        self.blocks: list[tuple[np.ndarray, np.ndarray]] = []
+        self.entries: list[np.ndarray] = []  # distinct k-mers of each entry
+        self.indexed = 0
+
+    def add(self, kmers: np.ndarray) -> None:
+        """Add the next entry, given its distinct k-mers."""
+        self.entries.append(kmers.astype(np.int32))
+
+    def hits(
+        self, kmers: np.ndarray, labels: np.ndarray, groups: int, size: int
+    ) -> np.ndarray:
+        """Count the labelled k-mers in each of the first size entries.
+
+        The k-mers should be distinct within each label (from zero up to but
+        excluding the number of groups). Returns a 2D array with a row of hits
+        for each group. The size must not decrease from one call to the next.
+        """
+        assert self.indexed <= size <= len(self.entries)
+        if size > self.indexed:
+            new = self.entries[self.indexed : size]
+            codes = np.concatenate(new)
+            ids = np.repeat(
+                np.arange(self.indexed, size, dtype=np.int64), [len(_) for _ in new]
+            )
+            self.indexed = size
+            while self.blocks and len(self.blocks[-1][1]) <= 2 * len(codes):
+                old_bounds, old_ids = self.blocks.pop()
+                codes = np.concatenate(
+                    [
+                        np.repeat(np.arange(len(old_bounds) - 1), np.diff(old_bounds)),
+                        codes,
+                    ]
+                )
+                ids = np.concatenate([old_ids, ids])
+            # Compressed sparse row style, so the entries for k-mer code x
+            # are ids[bounds[x] : bounds[x + 1]]
+            bounds = np.zeros(self.size + 1, np.int64)
+            np.cumsum(np.bincount(codes, minlength=self.size), out=bounds[1:])
+            self.blocks.append((bounds, ids[np.argsort(codes, kind="stable")]))
+        # Offset each group's entries so all can be counted at once:
+        offsets = labels * size
+        hits = np.zeros(groups * size, np.int64)
+        for bounds, ids in self.blocks:
+            starts = bounds[kmers]
+            lengths = bounds[kmers + 1] - starts
+            if lengths.any():
+                # Concatenate the ranges of entries for each k-mer:
+                index = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+                index += np.arange(len(index))
+                hits += np.bincount(
+                    ids[index] + np.repeat(offsets, lengths), minlength=len(hits)
+                )
+        return hits.reshape(groups, size)
+
+
+def uchime_denovo(
+    counts: dict[str, int],
+    abundance_skew: float = 16.0,
+    debug: bool = False,
+) -> dict[str, str]:
+    """Flag likely chimeras amongst denoised sequences, in the style of UCHIME3.
+
+    Argument counts is an (unsorted) dict of denoised sequences as keys, with
+    their total abundance counts as values. These are considered in order of
+    decreasing abundance, where potential parents must be at least the given
+    abundance skew times more abundant than the query (default 16 as in the
+    UCHIME3 de novo algorithm). As in UCHIME2 and UCHIME3, the query is assumed
+    to be correct, so is only flagged if a model of two parents with a single
+    breakpoint matches it perfectly. Anything not flagged as a chimera becomes
+    a candidate parent for subsequent queries.
+
+    Candidate parents are taken from a k-mer index as the best hit for each
+    quarter of the query, and overall. Each is aligned to the query, and the
+    breakpoints where the left part matches one candidate and the right part
+    another are found for all the candidate pairs at once using cumulative
+    sums of the differences.
+
+    Returns a dict mapping the MD5 checksums of any chimeras to a string of the
+    MD5 checksums of the left and right parents, separated by a slash.
+
+    >>> a = "ACGTACGTAATTGGCCAATTGGCATGCATGTTAACC"
+    >>> b = "ACGTTCGTAATTGGCCAATTGGCATGCCTGTTAACC"
+    >>> q = a[:16] + b[16:]
+    >>> uchime_denovo({a: 1000, b: 500, q: 10}) == {
+    ...     md5seq(q): md5seq(a) + "/" + md5seq(b)
+    ... }
+    True
+    """
+    chimeras: dict[str, str] = {}
+    # As queries are processed by decreasing abundance, the parents are added
+    # in that order, so those abundant enough are a prefix of the list.
+    # Recording negated abundances as an ascending list for use with bisect:
+    parent_seqs: list[str] = []
+    parent_neg_a: list[int] = []
+    kmer_index = _KmerIndex(_CHIMERA_KMER)
+    in_top = np.zeros(kmer_index.size, bool)  # scratch space
+    for seq, a in sorted(counts.items(), key=lambda x: (-x[1], x[0])):
+        kmers = _kmer_codes(seq, _CHIMERA_KMER)
+        # Distinct k-mers in each quarter of the query, and overall:
+        quarters = np.unique(
+            (np.arange(len(kmers)) * 4 // max(1, len(kmers)) << 16 | kmers)[kmers >= 0]
+        )
+        distinct = np.unique(quarters & 0xFFFF)
+        parents = bisect_right(parent_neg_a, -a * abundance_skew)
+        candidates = set()
+        if parents > 1:
+            quarter_hits = kmer_index.hits(
+                quarters & 0xFFFF, quarters >> 16, 4, parents
+            )
+            total_hits = quarter_hits.sum(axis=0)
+            top = int(total_hits.argmax())
+            candidates.add(top)
+            # Also want the best parent for the k-mers missing from the top hit
+            # (as with short segments the best hit per quarter may not find it):
+            in_top[kmer_index.entries[top]] = True
+            missing = distinct[~in_top[distinct]]
+            in_top[kmer_index.entries[top]] = False
+            missing_hits = kmer_index.hits(
+                missing, np.zeros(len(missing), np.int64), 1, parents
+            )
+            for hits in np.concatenate([quarter_hits, missing_hits]):
+                if hits.any():
+                    # Tie break on overall hits, then abundance (as argmax
+                    # takes the first):
+                    candidates.add(
+                        int((hits * (total_hits.max() + 1) + total_hits).argmax())
+                    )
+        if len(candidates) > 1:
+            choices = sorted(candidates)
+            diffs = np.array([_edit_positions(seq, parent_seqs[_]) for _ in choices])
+            # Number of differences before each possible breakpoint:
+            before = np.zeros((len(choices), len(seq) + 2), np.int64)
+            np.cumsum(diffs, axis=1, out=before[:, 1:])
+            left_match = (before == 0).astype(np.int64)
+            right_match = (before == before[:, -1:]).astype(np.int64)
+            # Count of breakpoints where left and right parent pair match,
+            # the diagonal will be zero as each parent has some difference:
+            models = np.argwhere(left_match @ right_match.T)
+            if len(models):
+                left, right = (parent_seqs[choices[_]] for _ in models[0])
+                chimeras[md5seq(seq)] = md5seq(left) + "/" + md5seq(right)
+                if debug:
+                    sys.stderr.write(
+                        f"DEBUG: uchime {md5seq(seq)}_{a} chimera of "
+                        f"{md5seq(left)}_{counts[left]} "
+                        f"and {md5seq(right)}_{counts[right]}\n"
+                    )
+                continue
+        # Not a chimera, so a potential parent for later queries
+        kmer_index.add(distinct)
+        parent_seqs.append(seq)
+        parent_neg_a.append(-a)
+    return chimeras
+
+
+def _write_fasta(handle: IO[str], records: list[tuple[str, str]]) -> None:
+    """Write FASTA records (title and sequence pairs) and close the handle."""
+    try:
+        for title, seq in records:
+            handle.write(f">{title}\n{seq}\n")
+        handle.close()
+    except BrokenPipeError:
+        # Tool exited early, caller will report its return code. Closing
+        # still fails flushing our buffer, but does close the pipe:
+        try:
+            handle.close()
+        except BrokenPipeError:
+            pass
+
+
+def _tool_output(
+    cmd: list[str],
+    records: list[tuple[str, str]],
+    input_fasta: str | None = None,
+    output_filename: str | None = None,
+    debug: bool = False,
+) -> Iterator[str]:
+    """Run a tool on FASTA records, yielding the lines of its output.
+
+    If given input and output filenames (which the command should use), the
+    records are written to the input file, the tool is run, and its output
+    file is then read back.
+
+    Otherwise the command should read the FASTA input from stdin and write
+    the output of interest to stdout. The records are fed to the tool in a
+    background thread while the output is parsed as it arrives, with stderr
+    going to an anonymous temporary file so that it cannot block the pipes.
+    """
+    if input_fasta:
+        assert output_filename
+        with open(input_fasta, "w") as handle:
+            _write_fasta(handle, records)
+        run(cmd, debug=debug)
+        with open(output_filename) as handle:
+            yield from handle
+        return
+    if debug:
+        sys.stderr.write(f"Calling command: {cmd_as_string(cmd)}\n")
+    with tempfile.TemporaryFile(mode="w+") as err_handle:
+        with subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=err_handle,
+            text=True,
+        ) as child:
+            assert child.stdin is not None
+            assert child.stdout is not None
+            feeder = threading.Thread(target=_write_fasta, args=(child.stdin, records))
+            feeder.start()
+            yield from child.stdout
+            feeder.join()
+        if child.returncode:
+            if debug:
+                err_handle.seek(0)
+                sys.stderr.write(err_handle.read())
+            sys.exit(
+                f"ERROR: Return code {child.returncode} from command:"
+                f"\n{cmd_as_string(cmd)}\n"
+            )
 
 
 def usearch(
@@ -178,49 +581,49 @@ def usearch(
     Assumes v10 or v11 (or later if the command line API is the same).
     Parses the four columns tabbed output.
 
+    If a temp folder is given, the input FASTA and output TSV files are kept
+    there. Otherwise the sequences are piped to USEARCH via ``/dev/stdin``,
+    and the tabbed output is read from ``/dev/stdout`` as it arrives.
+
     Returns a dict mapping input sequences to centroid sequences, and a dict
     of MD5 checksums of any sequences flagged as chimeras.
     """
     check_tools(["usearch"], debug)
 
+    # Default to piping the input and output via stdin and stdout
+    input_fasta: str | None = None
+    output_tsv: str | None = None
     if tmp_dir:
         # Up to the user to remove the files
-        tmp_obj = None
-        shared_tmp = tmp_dir
-    else:
-        tmp_obj = tempfile.TemporaryDirectory()
-        shared_tmp = tmp_obj.name
-
-    if debug:
-        sys.stderr.write(f"DEBUG: Shared temp folder {shared_tmp}\n")
-
-    input_fasta = os.path.join(shared_tmp, "noisy.fasta")
-    output_tsv = os.path.join(shared_tmp, "clustering.tsv")
+        if debug:
+            sys.stderr.write(f"DEBUG: Shared temp folder {tmp_dir}\n")
+        input_fasta = os.path.join(tmp_dir, "noisy.fasta")
+        output_tsv = os.path.join(tmp_dir, "clustering.tsv")
     md5_to_seq = {}
-    with open(input_fasta, "w") as handle:
-        # Output using MD5 with USEARCH naming: md5;size=abundance
-        # Sorting sequences by abundance, largest first
-        # If gamma known, can pre-filter to drop trace level entries
-        for a, seq in sorted(
-            (
-                (a, seq)
-                for (seq, a) in counts.items()
-                if not unoise_gamma or a >= unoise_gamma
-            ),
-            key=lambda x: (-x[0], x[1]),
-        ):
-            md5 = md5seq(seq)
-            handle.write(f">{md5};size={a}\n{seq}\n")
-            md5_to_seq[md5] = seq
+    records = []
+    # Output using MD5 with USEARCH naming: md5;size=abundance
+    # Sorting sequences by abundance, largest first
+    # If gamma known, can pre-filter to drop trace level entries
+    for a, seq in sorted(
+        (
+            (a, seq)
+            for (seq, a) in counts.items()
+            if not unoise_gamma or a >= unoise_gamma
+        ),
+        key=lambda x: (-x[0], x[1]),
+    ):
+        md5 = md5seq(seq)
+        records.append((f"{md5};size={a}", seq))
+        md5_to_seq[md5] = seq
 
     cmd = [
         "usearch",
         "-unoise3",
-        input_fasta,
+        input_fasta or "/dev/stdin",
         # "-zotus",
         # output_fasta,
         "-tabbedout",
-        output_tsv,
+        output_tsv or "/dev/stdout",
     ]
     if unoise_alpha:
         cmd += ["-unoise_alpha", str(unoise_alpha)]
@@ -232,55 +635,53 @@ def usearch(
         # Currently triggers:
         # WARNING: Option -threads not used
         cmd += ["--threads", str(cpu)]
-    run(cmd, debug=debug)
     corrections = {}
     chimeras = {}
     amp_md5 = {}  # maps USEARCH amplicon (centroid) names to MD5
-    with open(output_tsv) as handle:
-        for line in handle:
-            if not line:
-                continue
-            parts = line.split("\t")
-            md5 = parts[0].split(";", 1)[0]  # strip the size information
-            seq = md5_to_seq[md5]
-            if len(parts) not in (3, 4):
-                sys.exit(
-                    f"ERROR: Found {len(parts)} fields in "
-                    "usearch -tabbedout output, not 3 or 4"
+    for line in _tool_output(cmd, records, input_fasta, output_tsv, debug):
+        if not line:
+            continue
+        parts = line.split("\t")
+        md5 = parts[0].split(";", 1)[0]  # strip the size information
+        seq = md5_to_seq[md5]
+        if len(parts) not in (3, 4):
+            sys.exit(
+                f"ERROR: Found {len(parts)} fields in "
+                "usearch -tabbedout output, not 3 or 4"
+            )
+        if parts[1] == "denoise":
+            if parts[2].startswith("amp") and len(parts) == 3:
+                # centroid
+                corrections[seq] = seq
+                amp_md5[parts[2].strip("\n").lower()] = md5
+            elif parts[2] in ("bad", "shifted") and ";top=" in parts[3]:
+                # hit, mapped to a centroid
+                centroid_md5 = parts[3].split(";top=", 1)[1].split(";", 1)[0]
+                corrections[seq] = md5_to_seq[centroid_md5]
+            else:
+                sys.exit(f"ERROR: Unexpected usearch denoise line: {line!r}")
+        elif parts[1] == "chfilter":
+            if parts[2] == "zotu\n":
+                pass
+            elif parts[2] == "chimera":
+                # Expect something like this in final field:
+                # dqm=0;dqt=33;div=18.2;top=(R);parentL=Amp4;parentR=Amp13;
+                # dqm=0;dqt=7;div=3.4;top=(L);parentL=Amp8;parentR=Amp4;
+                # dqm=0;dqt=9;div=4.5;top=Amp54;parentL=Amp25;parentR=Amp13;
+                # Note Amp with upper case A, verus lower case above.
+                # Note not clear to me what top field means...
+                fields = dict(
+                    _.split("=", 1)
+                    for _ in parts[3].strip("\n").strip(";").lower().split(";")
+                )
+                chimeras[md5] = (
+                    amp_md5[fields["parentl"]] + "/" + amp_md5[fields["parentr"]]
                 )
-            if parts[1] == "denoise":
-                if parts[2].startswith("amp") and len(parts) == 3:
-                    # centroid
-                    corrections[seq] = seq
-                    amp_md5[parts[2].strip("\n").lower()] = md5
-                elif parts[2] in ("bad", "shifted") and ";top=" in parts[3]:
-                    # hit, mapped to a centroid
-                    centroid_md5 = parts[3].split(";top=", 1)[1].split(";", 1)[0]
-                    corrections[seq] = md5_to_seq[centroid_md5]
-                else:
-                    sys.exit(f"ERROR: Unexpected usearch denoise line: {line!r}")
-            elif parts[1] == "chfilter":
-                if parts[2] == "zotu\n":
-                    pass
-                elif parts[2] == "chimera":
-                    # Expect something like this in final field:
-                    # dqm=0;dqt=33;div=18.2;top=(R);parentL=Amp4;parentR=Amp13;
-                    # dqm=0;dqt=7;div=3.4;top=(L);parentL=Amp8;parentR=Amp4;
-                    # dqm=0;dqt=9;div=4.5;top=Amp54;parentL=Amp25;parentR=Amp13;
-                    # Note Amp with upper case A, verus lower case above.
-                    # Note not clear to me what top field means...
-                    fields = dict(
-                        _.split("=", 1)
-                        for _ in parts[3].strip("\n").strip(";").lower().split(";")
-                    )
-                    chimeras[md5] = (
-                        amp_md5[fields["parentl"]] + "/" + amp_md5[fields["parentr"]]
-                    )
-                else:
-                    sys.exit(f"ERROR: Unexpected usearch chfilter line: {line!r}")
             else:
-                sys.exit(f"ERROR: Unexpected usearch tabbedout line: {line!r}")
-    del md5_to_seq
+                sys.exit(f"ERROR: Unexpected usearch chfilter line: {line!r}")
+        else:
+            sys.exit(f"ERROR: Unexpected usearch tabbedout line: {line!r}")
+    del md5_to_seq, records
     return corrections, chimeras
 
 
@@ -298,53 +699,55 @@ def vsearch(
     Argument counts is an (unsorted) dict of sequences (for the same amplicon
     marker) as keys, with their total abundance counts as values.
 
+    If a temp folder is given, the input and output FASTA and TSV files are
+    kept there. Otherwise the sequences are piped to VSEARCH via stdin, and
+    the cluster and chimera reports are read from stdout as they arrive.
+
     Returns a dict mapping input sequences to centroid sequences, and a dict
     of MD5 checksums of any sequences flagged as chimeras.
     """
     check_tools(["vsearch"], debug)
 
+    # Default to piping the inputs and outputs via stdin and stdout
+    input_fasta: str | None = None
+    output_tsv: str | None = None
+    denoised_fasta: str | None = None
+    chimera_tsv: str | None = None
     if tmp_dir:
         # Up to the user to remove the files
-        tmp_obj = None
-        shared_tmp = tmp_dir
-    else:
-        tmp_obj = tempfile.TemporaryDirectory()
-        shared_tmp = tmp_obj.name
-
-    if debug:
-        sys.stderr.write(f"DEBUG: Shared temp folder {shared_tmp}\n")
-
-    input_fasta = os.path.join(shared_tmp, "noisy.fasta")
-    output_tsv = os.path.join(shared_tmp, "clustering.tsv")
-    denoised_fasta = os.path.join(shared_tmp, "denoised.fasta")
-    chimera_tsv = os.path.join(shared_tmp, "chimeras.tsv")
+        if debug:
+            sys.stderr.write(f"DEBUG: Shared temp folder {tmp_dir}\n")
+        input_fasta = os.path.join(tmp_dir, "noisy.fasta")
+        output_tsv = os.path.join(tmp_dir, "clustering.tsv")
+        denoised_fasta = os.path.join(tmp_dir, "denoised.fasta")
+        chimera_tsv = os.path.join(tmp_dir, "chimeras.tsv")
     md5_to_seq = {}
-    with open(input_fasta, "w") as handle:
-        # Output using MD5 with USEARCH naming: md5;size=abundance
-        # Sorting sequences by abundance, largest first
-        # If we can, pre-filter using gamma
-        for a, seq in sorted(
-            (
-                (a, seq)
-                for (seq, a) in counts.items()
-                if not unoise_gamma or a >= unoise_gamma
-            ),
-            key=lambda x: (-x[0], x[1]),
-        ):
-            md5 = md5seq(seq)
-            handle.write(f">{md5};size={a}\n{seq}\n")
-            md5_to_seq[md5] = seq
+    records = []
+    # Output using MD5 with USEARCH naming: md5;size=abundance
+    # Sorting sequences by abundance, largest first
+    # If we can, pre-filter using gamma
+    for a, seq in sorted(
+        (
+            (a, seq)
+            for (seq, a) in counts.items()
+            if not unoise_gamma or a >= unoise_gamma
+        ),
+        key=lambda x: (-x[0], x[1]),
+    ):
+        md5 = md5seq(seq)
+        records.append((f"{md5};size={a}", seq))
+        md5_to_seq[md5] = seq
 
     cmd = [
         "vsearch",
         "--sizein",
         "--sizeout",
         "--cluster_unoise",
-        input_fasta,
+        input_fasta or "-",
         # "--centroids",
         # output_fasta,
         "--uc",
-        output_tsv,
+        output_tsv or "-",
     ]
     if unoise_alpha:
         cmd += ["-unoise_alpha", str(unoise_alpha)]
@@ -358,75 +761,67 @@ def vsearch(
         # clustering (DGC).
     if cpu:
         cmd += ["--threads", str(cpu)]
-    run(cmd, debug=debug)
     corrections = {}
-    with open(output_tsv) as handle:
-        for line in handle:
-            if not line:
-                continue
-            parts = line.split("\t")
-            md5 = parts[8].split(";", 1)[0]  # strip the size information
-            seq = md5_to_seq[md5]
-            if len(parts) != 10:
-                sys.exit(
-                    f"ERROR: Found {len(parts)} fields in vsearch --uc output, not 10"
-                )
-            if parts[0] == "S":
-                # centroid
-                corrections[seq] = seq
-            elif parts[0] == "H":
-                # hit, mapped to a centroid
-                centroid_md5 = parts[9].split(";", 1)[0]
-                corrections[seq] = md5_to_seq[centroid_md5]
-            elif parts[0] == "C":
-                # cluster summary (should be one for each S line)
-                pass
-            else:
-                sys.exit(
-                    f"ERROR: vsearch --uc output line started {parts[0]}, not S, H or C"
-                )
-    del md5_to_seq
-
-    with open(denoised_fasta, "w") as handle:
-        # TODO: Wasteful as will re-compute the post-correction counts
-        post_counts: dict[str, int] = defaultdict(int)
-        for seq, a in counts.items():
-            if seq not in corrections:
-                # Ignored as per UNOISE algorithm
-                if unoise_gamma:
-                    assert a < unoise_gamma, (
-                        f"{md5seq(seq)} total {a} vs {unoise_gamma}"
-                    )
-                continue
-            seq = corrections[seq]
-            post_counts[seq] += a
-        for seq, a in sorted(post_counts.items(), key=lambda x: (-x[1], x[0])):
+    for line in _tool_output(cmd, records, input_fasta, output_tsv, debug):
+        if not line:
+            continue
+        parts = line.split("\t")
+        md5 = parts[8].split(";", 1)[0]  # strip the size information
+        seq = md5_to_seq[md5]
+        if len(parts) != 10:
+            sys.exit(f"ERROR: Found {len(parts)} fields in vsearch --uc output, not 10")
+        if parts[0] == "S":
+            # centroid
+            corrections[seq] = seq
+        elif parts[0] == "H":
+            # hit, mapped to a centroid
+            centroid_md5 = parts[9].split(";", 1)[0]
+            corrections[seq] = md5_to_seq[centroid_md5]
+        elif parts[0] == "C":
+            # cluster summary (should be one for each S line)
+            pass
+        else:
+            sys.exit(
+                f"ERROR: vsearch --uc output line started {parts[0]}, not S, H or C"
+            )
+    del md5_to_seq, records
+
+    # TODO: Wasteful as will re-compute the post-correction counts
+    post_counts: dict[str, int] = defaultdict(int)
+    for seq, a in counts.items():
+        if seq not in corrections:
+            # Ignored as per UNOISE algorithm
             if unoise_gamma:
-                assert a >= unoise_gamma
-            assert corrections[seq] == seq
-            handle.write(f">{md5seq(seq)};size={a}\n{seq}\n")
-        del post_counts
+                assert a < unoise_gamma, f"{md5seq(seq)} total {a} vs {unoise_gamma}"
+            continue
+        seq = corrections[seq]
+        post_counts[seq] += a
+    records = []
+    for seq, a in sorted(post_counts.items(), key=lambda x: (-x[1], x[0])):
+        if unoise_gamma:
+            assert a >= unoise_gamma
+        assert corrections[seq] == seq
+        records.append((f"{md5seq(seq)};size={a}", seq))
+    del post_counts
     cmd = [
         "vsearch",
         "--sizein",
         "--sizeout",
         "--uchime3_denovo",
-        denoised_fasta,
+        denoised_fasta or "-",
         "--uchimeout",
-        chimera_tsv,
+        chimera_tsv or "-",
     ]
     if cpu:
         cmd += ["--threads", str(cpu)]
-    run(cmd, debug=debug)
     chimeras = {}
-    with open(chimera_tsv) as handle:
-        for line in handle:
-            if not line or line.endswith("N\n"):
-                continue
-            parts = line.split("\t", 5)
-            md5 = parts[1].split(";", 1)[0]  # strip the size information
-            assert len(md5) == 32, line
-            chimeras[md5] = parts[2].split(";", 1)[0] + "/" + parts[3].split(";", 1)[0]
+    for line in _tool_output(cmd, records, denoised_fasta, chimera_tsv, debug):
+        if not line or line.endswith("N\n"):
+            continue
+        parts = line.split("\t", 5)
+        md5 = parts[1].split(";", 1)[0]  # strip the size information
+        assert len(md5) == 32, line
+        chimeras[md5] = parts[2].split(";", 1)[0] + "/" + parts[3].split(";", 1)[0]
 
     return corrections, chimeras
 
@@ -451,13 +846,13 @@ def read_correction(
     marker) as keys, with their total abundance counts as values.
 
     Returns a dict mapping input sequences to centroid sequences, and dict of
-    any chimeras detected (empty for some algorithms).
+    any chimeras detected.
     """
     start = time()
     if algorithm == "unoise-l":
-        # Does not need tmp_dir, cpu
+        # Does not need tmp_dir
         answer = unoise(
-            counts, unoise_alpha, unoise_gamma, abundance_based, debug=False
+            counts, unoise_alpha, unoise_gamma, abundance_based, debug=False, cpu=cpu
         )
     elif algorithm == "usearch":
         # Does not need cpu?
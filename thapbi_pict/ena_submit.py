@@ -17,6 +17,7 @@ import tempfile
 
 from .prepare import find_fastq_pairs
 from .utils import load_metadata
+from .utils import md5_from_sidecars
 
 # As of Nov 2024 and earlier, there are 12 mandatory fields:
 #
@@ -58,25 +59,11 @@ assert TABLE_HEADER.count("\t") == TABLE_TEMPLATE.count("\t")
 def load_md5(file_list: list[str]) -> dict[str, str]:
     """Return a dict mapping given filenames to MD5 digests."""
     assert file_list, "Nothing to do here."
-    answer = {}
     base_names = {os.path.split(_)[1] for _ in file_list}
     if len(base_names) < len(file_list):
         # This isn't a problem locally, but will be on upload to ENA
         sys.exit("ERROR: Duplicate FASTQ names once folder dropped")
-    checksum_files = {_ + ".md5" for _ in file_list}
-    checksum_files.update(
-        os.path.join(os.path.split(_)[0], "MD5SUM.txt") for _ in file_list
-    )
-    for cache in checksum_files:
-        if os.path.isfile(cache):
-            with open(cache) as handle:
-                for line in handle:
-                    md5, filename = line.strip().split()
-                    # If MD5 file contains relative path, interpret it
-                    assert "/" not in filename, filename
-                    filename = os.path.join(os.path.split(cache)[0], filename)
-                    if filename in file_list:
-                        answer[filename] = md5
+    answer = md5_from_sidecars(file_list, strict=True)
     if not answer:
         sys.exit("ERROR: Need to provide MD5SUM.txt or example.fastq.gz.md5 files")
     for f in file_list:
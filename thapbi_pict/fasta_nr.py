@@ -15,11 +15,8 @@ import os
 import sys
 from collections import Counter
 
-from Bio.Seq import reverse_complement
-from Bio.SeqIO.FastaIO import SimpleFastaParser
-
 from .prepare import save_nr_fasta
-from .utils import abundance_from_read_name
+from .utils import abundance_counts_in_fastas
 
 
 def main(
@@ -30,8 +27,12 @@ def main(
     min_length: int = 0,
     max_length: int = sys.maxsize,
     debug: bool = False,
+    cpu: int = 0,
 ) -> None:
-    """Implement the ``thapbi_pict fasta-nr`` command."""
+    """Implement the ``thapbi_pict fasta-nr`` command.
+
+    Given more than one CPU, the input files are parsed in parallel.
+    """
     if not inputs:
         inputs = []
     if not revcomp:
@@ -58,23 +59,19 @@ def main(
             )
 
     counts: dict[str, int] = Counter()
-    for filename in inputs:
-        # Assuming FASTA for now
-        if debug:
+    if debug:
+        for filename in inputs:
             sys.stderr.write(f"DEBUG: Parsing {filename}\n")
-        with open(filename) as handle:
-            for _, seq in SimpleFastaParser(handle):
-                if min_length <= len(seq) <= max_length:
-                    a = abundance_from_read_name(_.split(None, 1)[0])
-                    counts[seq.upper()] += a
-    for filename in revcomp:
-        if debug:
+        for filename in revcomp:
             sys.stderr.write(f"DEBUG: Parsing {filename} (will reverse complement)\n")
-        with open(filename) as handle:
-            for _, seq in SimpleFastaParser(handle):
-                if min_length <= len(seq) <= max_length:
-                    a = abundance_from_read_name(_.split(None, 1)[0])
-                    counts[reverse_complement(seq.upper())] += a
+    for file_counts in abundance_counts_in_fastas(
+        inputs + revcomp,
+        min_length,
+        max_length,
+        revcomp=[False] * len(inputs) + [True] * len(revcomp),
+        cpu=cpu,
+    ):
+        counts.update(file_counts)
 
     if counts:
         sys.stderr.write(
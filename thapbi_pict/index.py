@@ -0,0 +1,394 @@
+# Copyright 2026 by Peter Cock, University of Strathclyde.
+# All rights reserved.
+# This file is part of the THAPBI Phytophthora ITS1 Classifier Tool (PICT),
+# and is released under the "MIT License Agreement". Please see the LICENSE
+# file that should have been included as part of this package.
+"""Pre-computed classifier index of the marker sequences in a database.
+
+This implements the ``thapbi_pict index ...`` command, which writes an index
+file for each marker next to the SQLite database. The classifiers will memory
+map a fresh index file rather than querying the database and rebuilding their
+lookup tables on every run.
+
+The index file starts with a short magic string, then the length of a JSON
+header (as an 8 byte little endian integer), the JSON header itself, then the
+raw NumPy arrays listed in the header (each aligned to 64 bytes). The header
+records the MD5 checksum of the database file, so stale indexes are detected.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from .db_orm import connect_to_db
+from .db_orm import MarkerDef
+from .db_orm import MarkerSeq
+from .db_orm import SeqSource
+from .db_orm import Taxonomy
+from .utils import md5_hexdigest
+
+INDEX_MAGIC = b"THAPBI-PICT-INDEX\n"
+INDEX_VERSION = 1  # increment if the file layout or array contents change
+INDEX_ALIGN = 64
+QGRAM = 16  # q-gram length for substring index, 2 bits per base so fits uint32
+HASH_BASE = 1000003  # odd, so invertible modulo 2**64 for the deletion hashes
+HASH_INVERSE = pow(HASH_BASE, -1, 2**64)
+
+# Map ASCII to 2-bit nucleotide codes, with 255 for anything else
+_NUC_CODE = np.full(256, 255, dtype=np.uint8)
+for _code, _nuc in enumerate("ACGT"):
+    _NUC_CODE[ord(_nuc)] = _code
+del _code, _nuc
+
+
+def index_filename(db_file: str, marker_name: str) -> str:
+    """Return the index filename for the given marker in an SQLite database file."""
+    return f"{db_file}.{marker_name}.index"
+
+
+def db_filename(session) -> str | None:
+    """Return the SQLite database filename for the session, or None if in memory."""
+    db_file: str | None = session.get_bind().url.database
+    if not db_file or db_file == ":memory:" or not os.path.isfile(db_file):
+        return None
+    return db_file
+
+
+def qgram_codes(seq: str) -> np.ndarray:
+    """Return array of 2-bit encoded q-grams in the sequence, skipping ambiguous ones.
+
+    >>> qgram_codes("A" * 15 + "C").tolist()
+    [1]
+    >>> qgram_codes("A" * 15 + "CN").tolist()
+    [1]
+    >>> qgram_codes("A" * 15).tolist()
+    []
+    """
+    count = len(seq) - QGRAM + 1
+    if count < 1:
+        return np.zeros(0, dtype=np.uint32)
+    nucs = _NUC_CODE[np.frombuffer(seq.encode("ascii"), dtype=np.uint8)]
+    codes = np.zeros(count, dtype=np.uint32)
+    for offset in range(QGRAM):
+        codes |= nucs[offset : offset + count].astype(np.uint32) << np.uint32(
+            2 * (QGRAM - 1 - offset)
+        )
+    # Only keep q-grams without any ambiguous bases
+    bad = np.concatenate(([0], np.cumsum(nucs == 255)))
+    good: np.ndarray = codes[bad[QGRAM:] == bad[:count]]
+    return good
+
+
+def add_qgram_index(arrays: dict[str, np.ndarray], seqs: list[str]) -> None:
+    """Add q-gram index arrays for the sequences, if not already present.
+
+    Adds a sorted array of the distinct q-gram codes, with an array of offsets
+    into an array of sequence indexes for each q-gram (like a sparse matrix in
+    CSR format).
+    """
+    if "qgram_codes" in arrays:
+        return
+    codes = []
+    seq_ids = []
+    for i, seq in enumerate(seqs):
+        seq_codes = np.unique(qgram_codes(seq))
+        codes.append(seq_codes)
+        seq_ids.append(np.full(len(seq_codes), i, dtype=np.int32))
+    all_codes = np.concatenate(codes) if codes else np.zeros(0, dtype=np.uint32)
+    all_ids = np.concatenate(seq_ids) if seq_ids else np.zeros(0, dtype=np.int32)
+    order = np.lexsort((all_ids, all_codes))
+    all_codes = all_codes[order]
+    unique_codes, starts = np.unique(all_codes, return_index=True)
+    arrays["qgram_codes"] = unique_codes.astype(np.uint32)
+    arrays["qgram_offsets"] = np.append(starts, len(all_codes)).astype(np.int64)
+    arrays["qgram_seqs"] = all_ids[order]
+
+
+def qgram_candidates(seq: str, arrays: dict[str, np.ndarray]) -> np.ndarray | None:
+    """Return indexes of sequences which might contain the query as a substring.
+
+    Any sequence containing the query must contain all its q-grams, so returns
+    the sequences for the least common q-gram in the query. Returns None if
+    the query has no (unambiguous) q-grams, meaning all sequences are
+    candidates.
+    """
+    codes = qgram_codes(seq)
+    if not len(codes):
+        return None
+    table = arrays["qgram_codes"]
+    offsets = arrays["qgram_offsets"]
+    found = np.searchsorted(table, codes)
+    if found.max() >= len(table) or (table[found] != codes).any():
+        # At least one q-gram is not in any sequence
+        return np.zeros(0, dtype=np.int32)
+    counts = offsets[found + 1] - offsets[found]
+    best = found[np.argmin(counts)]
+    return arrays["qgram_seqs"][offsets[best] : offsets[best + 1]]
+
+
+def deletion_hashes(seq: str) -> np.ndarray:
+    """Return polynomial hashes of the sequence and all its 1bp deletions.
+
+    The first entry is the hash of the full sequence, followed by the hash of
+    the sequence with each base deleted in turn. Uses a polynomial hash with
+    position dependent weights, modulo 2**64 via unsigned integer overflow,
+    so that the deletion hashes can be computed without making the strings.
+
+    >>> hashes = deletion_hashes("ACGT").tolist()
+    >>> hashes[1:] == [deletion_hashes(_)[0] for _ in ("CGT", "AGT", "ACT", "ACG")]
+    True
+    >>> hashes[0] in hashes[1:]
+    False
+    """
+    weights = np.full(len(seq), HASH_BASE, dtype=np.uint64)
+    if len(seq):
+        weights[0] = 1
+    weights = np.cumprod(weights, dtype=np.uint64)
+    values = np.frombuffer(seq.encode("ascii"), dtype=np.uint8).astype(np.uint64)
+    prefix = np.concatenate(
+        (np.zeros(1, dtype=np.uint64), np.cumsum(values * weights, dtype=np.uint64))
+    )
+    total = prefix[-1:]
+    # Before the deletion weights are unchanged, after are shifted one place
+    deletions = prefix[:-1] + np.uint64(HASH_INVERSE) * (total - prefix[1:])
+    return np.concatenate((total, deletions))
+
+
+def add_deletion_index(arrays: dict[str, np.ndarray], seqs: list[str]) -> None:
+    """Add hash table of the sequences and their 1bp deletions, if not present.
+
+    This is a deletion neighbourhood index (as used in SymSpell), as a sorted
+    array of the hashes with a matching array of sequence indexes.
+    """
+    if "deletion_hashes" in arrays:
+        return
+    hashes = [deletion_hashes(seq) for seq in seqs]
+    all_hashes = np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64)
+    all_ids = np.repeat(
+        np.arange(len(seqs), dtype=np.int32), [len(_) for _ in hashes]
+    ).astype(np.int32)
+    order = np.lexsort((all_ids, all_hashes))
+    arrays["deletion_hashes"] = all_hashes[order]
+    arrays["deletion_seqs"] = all_ids[order]
+
+
+def deletion_candidates(seq: str, arrays: dict[str, np.ndarray]) -> np.ndarray:
+    """Return indexes of sequences which might be within 1bp of the query.
+
+    These share a hash for the full sequence or a 1bp deletion. A 1bp insertion
+    in the query matches the DB sequence, a 1bp deletion in the query matches a
+    DB sequence deletion, and a substitution shares a 1bp deletion with the DB
+    sequence (at the same position).
+    """
+    table = arrays["deletion_hashes"]
+    hashes = deletion_hashes(seq)
+    starts = np.searchsorted(table, hashes, side="left")
+    ends = np.searchsorted(table, hashes, side="right")
+    seq_ids = arrays["deletion_seqs"]
+    return np.unique(
+        np.concatenate(
+            [seq_ids[s:e] for s, e in zip(starts.tolist(), ends.tolist()) if s < e]
+            or [np.zeros(0, dtype=np.int32)]
+        )
+    )
+
+
+def build_index(
+    session, marker_name: str, db_md5: str = "", full: bool = False
+) -> tuple[dict, dict[str, np.ndarray]]:
+    """Load the marker sequences and taxonomy from the DB as index arrays.
+
+    Returns a header dict (for the JSON header), and a dict of NumPy arrays.
+    The header lists the distinct (genus, species, taxid) entries, and the
+    DB wide genus to NCBI taxid mapping. The arrays hold the concatenated
+    upper case sequences with their offsets, and the list of taxonomy
+    entries for each sequence again as offsets into a concatenated array.
+    Unless building the full index (for writing to disk), the q-gram and
+    deletion indexes are left to be added later if needed.
+    """
+    seq_tax: dict[str, set[tuple[str, str, int]]] = {
+        marker.sequence.upper(): set()
+        for marker in session.query(MarkerSeq.sequence)
+        .join(SeqSource)
+        .join(MarkerDef, SeqSource.marker_definition)
+        .filter(MarkerDef.name == marker_name)
+        .distinct()
+    }
+    for seq, genus, species, taxid in (
+        session.query(
+            MarkerSeq.sequence, Taxonomy.genus, Taxonomy.species, Taxonomy.ncbi_taxid
+        )
+        .join(SeqSource, SeqSource.marker_seq_id == MarkerSeq.id)
+        .join(Taxonomy, SeqSource.taxonomy_id == Taxonomy.id)
+        .join(MarkerDef, SeqSource.marker_definition)
+        .filter(MarkerDef.name == marker_name)
+        .distinct()
+    ):
+        seq_tax[seq.upper()].add((genus, species, taxid))
+    taxonomy = sorted(set().union(*seq_tax.values()))
+    tax_id = {entry: i for i, entry in enumerate(taxonomy)}
+    tax_ids = [sorted(tax_id[_] for _ in entries) for entries in seq_tax.values()]
+
+    seq_lengths = [len(_) for _ in seq_tax]
+    tax_counts = [len(_) for _ in tax_ids]
+    arrays: dict[str, np.ndarray] = {
+        "seq_data": np.frombuffer("".join(seq_tax).encode("ascii"), dtype=np.uint8),
+        "seq_offsets": np.concatenate(([0], np.cumsum(seq_lengths))).astype(np.int64),
+        "tax_ids": np.array([_ for ids in tax_ids for _ in ids], dtype=np.int32),
+        "tax_offsets": np.concatenate(([0], np.cumsum(tax_counts))).astype(np.int64),
+    }
+    header = {
+        "version": INDEX_VERSION,
+        "marker": marker_name,
+        "db_md5": db_md5,
+        "qgram": QGRAM,
+        "taxonomy": taxonomy,
+        "genus_taxid": {
+            _.genus: _.ncbi_taxid
+            for _ in session.query(Taxonomy)
+            .filter(Taxonomy.species == "")
+            .filter(Taxonomy.ncbi_taxid != 0)
+        },
+    }
+    if full:
+        seqs = list(seq_tax)
+        add_qgram_index(arrays, seqs)
+        add_deletion_index(arrays, seqs)
+    return header, arrays
+
+
+def index_seqs(arrays: dict[str, np.ndarray]) -> list[str]:
+    """Return list of the sequences in the index arrays."""
+    data = arrays["seq_data"].tobytes().decode("ascii")
+    offsets = arrays["seq_offsets"].tolist()
+    return [data[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def index_taxonomy(
+    header: dict, arrays: dict[str, np.ndarray]
+) -> list[list[tuple[str, str, int]]]:
+    """Return list of the taxonomy entries for each sequence in the index."""
+    taxonomy = [(g, s, t) for g, s, t in header["taxonomy"]]
+    tax_ids = arrays["tax_ids"].tolist()
+    offsets = arrays["tax_offsets"].tolist()
+    return [
+        [taxonomy[_] for _ in tax_ids[start:end]]
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+
+
+def write_index(filename: str, header: dict, arrays: dict[str, np.ndarray]) -> None:
+    """Write index file, via a temporary file so safe with concurrent readers."""
+    layout: dict[str, tuple[str, int, int]] = {}
+    offset = 0
+    for name, values in arrays.items():
+        layout[name] = (values.dtype.str, offset, len(values))
+        offset += -(-values.nbytes // INDEX_ALIGN) * INDEX_ALIGN
+    json_bytes = json.dumps(dict(header, arrays=layout)).encode("ascii")
+    start = len(INDEX_MAGIC) + 8 + len(json_bytes)
+    start = -(-start // INDEX_ALIGN) * INDEX_ALIGN
+    folder = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile("wb", dir=folder, delete=False) as handle:
+        handle.write(INDEX_MAGIC)
+        handle.write(len(json_bytes).to_bytes(8, "little"))
+        handle.write(json_bytes)
+        for name, values in arrays.items():
+            handle.seek(start + layout[name][1])
+            handle.write(np.ascontiguousarray(values).tobytes())
+        handle.truncate(start + offset)
+    # Temporary files are private, but want the usual permissions
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(handle.name, 0o666 & ~umask)
+    os.replace(handle.name, filename)
+
+
+def read_index(filename: str) -> tuple[dict, dict[str, np.ndarray]]:
+    """Read index file header, and memory map the arrays.
+
+    Raises a ValueError if not an index file or not the current version.
+    """
+    with open(filename, "rb") as handle:
+        if handle.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            msg = f"{filename} is not a THAPBI PICT index file"
+            raise ValueError(msg)
+        json_len = int.from_bytes(handle.read(8), "little")
+        header = json.loads(handle.read(json_len))
+    if header.get("version") != INDEX_VERSION:
+        msg = f"{filename} is index version {header.get('version')}"
+        raise ValueError(msg)
+    start = len(INDEX_MAGIC) + 8 + json_len
+    start = -(-start // INDEX_ALIGN) * INDEX_ALIGN
+    arrays = {
+        name: (
+            np.memmap(
+                filename, dtype=dtype, mode="r", offset=start + offset, shape=(length,)
+            )
+            if length
+            else np.zeros(0, dtype=dtype)
+        )
+        for name, (dtype, offset, length) in header.pop("arrays").items()
+    }
+    return header, arrays
+
+
+def load_index(
+    session, marker_name: str, debug: bool = False
+) -> tuple[dict, dict[str, np.ndarray]]:
+    """Load the marker index from file if fresh, otherwise build it from the DB.
+
+    If there is an index file but it is stale (the DB has changed, or it is
+    from an older version of this tool), it is rebuilt and replaced.
+    """
+    db_file = db_filename(session)
+    if db_file:
+        filename = index_filename(db_file, marker_name)
+        if os.path.isfile(filename):
+            db_md5 = md5_hexdigest(db_file, chunk_size=2**20)
+            try:
+                header, arrays = read_index(filename)
+            except ValueError as err:
+                sys.stderr.write(f"WARNING: Rebuilding index as {err}\n")
+            else:
+                if header["db_md5"] == db_md5 and header["marker"] == marker_name:
+                    if debug:
+                        sys.stderr.write(f"DEBUG: Loaded index {filename}\n")
+                    return header, arrays
+                sys.stderr.write(f"WARNING: Rebuilding stale index {filename}\n")
+            header, arrays = build_index(session, marker_name, db_md5, full=True)
+            try:
+                write_index(filename, header, arrays)
+            except OSError as err:
+                sys.stderr.write(f"WARNING: Could not update index: {err}\n")
+            return header, arrays
+    return build_index(session, marker_name)
+
+
+def main(db_url: str, markers: list[str], debug: bool = False) -> int:
+    """Implement the ``thapbi_pict index`` subcommand.
+
+    Writes an index file for each marker next to the SQLite database.
+    """
+    session = connect_to_db(db_url)
+    db_file = db_filename(session)
+    if not db_file:
+        sys.exit("ERROR: Can only index an SQLite database file.")
+    db_md5 = md5_hexdigest(db_file, chunk_size=2**20)
+    for marker_name in markers:
+        header, arrays = build_index(session, marker_name, db_md5, full=True)
+        filename = index_filename(db_file, marker_name)
+        write_index(filename, header, arrays)
+        sys.stderr.write(
+            f"Wrote {marker_name} index of {len(arrays['seq_offsets']) - 1}"
+            f" sequences to {filename}\n"
+        )
+        if debug:
+            for name, values in arrays.items():
+                sys.stderr.write(f"DEBUG: {name} array of {len(values)} values\n")
+    session.close()
+    return 0
@@ -0,0 +1,137 @@
+# Copyright 2026 by Peter Cock, University of Strathclyde.
+# All rights reserved.
+# This file is part of the THAPBI Phytophthora ITS1 Classifier Tool (PICT),
+# and is released under the "MIT License Agreement". Please see the LICENSE
+# file that should have been included as part of this package.
+"""Content addressed cache of overlap merged reads.
+
+Merging the read pairs is usually the slowest step in ``prepare-reads``, so
+the ``--merged-cache`` option keeps each sample's non-redundant merged reads
+as a gzipped FASTA file. These are named after a checksum of the two input
+FASTQ files' MD5 checksums and the merging tool version, so re-delivered
+FASTQ files are not confused with the old ones, and the same cache can be
+shared between projects using the same raw data.
+
+A small SQLite manifest in the cache folder records the inputs for each
+file, its size and when it was last used. When over a maximum total size,
+the least recently used files are deleted (except for those used recently,
+which might be in use by a concurrent run).
+
+>>> key = merged_key(
+...     "2e02cc3bc1bf1e6c3bd4cf1ca5a1fa83",
+...     "c0de0b71e9c5c2ba1a7ba3d9d3d5c1e4",
+...     "flash 1.2.11",
+... )
+>>> key
+'2f04b71de572d9d046c2d58f81f355f5'
+>>> cache = open_merged_cache(":memory:")
+>>> record_merged(
+...     cache,
+...     key,
+...     "S1_R1.fastq.gz",
+...     "S1_R2.fastq.gz",
+...     "2e02cc3bc1bf1e6c3bd4cf1ca5a1fa83",
+...     "c0de0b71e9c5c2ba1a7ba3d9d3d5c1e4",
+...     "flash 1.2.11",
+...     12345,
+... )
+>>> cache.execute("SELECT r1, size FROM merged").fetchall()
+[('S1_R1.fastq.gz', 12345)]
+>>> cache.close()
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import time
+
+MANIFEST = "manifest.sqlite"  # within the cache folder
+DEF_EVICT_GRACE = 60 * 60  # seconds, files used this recently are kept
+
+
+def merged_key(md5_R1: str, md5_R2: str, merger: str) -> str:
+    """Return the cache key for a pair of FASTQ files and merger version."""
+    return hashlib.md5(f"{md5_R1}\t{md5_R2}\t{merger}".encode()).hexdigest()
+
+
+def merged_filename(cache_dir: str, key: str) -> str:
+    """Return the cached merged FASTA filename for the given key."""
+    return os.path.join(cache_dir, f"{key}.fasta.gz")
+
+
+def open_merged_cache(filename: str) -> sqlite3.Connection:
+    """Open (and if required create) the merged read cache manifest.
+
+    Uses a generous timeout as the cache may be shared by concurrent jobs.
+    """
+    cache = sqlite3.connect(filename, timeout=600)
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS merged ("
+        "key TEXT PRIMARY KEY, r1 TEXT, r2 TEXT, r1_md5 TEXT, r2_md5 TEXT, "
+        "merger TEXT, size INTEGER, last_used INTEGER)"
+    )
+    cache.execute("CREATE INDEX IF NOT EXISTS merged_last_used ON merged (last_used)")
+    cache.commit()
+    return cache
+
+
+def record_merged(
+    cache: sqlite3.Connection,
+    key: str,
+    raw_R1: str,
+    raw_R2: str,
+    md5_R1: str,
+    md5_R2: str,
+    merger: str,
+    size: int,
+) -> None:
+    """Add or refresh the manifest entry for a merged FASTA file."""
+    cache.execute(
+        "INSERT OR REPLACE INTO merged VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            key,
+            os.path.basename(raw_R1),
+            os.path.basename(raw_R2),
+            md5_R1,
+            md5_R2,
+            merger,
+            size,
+            int(time.time()),
+        ),
+    )
+    cache.commit()
+
+
+def evict_merged(
+    cache_dir: str,
+    cache: sqlite3.Connection,
+    max_size: int,
+    grace: int = DEF_EVICT_GRACE,
+) -> tuple[int, int]:
+    """Delete the least recently used merged files if the cache is too big.
+
+    The maximum size is in bytes. Files used within the grace period (in
+    seconds) are not deleted, even if this leaves the cache over the limit.
+
+    Returns the number of files deleted, and their total size.
+    """
+    total: int = cache.execute("SELECT SUM(size) FROM merged").fetchone()[0] or 0
+    count = freed = 0
+    for key, size in cache.execute(
+        "SELECT key, size FROM merged WHERE last_used < ? ORDER BY last_used",
+        (int(time.time()) - grace,),
+    ).fetchall():
+        if total - freed <= max_size:
+            break
+        try:
+            os.remove(merged_filename(cache_dir, key))
+        except FileNotFoundError:
+            # Perhaps deleted by a concurrent job
+            pass
+        cache.execute("DELETE FROM merged WHERE key = ?", (key,))
+        count += 1
+        freed += size
+    cache.commit()
+    return count, freed
@@ -0,0 +1,400 @@
+# Copyright 2026 by Peter Cock, University of Strathclyde.
+# All rights reserved.
+# This file is part of the THAPBI Phytophthora ITS1 Classifier Tool (PICT),
+# and is released under the "MIT License Agreement". Please see the LICENSE
+# file that should have been included as part of this package.
+"""Overlap merging of paired reads in Python, as an alternative to FLASH.
+
+This reimplements the FLASH v1.2.11 algorithm (Magoc and Salzberg 2011) as
+called by ``prepare-reads``, that is ``flash -O -M 300`` with the other
+settings left at their defaults. It is used with ``--merger in-process``.
+
+For each pair, read two is reverse complemented and every offset giving at
+least the minimum overlap (ignoring any uncalled bases) is scored by the
+mismatch density, the number of mismatches divided by the overlap length
+(capped at the maximum overlap). Ties are broken by the mean quality of the
+mismatched bases, and then by taking the longer overlap. Allowing "outies"
+means also trying the reads the other way round, with the start of read two
+before read one, which is only used if strictly better. The best overlap is
+accepted if its mismatch density is at most one in four. At mismatches the
+merged sequence takes the higher quality base (from read two if equal), or
+the called base if the other is an N.
+
+Rather than comparing the reads letter by letter, each batch of read pairs
+is packed into bit arrays using NumPy, so that all the pairs are scored at
+each offset at once using bitwise operations.
+
+>>> merge_read_pair(
+...     "ACGTTAGCAAGGCTTAACCGGTTAC", "I" * 25, "GTTAGCGAATTAGCGTAACCGGTTA", "I" * 25
+... )
+'ACGTTAGCAAGGCTTAACCGGTTACGCTAATTCGCTAAC'
+
+Here the first read and the reverse complement of the second read overlap
+by eleven bases. Unrelated reads are not merged:
+
+>>> print(
+...     merge_read_pair(
+...         "ACGTTAGCAAGGCTTAACCGGTTAC", "I" * 25, "TTTTTTTTTTTTTTTTTTTTTTTTT", "I" * 25
+...     )
+... )
+None
+"""
+
+from __future__ import annotations
+
+import gzip
+import sys
+from collections import Counter
+from itertools import islice
+
+import numpy as np
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+
+DEF_MIN_OVERLAP = 10  # as in FLASH
+DEF_MAX_OVERLAP = 300  # our reads tend to overlap a lot, as flash -M 300
+DEF_MAX_MISMATCH_DENSITY = 0.25  # as in FLASH
+DEF_BATCH_SIZE = 10000  # read pairs
+
+_N = 4  # code for uncalled bases
+_PAD = 5  # code for beyond the end of a read
+_CODES = np.full(256, _N, np.uint8)
+for _code, _letter in enumerate("ACGT"):
+    _CODES[ord(_letter)] = _CODES[ord(_letter.lower())] = _code
+_COMPLEMENT = np.array([3, 2, 1, 0, _N, _PAD], np.uint8)
+_LETTERS = np.frombuffer(b"ACGTN-", np.uint8)
+
+
+def _encode(
+    reads: list[tuple[str, str]], width: int, reverse_complement: bool = False
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return padded base codes, Phred scores, and lengths for reads."""
+    lengths = np.fromiter((len(seq) for seq, _ in reads), np.int64, len(reads))
+    in_read = np.arange(width) < lengths[:, None]
+    codes = np.full((len(reads), width), _PAD, np.uint8)
+    quals = np.zeros((len(reads), width), np.int16)
+    codes[in_read] = _CODES[
+        np.frombuffer("".join(seq for seq, _ in reads).encode("ascii"), np.uint8)
+    ]
+    quals[in_read] = (
+        np.frombuffer("".join(qual for _, qual in reads).encode("ascii"), np.uint8) - 33
+    )
+    if reverse_complement:
+        index = np.maximum(lengths[:, None] - 1 - np.arange(width), 0)
+        codes = np.where(
+            in_read, _COMPLEMENT[np.take_along_axis(codes, index, 1)], _PAD
+        ).astype(np.uint8)
+        quals = np.where(in_read, np.take_along_axis(quals, index, 1), 0).astype(
+            np.int16
+        )
+    return codes, quals, lengths
+
+
+def _pack(bits: np.ndarray, words: int) -> np.ndarray:
+    """Pack rows of booleans into 64-bit words, first position as lowest bit."""
+    packed = np.zeros((bits.shape[0], words * 8), np.uint8)
+    tmp = np.packbits(bits, axis=1, bitorder="little")
+    packed[:, : tmp.shape[1]] = tmp
+    return packed.view("<u8")
+
+
+def _bit_planes(codes: np.ndarray, words: int) -> tuple[np.ndarray, ...]:
+    """Pack base codes as called flag, high bit and low bit arrays."""
+    return (
+        _pack(codes < _N, words),
+        _pack((codes & 2).astype(bool), words),
+        _pack((codes & 1).astype(bool), words),
+    )
+
+
+def _drop(words: np.ndarray, count: int) -> np.ndarray:
+    """Shift packed bits down, dropping the given number of positions."""
+    skip, bits = divmod(count, 64)
+    answer = np.zeros_like(words)
+    keep = words.shape[1] - skip
+    if keep > 0:
+        if bits:
+            answer[:, :keep] = words[:, skip:] >> np.uint64(bits)
+            answer[:, : keep - 1] |= words[:, skip + 1 :] << np.uint64(64 - bits)
+        else:
+            answer[:, :keep] = words[:, skip:]
+    return answer
+
+
+def _popcount(words: np.ndarray) -> np.ndarray:
+    """Count the set bits in each row of packed bits."""
+    counts: np.ndarray
+    if hasattr(np, "bitwise_count"):
+        # NumPy 2.0 onwards
+        counts = np.bitwise_count(words).sum(axis=1, dtype=np.int64)
+    else:
+        counts = np.unpackbits(words.view(np.uint8), axis=1).sum(axis=1, dtype=np.int64)
+    return counts
+
+
+def _densities(
+    left_planes: tuple[np.ndarray, ...],
+    left_lengths: np.ndarray,
+    right_planes: tuple[np.ndarray, ...],
+    right_lengths: np.ndarray,
+    width: int,
+    min_overlap: int,
+    max_overlap: int,
+) -> np.ndarray:
+    """Score placing the right reads at each offset from start of the left reads.
+
+    Returns a two dimensional array of the mismatch density for each offset
+    and read pair, with infinity for offsets which are not allowed. This
+    requires at least the minimum overlap of called bases, and that the
+    right read is not contained within the left read.
+    """
+    right_called, right_high, right_low = right_planes
+    answer = np.full(
+        (max(0, width - min_overlap + 1), len(left_lengths)), np.inf, np.float32
+    )
+    for offset in range(answer.shape[0]):
+        left_called, left_high, left_low = (_drop(_, offset) for _ in left_planes)
+        called = left_called & right_called
+        overlap = _popcount(called)
+        mismatches = _popcount(
+            ((left_high ^ right_high) | (left_low ^ right_low)) & called
+        )
+        ok = (
+            (left_lengths - right_lengths <= offset)
+            & (offset <= left_lengths - min_overlap)
+            & (min_overlap <= overlap)
+        )
+        answer[offset, ok] = mismatches[ok].astype(np.float32) / np.minimum(
+            overlap[ok], max_overlap
+        ).astype(np.float32)
+    return answer
+
+
+def _mismatch_quality(
+    left_codes: np.ndarray,
+    left_quals: np.ndarray,
+    right_codes: np.ndarray,
+    right_quals: np.ndarray,
+    offset: int,
+    max_overlap: int,
+) -> np.float32:
+    """Score placing a right read at an offset by the quality of the mismatches.
+
+    This is the total of the lower Phred score at each mismatch, divided by
+    the (capped) overlap length, as used to break ties on mismatch density.
+    """
+    left_codes = left_codes[offset:]
+    left_quals = left_quals[offset:]
+    right_codes = right_codes[: len(left_codes)]
+    right_quals = right_quals[: len(left_codes)]
+    called = (left_codes < _N) & (right_codes < _N)
+    mismatches = called & (left_codes != right_codes)
+    return np.float32(
+        np.minimum(left_quals, right_quals)[mismatches].sum()
+    ) / np.float32(min(int(called.sum()), max_overlap))
+
+
+def _combine(
+    left_codes: np.ndarray,
+    left_quals: np.ndarray,
+    left_lengths: np.ndarray,
+    right_codes: np.ndarray,
+    right_quals: np.ndarray,
+    right_lengths: np.ndarray,
+    offsets: np.ndarray,
+) -> list[str]:
+    """Build the merged sequences with the right reads at the given offsets."""
+    lengths = offsets + right_lengths
+    positions = np.arange(int(lengths.max()))
+    in_left = positions < left_lengths[:, None]
+    index = np.minimum(positions, left_codes.shape[1] - 1)
+    left = np.where(in_left, left_codes[:, index], _PAD)
+    left_q = np.where(in_left, left_quals[:, index], 0)
+    index = positions - offsets[:, None]
+    in_right = (0 <= index) & (index < right_lengths[:, None])
+    index = np.clip(index, 0, right_codes.shape[1] - 1)
+    right = np.where(in_right, np.take_along_axis(right_codes, index, 1), _PAD)
+    right_q = np.where(in_right, np.take_along_axis(right_quals, index, 1), 0)
+    consensus = np.where(
+        left == right,
+        left,
+        np.where(
+            left == _N,
+            right,
+            np.where(right == _N, left, np.where(left_q > right_q, left, right)),
+        ),
+    )
+    merged = _LETTERS[np.where(in_left & in_right, consensus, np.minimum(left, right))]
+    return [
+        row[:length].tobytes().decode("ascii") for row, length in zip(merged, lengths)
+    ]
+
+
+def merge_batch(
+    reads_R1: list[tuple[str, str]],
+    reads_R2: list[tuple[str, str]],
+    min_overlap: int = DEF_MIN_OVERLAP,
+    max_overlap: int = DEF_MAX_OVERLAP,
+    max_mismatch_density: float = DEF_MAX_MISMATCH_DENSITY,
+    allow_outies: bool = True,
+) -> list[str | None]:
+    """Overlap merge a batch of read pairs given as (sequence, quality) tuples.
+
+    The quality strings should be in the Sanger FASTQ encoding. Returns a
+    list of the merged sequences, or None for pairs which did not merge.
+    """
+    assert len(reads_R1) == len(reads_R2)
+    if not reads_R1:
+        return []
+    width = max(len(seq) for seq, _ in reads_R1 + reads_R2)
+    words = (width + 63) // 64
+    codes_1, quals_1, lengths_1 = _encode(reads_R1, width)
+    codes_2, quals_2, lengths_2 = _encode(reads_R2, width, reverse_complement=True)
+    planes_1 = _bit_planes(codes_1, words)
+    planes_2 = _bit_planes(codes_2, words)
+    # Innie offsets, and optionally outie offsets (reads the other way round):
+    densities = _densities(
+        planes_1, lengths_1, planes_2, lengths_2, width, min_overlap, max_overlap
+    )
+    innie_count = densities.shape[0]
+    if allow_outies:
+        densities = np.concatenate(
+            [
+                densities,
+                _densities(
+                    planes_2,
+                    lengths_2,
+                    planes_1,
+                    lengths_1,
+                    width,
+                    min_overlap,
+                    max_overlap,
+                ),
+            ]
+        )
+    best = densities.min(axis=0)
+    tied = densities == best
+    choice = tied.argmax(axis=0)  # first best offset, so innie and longer overlap
+    merged = best <= np.float32(max_mismatch_density)
+    for row in np.nonzero(merged & (tied.sum(axis=0) > 1))[0]:
+        # Break ties on the mismatch quality, rare but can happen
+        candidates = np.nonzero(tied[:, row])[0].tolist()
+        scores = [
+            _mismatch_quality(
+                codes_1[row], quals_1[row], codes_2[row], quals_2[row], c, max_overlap
+            )
+            if c < innie_count
+            else _mismatch_quality(
+                codes_2[row],
+                quals_2[row],
+                codes_1[row],
+                quals_1[row],
+                c - innie_count,
+                max_overlap,
+            )
+            for c in candidates
+        ]
+        choice[row] = candidates[int(np.argmin(scores))]
+
+    answer: list[str | None] = [None] * len(reads_R1)
+    innie = merged & (choice < innie_count)
+    if innie.any():
+        for row, seq in zip(
+            np.nonzero(innie)[0],
+            _combine(
+                codes_1[innie],
+                quals_1[innie],
+                lengths_1[innie],
+                codes_2[innie],
+                quals_2[innie],
+                lengths_2[innie],
+                choice[innie],
+            ),
+        ):
+            answer[row] = seq
+    outie = merged & (choice >= innie_count)
+    if outie.any():
+        for row, seq in zip(
+            np.nonzero(outie)[0],
+            _combine(
+                codes_2[outie],
+                quals_2[outie],
+                lengths_2[outie],
+                codes_1[outie],
+                quals_1[outie],
+                lengths_1[outie],
+                choice[outie] - innie_count,
+            ),
+        ):
+            answer[row] = seq
+    return answer
+
+
+def merge_read_pair(
+    seq_R1: str,
+    qual_R1: str,
+    seq_R2: str,
+    qual_R2: str,
+    min_overlap: int = DEF_MIN_OVERLAP,
+    max_overlap: int = DEF_MAX_OVERLAP,
+    max_mismatch_density: float = DEF_MAX_MISMATCH_DENSITY,
+    allow_outies: bool = True,
+) -> str | None:
+    """Overlap merge a single read pair, returns sequence or None."""
+    return merge_batch(
+        [(seq_R1, qual_R1)],
+        [(seq_R2, qual_R2)],
+        min_overlap,
+        max_overlap,
+        max_mismatch_density,
+        allow_outies,
+    )[0]
+
+
+def merge_fastq_pairs(
+    raw_R1: str,
+    raw_R2: str,
+    min_overlap: int = DEF_MIN_OVERLAP,
+    max_overlap: int = DEF_MAX_OVERLAP,
+    max_mismatch_density: float = DEF_MAX_MISMATCH_DENSITY,
+    allow_outies: bool = True,
+    batch_size: int = DEF_BATCH_SIZE,
+) -> tuple[int, int, dict[str, int]]:
+    """Overlap merge a pair of FASTQ files, tallying the merged reads.
+
+    The FASTQ files may be gzip compressed, and are read in batches.
+
+    Returns two integers, FASTQ pair count for input and output, and a
+    dictionary of the merged sequences and their counts.
+    """
+    count_raw = count_merged = 0
+    counts: dict[str, int] = Counter()
+    with (
+        (
+            gzip.open(raw_R1, "rt") if raw_R1.endswith(".gz") else open(raw_R1)
+        ) as handle_R1,
+        (
+            gzip.open(raw_R2, "rt") if raw_R2.endswith(".gz") else open(raw_R2)
+        ) as handle_R2,
+    ):
+        iter_R1 = ((seq, qual) for _, seq, qual in FastqGeneralIterator(handle_R1))
+        iter_R2 = ((seq, qual) for _, seq, qual in FastqGeneralIterator(handle_R2))
+        while True:
+            batch_R1 = list(islice(iter_R1, batch_size))
+            batch_R2 = list(islice(iter_R2, batch_size))
+            if len(batch_R1) != len(batch_R2):
+                sys.exit(f"ERROR: Different number of reads in {raw_R1} and {raw_R2}")
+            if not batch_R1:
+                break
+            count_raw += len(batch_R1)
+            for seq in merge_batch(
+                batch_R1,
+                batch_R2,
+                min_overlap,
+                max_overlap,
+                max_mismatch_density,
+                allow_outies,
+            ):
+                if seq is not None:
+                    counts[seq.upper()] += 1
+                    count_merged += 1
+    return count_raw, count_merged, counts
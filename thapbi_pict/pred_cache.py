@@ -0,0 +1,123 @@
+# Copyright 2026 by Peter Cock, University of Strathclyde.
+# All rights reserved.
+# This file is part of the THAPBI Phytophthora ITS1 Classifier Tool (PICT),
+# and is released under the "MIT License Agreement". Please see the LICENSE
+# file that should have been included as part of this package.
+"""Persistent cache of classifier predictions between runs.
+
+The same sequences (ASVs) recur between sequencing runs, so the ``classify``
+and ``pipeline`` commands can optionally store each prediction in a small
+SQLite file, and reuse it next time rather than reclassifying the sequence.
+Entries are keyed on the checksum of the marker database file, the marker,
+the classifier method, and the sequence MD5 checksum. When over the maximum
+size, the least recently used entries are deleted.
+
+>>> cache = open_pred_cache(":memory:")
+>>> store_predictions(cache, "db", "ITS1", "identity", {"abc": ("4783", "X y", "")})
+>>> lookup_predictions(cache, "db", "ITS1", "identity", ["abc", "def"])
+{'abc': ('4783', 'X y', '')}
+>>> lookup_predictions(cache, "db", "ITS1", "onebp", ["abc", "def"])
+{}
+>>> cache.close()
+"""
+
+from __future__ import annotations
+
+import sqlite3
+import time
+from collections.abc import Iterable
+
+DEF_PRED_CACHE_SIZE = 1000000  # maximum number of cached predictions
+SQL_BATCH = 500  # number of values per SQL IN clause, under SQLite's limit
+
+
+def open_pred_cache(filename: str) -> sqlite3.Connection:
+    """Open (and if required create) the prediction cache SQLite file.
+
+    Uses a generous timeout as the cache may be shared by concurrent jobs.
+    """
+    cache = sqlite3.connect(filename, timeout=600)
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS predictions ("
+        "db_md5 TEXT, marker TEXT, method TEXT, md5 TEXT, "
+        "taxid TEXT, genus_species TEXT, note TEXT, last_used INTEGER, "
+        "PRIMARY KEY (db_md5, marker, method, md5)) WITHOUT ROWID"
+    )
+    cache.execute(
+        "CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)"
+    )
+    cache.commit()
+    return cache
+
+
+def lookup_predictions(
+    cache: sqlite3.Connection,
+    db_md5: str,
+    marker_name: str,
+    method: str,
+    md5_list: Iterable[str],
+) -> dict[str, tuple[str, str, str]]:
+    """Return dict of MD5 to cached (taxid, genus-species, note) predictions.
+
+    Updates the last used time stamp of any entries found.
+    """
+    md5_list = list(md5_list)
+    answer: dict[str, tuple[str, str, str]] = {}
+    for i in range(0, len(md5_list), SQL_BATCH):
+        batch = md5_list[i : i + SQL_BATCH]
+        answer.update(
+            (md5, (taxid, genus_species, note))
+            for md5, taxid, genus_species, note in cache.execute(
+                "SELECT md5, taxid, genus_species, note FROM predictions "
+                "WHERE db_md5 = ? AND marker = ? AND method = ? "
+                f"AND md5 IN ({', '.join('?' * len(batch))})",
+                (db_md5, marker_name, method, *batch),
+            )
+        )
+    now = int(time.time())
+    cache.executemany(
+        "UPDATE predictions SET last_used = ? "
+        "WHERE db_md5 = ? AND marker = ? AND method = ? AND md5 = ?",
+        ((now, db_md5, marker_name, method, md5) for md5 in answer),
+    )
+    cache.commit()
+    return answer
+
+
+def store_predictions(
+    cache: sqlite3.Connection,
+    db_md5: str,
+    marker_name: str,
+    method: str,
+    predictions: dict[str, tuple[str, str, str]],
+) -> None:
+    """Add dict of MD5 to (taxid, genus-species, note) predictions to the cache."""
+    now = int(time.time())
+    cache.executemany(
+        "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            (db_md5, marker_name, method, md5, taxid, genus_species, note, now)
+            for md5, (taxid, genus_species, note) in predictions.items()
+        ),
+    )
+    cache.commit()
+
+
+def evict_predictions(
+    cache: sqlite3.Connection, max_size: int = DEF_PRED_CACHE_SIZE
+) -> int:
+    """Delete the least recently used predictions if the cache is too big.
+
+    Returns the number of entries deleted.
+    """
+    count: int = cache.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+    if count <= max_size:
+        return 0
+    cache.execute(
+        "DELETE FROM predictions WHERE (db_md5, marker, method, md5) IN ("
+        "SELECT db_md5, marker, method, md5 FROM predictions "
+        "ORDER BY last_used LIMIT ?)",
+        (count - max_size,),
+    )
+    cache.commit()
+    return count - max_size
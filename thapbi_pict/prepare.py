@@ -14,9 +14,17 @@ from __future__ import annotations
 import gzip
 import os
 import shutil
+import subprocess
 import sys
 import tempfile
 from collections import Counter
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from itertools import repeat
 from math import ceil
 from time import time
 from typing import Any
@@ -28,18 +36,29 @@ from sqlalchemy import func
 from sqlalchemy.orm import aliased
 from sqlalchemy.orm import contains_eager
 
+from . import __version__
 from .db_orm import MarkerDef
 from .db_orm import MarkerSeq
 from .db_orm import SeqSource
 from .db_orm import Taxonomy
+from .merged_cache import evict_merged
+from .merged_cache import MANIFEST
+from .merged_cache import merged_filename
+from .merged_cache import merged_key
+from .merged_cache import open_merged_cache
+from .merged_cache import record_merged
+from .overlap_merge import merge_fastq_pairs
 from .utils import abundance_from_read_name
-from .utils import abundance_values_in_fasta
+from .utils import cmd_as_string
 from .utils import kmers
 from .utils import load_fasta_header
+from .utils import md5_from_sidecars
+from .utils import md5_hexdigest
 from .utils import md5seq
 from .utils import primer_clean
 from .utils import run
 from .versions import check_tools
+from .versions import version_flash
 
 
 def find_fastq_pairs(
@@ -254,6 +273,104 @@ def run_cutadapt(
     return parse_cutadapt_stdout(run(cmd, debug=debug).stdout)
 
 
+def load_trimmed_counts(trimmed_fasta: str) -> dict[str, int]:
+    r"""Load primer trimmed FASTA file from cutadapt as dict of sequence counts.
+
+    Expects the reads to follow ``>identifier_abundance\n`` naming (with an
+    optional `` rc`` suffix if reverse complemented), and uses the abundance.
+    """
+    if not os.path.isfile(trimmed_fasta):
+        sys.exit(f"ERROR: Expected file {trimmed_fasta!r} from cutadapt\n")
+    counts: dict[str, int] = Counter()
+    with open(trimmed_fasta) as handle:
+        for title, seq in SimpleFastaParser(handle):
+            assert title.count(" ") == 0 or (
+                title.count(" ") == 1 and title.endswith(" rc")
+            ), title
+            assert title.count("_") == 1 and title[32] == "_", title
+            counts[seq.upper()] += abundance_from_read_name(title.split(None, 1)[0])
+    return counts
+
+
+def trim_merged_reads(
+    merged_fasta_gz: str,
+    marker_definitions: dict[str, Any],
+    flip: bool = False,
+) -> tuple[int, dict[str, dict[str, int]]]:
+    """Primer trim merged reads in memory, giving sequence counts per marker.
+
+    This is an in-process alternative to ``run_cutadapt`` which works on the
+    non-redundant merged reads (named ``>MD5_abundance``), applying the primer
+    matching from the cutadapt library with the same settings as the command
+    line (including IUPAC ambiguity codes in the primers, and the reverse
+    complement search if flip=True). Each unique sequence is matched once,
+    and its abundance added to the counts for the best matching marker.
+
+    Returns the number of unique merged reads, and a dict of dicts of the
+    trimmed sequences and their total abundance, keyed by marker name.
+    """
+    from cutadapt.info import ModificationInfo
+    from cutadapt.modifiers import AdapterCutter
+    from cutadapt.modifiers import ReverseComplementer
+    from cutadapt.parser import make_adapters_from_specifications
+    from dnaio import SequenceRecord
+
+    # Currently at least, cannot set these at the adapter level...
+    min_len = min(_["min_length"] for _ in marker_definitions.values())
+    max_len = max(_["max_length"] for _ in marker_definitions.values())
+
+    specs = []
+    for marker, values in sorted(marker_definitions.items()):
+        left_primer = primer_clean(values["left_primer"])
+        right_primer = primer_clean(values["right_primer"])
+        if not left_primer or not right_primer:
+            sys.exit(f"ERROR: Missing primer(s) for marker {marker}")
+        # Equivalent to the cutadapt command line -g LEFT...RIGHT as used in
+        # run_cutadapt, non-anchored linked adapters:
+        specs.append(
+            (
+                "front",
+                f"{marker}={left_primer};o={len(left_primer)}..."
+                f"{reverse_complement(right_primer)};o={len(right_primer)}",
+            )
+        )
+    # These are the cutadapt command line defaults:
+    adapters = make_adapters_from_specifications(
+        specs,
+        {
+            "max_errors": 0.1,
+            "min_overlap": 3,
+            "read_wildcards": False,
+            "adapter_wildcards": True,
+            "indels": True,
+        },
+    )
+    trimmer = AdapterCutter(adapters, times=1, action="trim")
+    if flip:
+        trimmer = ReverseComplementer(trimmer)
+
+    unique = 0
+    counts: dict[str, dict[str, int]] = {_: Counter() for _ in marker_definitions}
+    with gzip.open(merged_fasta_gz, "rt") as handle:
+        for title, seq in SimpleFastaParser(handle):
+            unique += 1
+            read = SequenceRecord(title, seq)
+            info = ModificationInfo(read)
+            trimmed = trimmer(read, info).sequence
+            if not info.matches:
+                # Like cutadapt --discard-untrimmed
+                continue
+            if (min_len and len(trimmed) < min_len) or (
+                max_len and len(trimmed) > max_len
+            ):
+                continue
+            # Like cutadapt demultiplexing via {name} in the output filename
+            counts[info.matches[-1].adapter.name][trimmed.upper()] += (
+                abundance_from_read_name(title.split(None, 1)[0])
+            )
+    return unique, counts
+
+
 def parse_flash_stdout(stdout: str) -> tuple[int, int]:
     r"""Extract FASTQ pair count before/after running flash.
 
@@ -292,26 +409,56 @@ assert parse_flash_stdout(
 ) == (6105, 5869)
 
 
-def run_flash(
+def stream_flash(
     trimmed_R1: str,
     trimmed_R2: str,
-    output_dir: str,
-    output_prefix: str,
     debug: bool = False,
     cpu: int = 0,
-) -> tuple[int, int]:
-    """Run FLASH on a pair of trimmed FASTQ files to merge overlapping pairs.
+) -> tuple[int, int, dict[str, int]]:
+    """Run FLASH on a pair of FASTQ files, tallying the merged reads.
+
+    Rather than having FLASH write its merged reads to a temporary FASTQ file
+    which is then re-read, uses ``--to-stdout`` and counts the sequences as
+    they arrive through the pipe. In this mode FLASH discards the unmerged
+    pairs, and writes its summary to stderr instead (which goes to an
+    anonymous temporary file to avoid the pipes blocking).
 
-    Returns two integers, FASTQ pair count for input and output files.
+    Returns two integers, FASTQ pair count for input and output files, and
+    a dictionary of the merged sequences and their counts.
     """
     # Note our reads tend to overlap a lot, thus increase max overlap with -M
     # Also, some of our samples are mostly 'outies' rather than 'innies', so -O
-    cmd = ["flash", "-O", "-M", "300"]
+    cmd = ["flash", "-O", "-M", "300", "--to-stdout"]
     if cpu:
         # Default is all CPUs
         cmd += ["-t", str(cpu)]
-    cmd += ["-d", output_dir, "-o", output_prefix, trimmed_R1, trimmed_R2]
-    return parse_flash_stdout(run(cmd, debug=debug).stdout)
+    cmd += [trimmed_R1, trimmed_R2]
+    if debug:
+        sys.stderr.write(f"Calling command: {cmd_as_string(cmd)}\n")
+    counts: dict[str, int] = Counter()
+    with tempfile.TemporaryFile(mode="w+") as err_handle:
+        with subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=err_handle, text=True
+        ) as child:
+            assert child.stdout is not None
+            for _, seq, _ in FastqGeneralIterator(child.stdout):
+                counts[seq.upper()] += 1
+        err_handle.seek(0)
+        stderr = err_handle.read()
+    if child.returncode:
+        if debug:
+            sys.stderr.write(stderr)
+        sys.exit(
+            f"ERROR: Return code {child.returncode} from command:"
+            f"\n{cmd_as_string(cmd)}\n"
+        )
+    count_raw, count_flash = parse_flash_stdout(stderr)
+    if count_flash != sum(counts.values()):
+        sys.exit(
+            f"ERROR: Expected {count_flash} merged reads from flash,"
+            f" but got {sum(counts.values())}\n"
+        )
+    return count_raw, count_flash, counts
 
 
 def save_nr_fasta(
@@ -445,10 +592,15 @@ def merge_paired_reads(
     raw_R2: str,
     merged_fasta_gz: str,
     tmp: str,
+    merger: str = "flash",
     debug: bool = False,
     cpu: int = 0,
 ) -> tuple[int, int]:
-    """Create NR FASTA file by overlap merging the paired FASTQ files."""
+    """Create NR FASTA file by overlap merging the paired FASTQ files.
+
+    The merger can be "flash" to run the FLASH command line tool, or
+    "in-process" to use our own implementation of the same algorithm.
+    """
     if os.path.isfile(merged_fasta_gz):
         if debug:
             sys.stderr.write(f"DEBUG: Reusing {merged_fasta_gz}\n")
@@ -458,22 +610,22 @@ def merge_paired_reads(
             return header["raw_fastq"], header["flash"]
         except KeyError:
             sys.exit(f"ERROR: Missing raw_fastq header in {merged_fasta_gz}")
-    # flash
-    merged_fastq = os.path.join(tmp, "flash.extendedFrags.fastq")
-    count_raw, count_flash = run_flash(
-        raw_R1, raw_R2, tmp, "flash", debug=debug, cpu=cpu
-    )
-    if not os.path.isfile(merged_fastq):
-        sys.exit(f"ERROR: Expected file {merged_fastq!r} from flash\n")
+    if merger == "flash":
+        # flash, streaming the merged reads into a tally
+        count_raw, count_flash, counts = stream_flash(
+            raw_R1, raw_R2, debug=debug, cpu=cpu
+        )
+    else:
+        # Same algorithm as flash (and same header key for the count)
+        count_raw, count_flash, counts = merge_fastq_pairs(raw_R1, raw_R2)
 
     if debug:
         sys.stderr.write(f"DEBUG: Caching {merged_fasta_gz}\n")
-    tmp_fasta_gz = os.path.join(tmp, "flash.extendedFrags.fasta")
-    make_nr_fasta(
-        merged_fastq,
+    tmp_fasta_gz = os.path.join(tmp, "merged.fasta.gz")
+    save_nr_fasta(
+        counts,
         tmp_fasta_gz,
         min_abundance=0,
-        fastq=True,
         gzipped=True,
         header_dict={
             # "left_primer": left_primer,
@@ -485,14 +637,18 @@ def merge_paired_reads(
             # "threshold": min_abundance,
         },
     )
-    shutil.move(tmp_fasta_gz, merged_fasta_gz)
+    # Move into place under a unique name first, then rename which is atomic,
+    # so that a concurrent job sharing the cache never sees a partial file:
+    partial = f"{merged_fasta_gz}.{os.path.basename(tmp)}.tmp"
+    shutil.move(tmp_fasta_gz, partial)
+    os.replace(partial, merged_fasta_gz)
     del tmp_fasta_gz
     return count_raw, count_flash
 
 
 def prepare_sample(
     fasta_name: str,
-    trimmed_fasta: str,
+    trimmed_counts: dict[str, int],
     headers: dict[str, int | str | None],
     min_len: int,
     max_len: int,
@@ -502,16 +658,17 @@ def prepare_sample(
     debug: bool = False,
     cpu: int = 0,
 ) -> tuple[int | None, int | None, int | None, int]:
-    """Create marker-specific FASTA file for sample from paired FASTQ.
+    """Create marker-specific FASTA file for sample from primer trimmed reads.
 
-    Applies abundance threshold, and min/max length.
+    Takes a dict of the primer trimmed sequences and their abundance, and
+    applies an abundance threshold, and min/max length.
 
     Returns pre-threshold total read count, accepted unique sequence count,
     accepted total read count, and the absolute abundance threshold used
     (higher of the given absolute threshold or the given fractional threshold).
     """
     if debug:
-        sys.stderr.write(f"DEBUG: prepare_sample {trimmed_fasta} --> {fasta_name}\n")
+        sys.stderr.write(f"DEBUG: prepare_sample --> {fasta_name}\n")
     if os.path.isfile(fasta_name):
         # Don't actually need the max abundance
         return None, None, None, -1
@@ -526,12 +683,7 @@ def prepare_sample(
     # count_raw = _header["raw_fastq"]
     # count_flash = _header["flash"]
     # count_tmp, count_cutadapt = run_cutadapt(...)
-    if not os.path.isfile(trimmed_fasta):
-        sys.exit(f"ERROR: Expected file {trimmed_fasta!r} from cutadapt\n")
-
-    _unique, _total, _max = abundance_values_in_fasta(trimmed_fasta)
-    count_cutadapt = _total
-    del _unique, _total, _max
+    count_cutadapt = sum(trimmed_counts.values())
 
     if debug:
         sys.stderr.write(
@@ -546,29 +698,23 @@ def prepare_sample(
     header_dict = dict(headers)  # take a copy
     header_dict["cutadapt"] = count_cutadapt
 
-    # deduplicate and apply minimum abundance threshold
+    # apply marker specific min/max length (cutadapt used global min/max length)
+    counts = {
+        seq: count
+        for seq, count in trimmed_counts.items()
+        if min_len <= len(seq) <= max_len
+    }
+    uniq_count = len(counts)
+
+    # apply minimum abundance threshold
     dedup = os.path.join(tmp, "dedup_trimmed.fasta")
-    (
-        count,
-        uniq_count,
-        accepted_total,
-        accepted_uniq_count,
-    ) = make_nr_fasta(
-        trimmed_fasta,
+    accepted_total, accepted_uniq_count = save_nr_fasta(
+        counts,
         dedup,
         min_abundance=min_abundance,
-        min_len=min_len,
-        max_len=max_len,
-        weighted_input=True,
         gzipped=False,
         header_dict=header_dict,
-        debug=debug,
     )
-    if count_cutadapt < count:
-        # Can be less if cutadapt had to use more relaxed global min/max length
-        sys.exit(
-            f"ERROR: Cutadapt says wrote {count_cutadapt}, but we saw {count} reads."
-        )
     if debug:
         assert isinstance(headers["raw_fastq"], int)
         count_raw = headers["raw_fastq"]
@@ -614,6 +760,411 @@ def prepare_sample(
     )
 
 
+def interval_union(intervals: list[tuple[float, float]]) -> float:
+    """Return the total length covered by the given (start, end) intervals.
+
+    Used to turn a list of when a stage was running into the wall time spent,
+    counting any overlapping periods only once (unlike the busy time):
+
+    >>> interval_union([(0.0, 2.0), (1.0, 3.0), (5.0, 6.0)])
+    4.0
+    """
+    total = 0.0
+    covered = float("-inf")
+    for start, end in sorted(intervals):
+        if end > covered:
+            total += end - max(start, covered)
+            covered = end
+    return total
+
+
+def merge_sample(
+    marker_definitions,
+    stem: str,
+    raw_R1: str,
+    raw_R2: str,
+    out_dir: str,
+    merged_cache: str,
+    tmp: str,
+    merger: str = "flash",
+    merger_version: str = "",
+    debug: bool = False,
+    cpu: int = 0,
+) -> tuple[str, str, int | None, int | None, tuple[float, float]]:
+    """Merge the read pairs, the first stage of preparing a sample.
+
+    Any intermediate files are to be written to a new sub-directory of tmp,
+    so that several samples can be prepared at once.
+
+    The merger can be "flash" to run the FLASH command line tool, or
+    "in-process" to use our own implementation of the same algorithm.
+
+    If the merger name and version are given, the merged_cache folder is used
+    as a content addressed cache, keyed on the FASTQ MD5 checksums (taken from
+    any ``MD5SUM.txt`` or ``*.md5`` files where available) and the merger.
+    Otherwise the merged reads are saved there using the sample name.
+
+    Returns the sample's temp directory and merged reads FASTA filename (or
+    empty strings if the sample has already been done), the raw and merged
+    read pair counts (or None), and the start and end time.
+    """
+    start = time()
+    if debug:
+        sys.stderr.write(f"Preparing sample {stem}\n")
+    stem = os.path.split(stem)[1]
+    if all(
+        os.path.isfile(os.path.join(out_dir, marker, f"{stem}.fasta"))
+        for marker in marker_definitions
+    ):
+        return "", "", None, None, (start, time())
+    tmp = tempfile.mkdtemp(prefix=f"{stem}_", dir=tmp)
+    if merger_version:
+        md5 = md5_from_sidecars([raw_R1, raw_R2])
+        for filename in (raw_R1, raw_R2):
+            if filename not in md5:
+                if debug:
+                    sys.stderr.write(f"DEBUG: Computing MD5 checksum of {filename}\n")
+                md5[filename] = md5_hexdigest(filename, chunk_size=2**20)
+        key = merged_key(md5[raw_R1], md5[raw_R2], merger_version)
+        merged_fasta_gz = merged_filename(merged_cache, key)
+    else:
+        merged_fasta_gz = os.path.join(merged_cache, f"{stem}.fasta.gz")
+    # Run flash to merge reads; or parse pre-existing files
+    count_raw, count_flash = merge_paired_reads(
+        raw_R1, raw_R2, merged_fasta_gz, tmp, merger=merger, debug=debug, cpu=cpu
+    )
+    assert count_raw is not None
+    assert count_flash is not None
+    if merger_version:
+        cache = open_merged_cache(os.path.join(merged_cache, MANIFEST))
+        record_merged(
+            cache,
+            key,
+            raw_R1,
+            raw_R2,
+            md5[raw_R1],
+            md5[raw_R2],
+            merger_version,
+            os.path.getsize(merged_fasta_gz),
+        )
+        cache.close()
+    return tmp, merged_fasta_gz, count_raw, count_flash, (start, time())
+
+
+def trim_sample(
+    marker_definitions,
+    stem: str,
+    merged_fasta_gz: str,
+    tmp: str,
+    count_flash: int | None,
+    flip: bool,
+    trimmer: str = "cutadapt",
+    debug: bool = False,
+    cpu: int = 0,
+) -> tuple[dict[str, dict[str, int]], tuple[float, float]]:
+    """Primer trim the merged reads, the second stage of preparing a sample.
+
+    Returns a dictionary of the trimmed sequence counts for each marker
+    (empty if there were no merged reads or the sample was already done),
+    and the start and end time.
+    """
+    start = time()
+    stem = os.path.split(stem)[1]
+    marker_counts: dict[str, dict[str, int]] = {}
+    if count_flash is None:
+        # Already done
+        pass
+    elif not count_flash:
+        # More fiddly, but could skip the abundance code below too?
+        if debug:
+            sys.stderr.write("DEBUG: Skipping cutadapt as no reads\n")
+    elif trimmer == "in-process":
+        _, marker_counts = trim_merged_reads(
+            merged_fasta_gz, marker_definitions, flip=flip
+        )
+    else:
+        # Run cutadapt to cut primers (giving one output per marker)
+        unique_merged_, unique_cutadapt_ = run_cutadapt(
+            merged_fasta_gz,
+            # Here {name} is the cutadapt filename template:
+            os.path.join(tmp, stem + ".{name}.fasta"),
+            marker_definitions,
+            flip=flip,
+            debug=debug,
+            cpu=cpu,
+        )
+        marker_counts = {
+            marker: load_trimmed_counts(os.path.join(tmp, f"{stem}.{marker}.fasta"))
+            for marker in marker_definitions
+        }
+    return marker_counts, (start, time())
+
+
+def threshold_sample(
+    marker_definitions,
+    stem: str,
+    out_dir: str,
+    tmp: str,
+    marker_counts: dict[str, dict[str, int]],
+    count_raw: int | None,
+    count_flash: int | None,
+    min_abundance: int,
+    min_abundance_fraction: float,
+    debug: bool = False,
+    cpu: int = 0,
+) -> tuple[list[str], bool, list[str], tuple[float, float]]:
+    """Apply the abundance thresholds, the final stage of preparing a sample.
+
+    Returns a list of the FASTA files for each marker, if the sample was
+    skipped as already done, a list of summary messages for the user, and
+    the start and end time.
+    """
+    start = time()
+    pool_path = os.path.abspath(os.path.split(stem)[0])
+    # Use relative path if under the current directory
+    try:
+        _ = os.path.relpath(pool_path)
+        if not _.startswith(".."):
+            pool_path = _
+    except ValueError:
+        # Will fail on Windows if using different drives
+        pass
+    stem = os.path.split(stem)[1]
+    fasta_files_prepared = []
+    skipped = False
+    messages = []
+    for marker, marker_values in marker_definitions.items():
+        sys.stdout.flush()
+        sys.stderr.flush()
+        fasta_name = os.path.join(out_dir, marker, f"{stem}.fasta")
+        # This skips pre-existing samples:
+        (
+            marker_total,
+            uniq_count,
+            accepted_total,
+            min_a,
+        ) = prepare_sample(
+            fasta_name,
+            marker_counts.get(marker, {}),
+            {
+                "marker": marker,
+                "left_primer": marker_values["left_primer"],
+                "right_primer": marker_values["right_primer"],
+                # Convert Windows style path separators:
+                "threshold_pool": pool_path.replace("\\", "/"),
+                "raw_fastq": count_raw,
+                "flash": count_flash,
+            },
+            marker_values["min_length"],
+            marker_values["max_length"],
+            min_abundance,
+            min_abundance_fraction,
+            tmp,
+            debug=debug,
+            cpu=cpu,
+        )
+        fasta_files_prepared.append(fasta_name)
+        if uniq_count:
+            assert marker_total is not None
+            assert accepted_total is not None
+            assert accepted_total <= marker_total, (accepted_total, marker_total)
+        if uniq_count is None:
+            skipped = True
+            if debug:
+                sys.stderr.write(f"Skipping {fasta_name} as already done\n")
+        elif min_a > 1:
+            assert marker_total is not None
+            messages.append(
+                f"Sample {stem} has {uniq_count} unique {marker} sequences,"
+                f" or {accepted_total}/{marker_total}"
+                f" reads over abundance threshold {min_a}\n"
+            )
+        else:
+            assert marker_total is not None
+            assert accepted_total == marker_total
+            messages.append(
+                f"Sample {stem} has {uniq_count} unique {marker} sequences,"
+                f" or {accepted_total} reads (abundance threshold {min_a})\n"
+            )
+    return fasta_files_prepared, skipped, messages, (start, time())
+
+
+def prepare_file_pair(
+    marker_definitions,
+    stem: str,
+    raw_R1: str,
+    raw_R2: str,
+    out_dir: str,
+    merged_cache: str,
+    tmp: str,
+    flip: bool,
+    min_abundance: int,
+    min_abundance_fraction: float,
+    trimmer: str = "cutadapt",
+    merger: str = "flash",
+    merger_version: str = "",
+    debug: bool = False,
+    cpu: int = 0,
+) -> tuple[list[str], bool, list[str], list[tuple[float, float]]]:
+    """Merge, primer-trim and apply abundance thresholds to one sample.
+
+    Runs the three stages merge_sample, trim_sample and threshold_sample one
+    after the other. Returns a list of the FASTA files for each marker, if
+    the sample was skipped as already done, a list of summary messages for
+    the user, and the start and end times of the three stages.
+    """
+    sample_tmp, merged_fasta_gz, count_raw, count_flash, merge_times = merge_sample(
+        marker_definitions,
+        stem,
+        raw_R1,
+        raw_R2,
+        out_dir,
+        merged_cache,
+        tmp,
+        merger=merger,
+        merger_version=merger_version,
+        debug=debug,
+        cpu=cpu,
+    )
+    marker_counts, trim_times = trim_sample(
+        marker_definitions,
+        stem,
+        merged_fasta_gz,
+        sample_tmp,
+        count_flash,
+        flip,
+        trimmer=trimmer,
+        debug=debug,
+        cpu=cpu,
+    )
+    fasta_names, skipped, messages, threshold_times = threshold_sample(
+        marker_definitions,
+        stem,
+        out_dir,
+        sample_tmp or tmp,
+        marker_counts,
+        count_raw,
+        count_flash,
+        min_abundance,
+        min_abundance_fraction,
+        debug=debug,
+        cpu=cpu,
+    )
+    return fasta_names, skipped, messages, [merge_times, trim_times, threshold_times]
+
+
+def pipeline_file_pairs(
+    marker_definitions,
+    file_pairs: list[tuple[str, str, str]],
+    out_dir: str,
+    merged_cache: str,
+    tmp: str,
+    flip: bool,
+    min_abundance: int,
+    min_abundance_fraction: float,
+    trimmer: str = "cutadapt",
+    merger: str = "flash",
+    merger_version: str = "",
+    debug: bool = False,
+    cpu: int = 3,
+) -> Iterator[tuple[list[str], bool, list[str], list[tuple[float, float]]]]:
+    """Prepare samples with the three stages overlapping between samples.
+
+    Each stage has its own thread, taking the samples in order, so that
+    flash can be merging the next sample while cutadapt trims the current
+    sample and the thresholds are applied to the previous sample. Yields
+    the same values as prepare_file_pair, in the input order.
+
+    The thresholds get one CPU, and the rest of the CPU budget (at least
+    three in total) is split between flash and cutadapt. Only three samples
+    are in flight at once, so merging cannot run ahead of trimming and the
+    memory used does not grow with the number of samples.
+    """
+    assert cpu >= 3, cpu
+    stage_cpu = (cpu - 1) // 2
+    merge_pool = ThreadPoolExecutor(max_workers=1)
+    trim_pool = ThreadPoolExecutor(max_workers=1)
+    threshold_pool = ThreadPoolExecutor(max_workers=1)
+
+    def trim_after(stem: str, merged: Future):
+        sample_tmp, merged_fasta_gz, count_raw, count_flash, _ = merged.result()
+        return trim_sample(
+            marker_definitions,
+            stem,
+            merged_fasta_gz,
+            sample_tmp,
+            count_flash,
+            flip,
+            trimmer=trimmer,
+            debug=debug,
+            cpu=stage_cpu,
+        )
+
+    def threshold_after(stem: str, merged: Future, trimmed: Future):
+        sample_tmp, merged_fasta_gz, count_raw, count_flash, _ = merged.result()
+        marker_counts, _ = trimmed.result()
+        return threshold_sample(
+            marker_definitions,
+            stem,
+            out_dir,
+            sample_tmp or tmp,
+            marker_counts,
+            count_raw,
+            count_flash,
+            min_abundance,
+            min_abundance_fraction,
+            debug=debug,
+            cpu=1,
+        )
+
+    def collect(merged: Future, trimmed: Future, thresholded: Future):
+        fasta_names, skipped, messages, threshold_times = thresholded.result()
+        return (
+            fasta_names,
+            skipped,
+            messages,
+            [merged.result()[-1], trimmed.result()[-1], threshold_times],
+        )
+
+    # One sample per stage, dropping each once yielded:
+    jobs: deque[tuple[Future, Future, Future]] = deque()
+    try:
+        for stem, raw_R1, raw_R2 in file_pairs:
+            merged = merge_pool.submit(
+                merge_sample,
+                marker_definitions,
+                stem,
+                raw_R1,
+                raw_R2,
+                out_dir,
+                merged_cache,
+                tmp,
+                merger=merger,
+                merger_version=merger_version,
+                debug=debug,
+                cpu=stage_cpu,
+            )
+            trimmed = trim_pool.submit(trim_after, stem, merged)
+            thresholded = threshold_pool.submit(threshold_after, stem, merged, trimmed)
+            jobs.append((merged, trimmed, thresholded))
+            del merged, trimmed, thresholded
+            if len(jobs) == 3:
+                yield collect(*jobs.popleft())
+        while jobs:
+            yield collect(*jobs.popleft())
+    finally:
+        # If there was an error, don't start any more samples:
+        for pool in (merge_pool, trim_pool, threshold_pool):
+            pool.shutdown(cancel_futures=True)
+
+
+def pipeline_file_pairs_list(
+    *args, **kwargs
+) -> list[tuple[list[str], bool, list[str], list[tuple[float, float]]]]:
+    """Run pipeline_file_pairs to completion, for use in a worker process."""
+    return list(pipeline_file_pairs(*args, **kwargs))
+
+
 def marker_cut(
     marker_definitions,
     file_pairs: list[tuple[str, str, str]],
@@ -623,15 +1174,51 @@ def marker_cut(
     flip: bool,
     min_abundance: int,
     min_abundance_fraction: float,
+    trimmer: str = "cutadapt",
+    merger: str = "flash",
+    merger_version: str = "",
+    merged_cache_size: int = 0,
     debug: bool = False,
     cpu: int = 0,
 ) -> list[str]:
-    """Apply primer-trimming for given markers."""
+    """Apply primer-trimming for given markers.
+
+    The trimmer can be "cutadapt" to run the cutadapt command line tool, or
+    "in-process" to primer trim the non-redundant merged reads in memory.
+
+    The merger can be "flash" to run the FLASH command line tool, or
+    "in-process" to use our own implementation of the same algorithm.
+
+    If the merger name and version are given, merged_cache is used as a
+    content addressed cache (see merge_sample), and the least recently used
+    files are removed if over the given maximum size in bytes (if non-zero).
+
+    How the samples are scheduled depends on the CPU budget:
+
+    * One sample, or one CPU: the samples are prepared one at a time, with
+      the three stages run in sequence, and flash and cutadapt given all
+      the CPUs.
+    * Several samples and two CPUs: two worker processes each prepare a
+      sample at a time, with one CPU each.
+    * Several samples and three or more CPUs: the samples are pipelined, so
+      flash, cutadapt and the thresholds overlap between samples (see
+      pipeline_file_pairs). With six or more CPUs and at least four
+      samples, the samples are split into consecutive batches, each
+      pipelined in a pool of worker processes with an equal share of the
+      CPUs.
+
+    Either way, the output and the summary messages do not depend on the
+    scheduling.
+    The time spent on each stage is reported as both the busy time (total
+    over all the samples), and the wall time (when any sample was at that
+    stage).
+    """
     sys.stderr.write(
         f"Looking for {len(marker_definitions)} markers in {len(file_pairs)} samples\n"
     )
 
-    time_flash = time_cutadapt = time_abundance = 0.0
+    start = time()
+    stage_times: list[list[tuple[float, float]]] = [[], [], []]
 
     for marker in marker_definitions:
         if not os.path.isdir(os.path.join(out_dir, marker)):
@@ -639,129 +1226,150 @@ def marker_cut(
                 sys.stderr.write(f"Making {marker} output sub-directory\n")
             os.mkdir(os.path.join(out_dir, marker))
 
+    stems = set()
+    for stem, _, _ in file_pairs:
+        stem = os.path.split(stem)[1]
+        if stem in stems:
+            marker = next(iter(marker_definitions))
+            fasta_name = os.path.join(out_dir, marker, f"{stem}.fasta")
+            sys.exit(f"ERROR: Multiple files named {fasta_name}")
+        stems.add(stem)
+    del stems
+
     skipped_samples = set()  # marker specific
     fasta_files_prepared = []  # return value
 
-    for stem, raw_R1, raw_R2 in file_pairs:
+    sys.stdout.flush()
+    sys.stderr.flush()
+    executor = None
+    if cpu >= 3 and len(file_pairs) > 1:
+        # Each pipeline needs at least three CPUs, and two samples to overlap:
+        workers = max(1, min(cpu // 3, len(file_pairs) // 2))
         if debug:
-            sys.stderr.write(f"Preparing sample {stem}\n")
-
-        sys.stdout.flush()
-        sys.stderr.flush()
-
-        pool_path = os.path.abspath(os.path.split(stem)[0])
-        # Use relative path if under the current directory
-        try:
-            _ = os.path.relpath(pool_path)
-            if not _.startswith(".."):
-                pool_path = _
-        except ValueError:
-            # Will fail on Windows if using different drives
-            pass
-        stem = os.path.split(stem)[1]
-        merged_fasta_gz = os.path.join(merged_cache, f"{stem}.fasta.gz")
-
-        count_raw = count_flash = None
-        if any(
-            not os.path.isfile(os.path.join(out_dir, marker, f"{stem}.fasta"))
-            for marker in marker_definitions
-        ):
-            # Run flash to merge reads; or parse pre-existing files
-            start = time()
-            count_raw, count_flash = merge_paired_reads(
-                raw_R1, raw_R2, merged_fasta_gz, tmp, debug=debug, cpu=cpu
+            sys.stderr.write(
+                f"DEBUG: Preparing {len(file_pairs)} samples using"
+                f" {workers} pipeline(s) of {cpu // workers} CPUs\n"
             )
-            time_flash += time() - start
-            assert count_raw is not None
-            assert count_flash is not None
-            if count_flash:
-                # Run cutadapt to cut primers (giving one output per marker)
-                start = time()
-                unique_merged_, unique_cutadapt_ = run_cutadapt(
-                    merged_fasta_gz,
-                    # Here {name} is the cutadapt filename template:
-                    os.path.join(tmp, stem + ".{name}.fasta"),
+        if workers == 1:
+            results = pipeline_file_pairs(
+                marker_definitions,
+                file_pairs,
+                out_dir,
+                merged_cache,
+                tmp,
+                flip,
+                min_abundance,
+                min_abundance_fraction,
+                trimmer=trimmer,
+                merger=merger,
+                merger_version=merger_version,
+                debug=debug,
+                cpu=cpu,
+            )
+        else:
+            # Consecutive batches, so the results come back in the input order:
+            size = ceil(len(file_pairs) / workers)
+            executor = ProcessPoolExecutor(max_workers=workers)
+            batches = [
+                executor.submit(
+                    pipeline_file_pairs_list,
                     marker_definitions,
-                    flip=flip,
+                    file_pairs[i : i + size],
+                    out_dir,
+                    merged_cache,
+                    tmp,
+                    flip,
+                    min_abundance,
+                    min_abundance_fraction,
+                    trimmer=trimmer,
+                    merger=merger,
+                    merger_version=merger_version,
                     debug=debug,
-                    cpu=cpu,
+                    cpu=cpu // workers,
                 )
-                time_cutadapt += time() - start
-            else:
-                # More fiddly, but could skip the abundance code below too?
-                # Just make an empty file for prepare_sample to parse.
-                if debug:
-                    sys.stderr.write("DEBUG: Skipping cutadapt as no reads\n")
-                for marker in marker_definitions:
-                    with open(
-                        os.path.join(tmp, f"{stem}.{marker}.fasta"), "w"
-                    ) as handle:
-                        handle.write("#Nothing\n")
-
-        # Apply abundance thresholds
-        start = time()
-        for marker, marker_values in marker_definitions.items():
-            sys.stdout.flush()
-            sys.stderr.flush()
-            fasta_name = os.path.join(out_dir, marker, f"{stem}.fasta")
-            if fasta_name in fasta_files_prepared:
-                sys.exit(f"ERROR: Multiple files named {fasta_name}")
-            # This skips pre-existing samples:
+                for i in range(0, len(file_pairs), size)
+            ]
+            results = chain.from_iterable(_.result() for _ in batches)
+    elif cpu == 2 and len(file_pairs) > 1:
+        if debug:
+            sys.stderr.write(
+                f"DEBUG: Preparing {len(file_pairs)} samples using 2 workers\n"
+            )
+        jobs = [
             (
-                marker_total,
-                uniq_count,
-                accepted_total,
-                min_a,
-            ) = prepare_sample(
-                fasta_name,
-                os.path.join(tmp, f"{stem}.{marker}.fasta"),
-                {
-                    "marker": marker,
-                    "left_primer": marker_values["left_primer"],
-                    "right_primer": marker_values["right_primer"],
-                    # Convert Windows style path separators:
-                    "threshold_pool": pool_path.replace("\\", "/"),
-                    "raw_fastq": count_raw,
-                    "flash": count_flash,
-                },
-                marker_values["min_length"],
-                marker_values["max_length"],
+                marker_definitions,
+                stem,
+                raw_R1,
+                raw_R2,
+                out_dir,
+                merged_cache,
+                tmp,
+                flip,
                 min_abundance,
                 min_abundance_fraction,
+                trimmer,
+                merger,
+                merger_version,
+                debug,
+            )
+            for stem, raw_R1, raw_R2 in file_pairs
+        ]
+        executor = ProcessPoolExecutor(max_workers=2)
+        # The map results come back in the input order:
+        results = executor.map(prepare_file_pair, *zip(*jobs), repeat(1))
+    else:
+        results = (
+            prepare_file_pair(
+                marker_definitions,
+                stem,
+                raw_R1,
+                raw_R2,
+                out_dir,
+                merged_cache,
                 tmp,
+                flip,
+                min_abundance,
+                min_abundance_fraction,
+                trimmer=trimmer,
+                merger=merger,
+                merger_version=merger_version,
                 debug=debug,
                 cpu=cpu,
             )
-            fasta_files_prepared.append(fasta_name)
-            if uniq_count:
-                assert marker_total is not None
-                assert accepted_total is not None
-                assert accepted_total <= marker_total, (accepted_total, marker_total)
-            if uniq_count is None:
-                skipped_samples.add(stem)
-                if debug:
-                    sys.stderr.write(f"Skipping {fasta_name} as already done\n")
-            elif min_a > 1:
-                assert marker_total is not None
-                sys.stderr.write(
-                    f"Sample {stem} has {uniq_count} unique {marker} sequences,"
-                    f" or {accepted_total}/{marker_total}"
-                    f" reads over abundance threshold {min_a}\n"
-                )
-            else:
-                assert marker_total is not None
-                assert accepted_total == marker_total
-                sys.stderr.write(
-                    f"Sample {stem} has {uniq_count} unique {marker} sequences,"
-                    f" or {accepted_total} reads (abundance threshold {min_a})\n"
-                )
-        time_abundance += time() - start
+            for stem, raw_R1, raw_R2 in file_pairs
+        )
+
+    for (stem, _, _), (fasta_names, skipped, messages, times) in zip(
+        file_pairs, results
+    ):
+        fasta_files_prepared.extend(fasta_names)
+        if skipped:
+            skipped_samples.add(stem)
+        for msg in messages:
+            sys.stderr.write(msg)
+        for stage, interval in zip(stage_times, times):
+            stage.append(interval)
         if debug:
+            time_merge, time_trim, time_abundance = (
+                sum(end - begin for begin, end in stage) for stage in stage_times
+            )
             sys.stderr.write(
-                f"Thus far, {time_flash:0.1f}s running flash and making NR,"
-                f" {time_cutadapt:0.1f}s on cutadapt,"
+                f"Thus far, {time_merge:0.1f}s merging reads and making NR,"
+                f" {time_trim:0.1f}s primer trimming,"
                 f" and {time_abundance:0.1f}s applying abundance thresholds\n"
             )
+    if executor:
+        executor.shutdown()
+
+    if merger_version and merged_cache_size:
+        cache = open_merged_cache(os.path.join(merged_cache, MANIFEST))
+        count, freed = evict_merged(merged_cache, cache, merged_cache_size)
+        cache.close()
+        if count:
+            sys.stderr.write(
+                f"Removed {count} least recently used files"
+                f" ({freed / 1024**3:0.2f} GB) from merged read cache\n"
+            )
 
     # Finished all files
     if skipped_samples:
@@ -769,10 +1377,18 @@ def marker_cut(
             f"Skipped {len(skipped_samples)} previously prepared {marker} samples\n"
         )
 
+    time_merge, time_trim, time_abundance = (
+        sum(end - begin for begin, end in stage) for stage in stage_times
+    )
+    wall_merge, wall_trim, wall_abundance = (
+        interval_union(stage) for stage in stage_times
+    )
     sys.stderr.write(
-        f"Spent {time_flash:0.1f}s running flash and making NR,"
-        f" {time_cutadapt:0.1f}s on cutadapt,"
-        f" and {time_abundance:0.1f}s applying abundance thresholds\n"
+        f"Spent {time_merge:0.1f}s merging reads and making NR,"
+        f" {time_trim:0.1f}s primer trimming,"
+        f" and {time_abundance:0.1f}s applying abundance thresholds"
+        f" (busy time, or {wall_merge:0.1f}s, {wall_trim:0.1f}s and"
+        f" {wall_abundance:0.1f}s wall time), taking {time() - start:0.1f}s\n"
     )
 
     sys.stdout.flush()
@@ -868,6 +1484,9 @@ def main(
     min_abundance_fraction: float = 0.0,
     ignore_prefixes: tuple[str] | None = None,
     merged_cache: str | None = None,
+    merged_cache_size: int = 0,
+    trimmer: str = "cutadapt",
+    merger: str = "flash",
     tmp_dir: str | None = None,
     debug: bool = False,
     cpu: int = 0,
@@ -876,6 +1495,14 @@ def main(
 
     For use in the pipeline command, returns a filename listing of the FASTA
     files created.
+
+    The trimmer can be "cutadapt" to run the cutadapt command line tool, or
+    "in-process" to primer trim the non-redundant merged reads in memory.
+    Likewise the merger can be "flash" to run the FLASH command line tool, or
+    "in-process" to use our own implementation of the same algorithm.
+
+    Any merged_cache folder is used as a content addressed cache shared
+    between runs, with an optional maximum size in bytes.
     """
     assert isinstance(fastq, (list, set))
 
@@ -890,6 +1517,8 @@ def main(
     if debug:
         sys.stderr.write(f"DEBUG: Shared temp folder {shared_tmp}\n")
 
+    # Will name the cached merged reads by their FASTQ checksums and merger version:
+    content_cache = bool(merged_cache)
     if not merged_cache:
         # Not told to keep it, just use a temp folder for the merged reads
         merged_cache = os.path.join(shared_tmp, "merged")
@@ -912,7 +1541,21 @@ def main(
         os.mkdir(out_dir)
         # sys.exit(f"ERROR: {out_dir} for per-sample files is not a directory.")
 
-    check_tools(["flash", "cutadapt"], debug)
+    if merger not in ("flash", "in-process"):
+        sys.exit(f"ERROR: Invalid read merger {merger!r}")
+    if trimmer not in ("cutadapt", "in-process"):
+        sys.exit(f"ERROR: Invalid primer trimmer {trimmer!r}")
+    tools: list[str] = [
+        name for name in ("flash", "cutadapt") if name in (merger, trimmer)
+    ]
+    if tools:
+        check_tools(tools, debug)
+    if not content_cache:
+        merger_version = ""
+    elif merger == "flash":
+        merger_version = f"flash {version_flash()}"
+    else:
+        merger_version = f"in-process {__version__}"
 
     marker_definitions = load_marker_defs(session, filter=markers)
 
@@ -945,6 +1588,10 @@ def main(
         flip,
         min_abundance,
         min_abundance_fraction,
+        trimmer=trimmer,
+        merger=merger,
+        merger_version=merger_version,
+        merged_cache_size=merged_cache_size,
         debug=debug,
         cpu=cpu,
     )
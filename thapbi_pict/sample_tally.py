@@ -11,25 +11,263 @@ This implements the ``thapbi_pict sample-tally ...`` command.
 from __future__ import annotations
 
 import gzip
+import heapq
 import os
 import shutil
 import sys
 import tempfile
-from collections import Counter
-from collections import defaultdict
+from collections.abc import Iterable
+from collections.abc import Iterator
 from math import ceil
 from time import time
 
-from Bio.SeqIO.FastaIO import SimpleFastaParser
+import numpy as np
 
 from .denoise import read_correction
 from .prepare import load_marker_defs
-from .utils import abundance_from_read_name
+from .utils import abundance_counts_in_fastas
 from .utils import export_sample_biom
 from .utils import file_to_sample_name
 from .utils import is_spike_in
 from .utils import load_fasta_header
 from .utils import md5seq
+from .utils import parse_sample_tsv
+from .utils import spike_kmer_index
+
+
+def sum_duplicates(
+    seq_ids: np.ndarray, sample_ids: np.ndarray, values: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Combine any repeated (sequence, sample) entries in a sparse count matrix.
+
+    The counts are held as three parallel arrays (coordinate or COO format),
+    sequence integer ID, sample integer ID and abundance. Returns the same
+    sorted by sequence ID then sample ID (so rows are contiguous as in CSR
+    format), with the values of any duplicated coordinates summed:
+
+    >>> seq_ids, sample_ids, values = sum_duplicates(
+    ...     np.array([1, 0, 1]), np.array([0, 2, 0]), np.array([5, 3, 4])
+    ... )
+    >>> seq_ids.tolist(), sample_ids.tolist(), values.tolist()
+    ([0, 1], [2, 0], [3, 9])
+    """
+    keys = seq_ids.astype(np.int64) * (int(sample_ids.max(initial=0)) + 1)
+    keys += sample_ids
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    starts = np.flatnonzero(np.diff(keys, prepend=-1))
+    return (
+        seq_ids[order][starts],
+        sample_ids[order][starts],
+        np.add.reduceat(values[order], starts) if len(keys) else values[:0],
+    )
+
+
+def seq_totals(seq_ids: np.ndarray, values: np.ndarray, seq_count: int) -> np.ndarray:
+    """Return the total abundance of each sequence ID in a sparse count matrix."""
+    totals = np.zeros(seq_count, dtype=np.int64)
+    np.add.at(totals, seq_ids, values)
+    return totals
+
+
+def dense_row(
+    sample_ids: np.ndarray, values: np.ndarray, row: slice, sample_count: int
+) -> list[int]:
+    """Return a row of the sparse count matrix as a list of all sample counts.
+
+    >>> dense_row(np.array([0, 1, 3]), np.array([7, 5, 2]), slice(1, 3), 5)
+    [0, 5, 0, 2, 0]
+    """
+    answer = np.zeros(sample_count, dtype=np.int64)
+    answer[sample_ids[row]] = values[row]
+    return answer.tolist()
+
+
+_MAX_TOTAL = 10**18  # for sorting run files by decreasing total abundance
+
+
+def intern_seqs(
+    seq_list: Iterable[str], seq_index: dict[str, int], seqs: list[str]
+) -> np.ndarray:
+    """Return array of the sequences' integer IDs, adding any new sequences.
+
+    >>> seqs = ["ACGT"]
+    >>> intern_seqs(["GGCC", "ACGT"], {"ACGT": 0}, seqs).tolist(), seqs
+    ([1, 0], ['ACGT', 'GGCC'])
+    """
+    ids = []
+    for seq in seq_list:
+        try:
+            ids.append(seq_index[seq])
+        except KeyError:
+            ids.append(len(seqs))
+            seq_index[seq] = len(seqs)
+            seqs.append(seq)
+    return np.array(ids, dtype=np.int32)
+
+
+def match_threshold_pools(
+    old_pools: Iterable[str], new_pools: Iterable[str]
+) -> dict[str, str]:
+    """Map threshold pool names from a tally TSV file to those of new samples.
+
+    The threshold pool names in a tally TSV file have had any common folder
+    prefix removed, so may be a suffix of the name in the FASTA headers. If
+    matched consistently, the same prefix is restored on the other old names:
+
+    >>> match_threshold_pools(["plate-A", "plate-C"], ["raw/plate-A", "raw/plate-B"])
+    {'plate-A': 'raw/plate-A', 'plate-C': 'raw/plate-C'}
+
+    If none match, the old pools are assumed to be in the same parent folder
+    as the new pools:
+
+    >>> match_threshold_pools(["plate-C"], ["raw/plate-A", "raw/plate-B"])
+    {'plate-C': 'raw/plate-C'}
+    >>> match_threshold_pools(["plate-C"], ["plate-A"])
+    {'plate-C': 'plate-C'}
+    """
+    answer = {}
+    prefixes = set()
+    for old_pool in old_pools:
+        for new_pool in new_pools:
+            if new_pool == old_pool or new_pool.endswith(
+                ("/" + old_pool, os.path.sep + old_pool)
+            ):
+                answer[old_pool] = new_pool
+                prefixes.add(new_pool[: len(new_pool) - len(old_pool)])
+                break
+    if not prefixes:
+        try:
+            prefixes.add(
+                os.path.join(
+                    os.path.commonpath([os.path.dirname(_) for _ in new_pools]), ""
+                )
+            )
+        except ValueError:
+            # Mix of absolute and relative paths, or nothing to go on
+            pass
+    prefix = prefixes.pop() if len(prefixes) == 1 else ""
+    return {old_pool: answer.get(old_pool, prefix + old_pool) for old_pool in old_pools}
+
+
+def load_existing_tally(
+    filename: str, marker: str, min_length: int = 0, max_length: int = sys.maxsize
+) -> dict[str, tuple[dict[str, str], dict[str, int]]]:
+    """Load a previous sample-tally TSV file, in order to add more samples.
+
+    Returns a dict keyed on sample name, of the sample metadata from the
+    header rows (using the same keys as the prepare-reads FASTA headers,
+    e.g. ``threshold_pool``), and a dict of the (upper case) sequences
+    within the length range and their counts.
+    """
+    seqs, seq_meta, sample_meta, counts = parse_sample_tsv(filename)
+    if any(seq_meta.values()):
+        sys.exit(
+            f"ERROR: Existing tally {filename} has sequence metadata"
+            " (e.g. from denoising), cannot add samples to it."
+        )
+    for seq_marker, _ in seqs:
+        if seq_marker != marker:
+            sys.exit(f"ERROR: Expected marker {marker}, not {seq_marker} in {filename}")
+    answer: dict[str, tuple[dict[str, str], dict[str, int]]] = {
+        sample: (
+            {
+                "marker": marker,
+                **{
+                    stat.lower().replace(" ", "_"): value
+                    for stat, value in meta.items()
+                    if value != "-"
+                },
+            },
+            {},
+        )
+        for sample, meta in sample_meta.items()
+    }
+    for (_, idn, sample), a in counts.items():
+        seq = seqs[marker, idn]
+        if min_length <= len(seq) <= max_length:
+            answer[sample][1][seq] = a
+    return answer
+
+
+class SpilledCounts:
+    """Sparse sequence by sample counts, sorted on disk to bound memory use.
+
+    Counts are buffered in memory until their estimated size exceeds the
+    given number of bytes, and then written to a new run file sorted by
+    key and sequence, with one line per sequence listing the sample ID and
+    count pairs. Iterating does an external merge of the run files, giving
+    the key, sequence and a dict of sample ID to count once per sequence
+    (in key order), summing any counts split over several run files.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as tmp:
+    ...     spill = SpilledCounts(tmp, "example", max_bytes=1)
+    ...     spill.add("b", "ACGT", {0: 5})
+    ...     spill.add("a", "GGCC", {1: 2})
+    ...     spill.add("b", "ACGT", {1: 3})
+    ...     len(spill.runs), list(spill)
+    (3, [('a', 'GGCC', {1: 2}), ('b', 'ACGT', {0: 5, 1: 3})])
+    """
+
+    def __init__(self, folder: str, prefix: str, max_bytes: int) -> None:
+        """Initialize the buffer, run files will be written to the folder."""
+        self.folder = folder
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.runs: list[str] = []
+        self.buffer: dict[tuple[str, str], dict[int, int]] = {}
+        self.size = 0  # rough estimate in bytes
+
+    def add(self, key: str, seq: str, counts: dict[int, int]) -> None:
+        """Add the sequence's counts, writing a run file if over the limit."""
+        try:
+            old = self.buffer[key, seq]
+        except KeyError:
+            self.buffer[key, seq] = dict(counts)
+            self.size += 200 + len(key) + len(seq)
+        else:
+            for sample_id, a in counts.items():
+                old[sample_id] = old.get(sample_id, 0) + a
+        self.size += 100 * len(counts)  # Python dict entries are not small
+        if self.size > self.max_bytes:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write any buffered counts to a new run file."""
+        if not self.buffer:
+            return
+        filename = os.path.join(self.folder, f"{self.prefix}_{len(self.runs)}.tsv")
+        with open(filename, "w") as handle:
+            for (key, seq), counts in sorted(self.buffer.items()):
+                pairs = ",".join(f"{s}:{a}" for s, a in sorted(counts.items()))
+                handle.write(f"{key}\t{seq}\t{pairs}\n")
+        self.runs.append(filename)
+        self.buffer = {}
+        self.size = 0
+
+    def __iter__(self) -> Iterator[tuple[str, str, dict[int, int]]]:
+        """Merge the run files, yielding key, sequence and counts dict."""
+        self.flush()
+        handles = [open(_) for _ in self.runs]
+        try:
+            last = None
+            counts: dict[int, int] = {}
+            for line in heapq.merge(*handles, key=lambda line: line.split("\t", 2)[:2]):
+                key, seq, pairs = line.rstrip("\n").split("\t")
+                if (key, seq) != last:
+                    if last:
+                        yield last[0], last[1], counts
+                    last = key, seq
+                    counts = {}
+                for pair in pairs.split(","):
+                    sample_id, a = pair.split(":")
+                    counts[int(sample_id)] = counts.get(int(sample_id), 0) + int(a)
+            if last:
+                yield last[0], last[1], counts
+        finally:
+            for handle in handles:
+                handle.close()
 
 
 def main(
@@ -41,6 +279,7 @@ def main(
     marker: str | None = None,
     spike_genus=None,
     fasta=None,
+    existing: str | None = None,
     min_abundance: int = 100,
     min_abundance_fraction: float = 0.001,
     total_min_abundance: int = 0,
@@ -52,6 +291,7 @@ def main(
     gzipped: bool = False,  # output
     biom: str | None = None,
     tmp_dir: str | None = None,
+    max_memory: int = 0,
     debug: bool = False,
     cpu: int = 0,
 ) -> None:
@@ -68,6 +308,23 @@ def main(
     (after denoising if being used), increased by pool if negative or
     synthetic controls are given respectively. Comma separated string argument
     spike_genus is treated case insensitively.
+
+    Optional argument existing is a previous sample-tally TSV file, with the
+    thresholds and other sample metadata in its header rows, to which the
+    new samples are added (including any controls used, which are still
+    applied to their pools). The thresholds only ever go up, so the counts
+    in the old table are all that is needed, and the output is as if all
+    the FASTA files had been tallied together. Not supported with denoising
+    or the total abundance threshold, as both depend on the full data.
+
+    Optional argument max_memory (in MB) bounds the memory used for the
+    sequence by sample counts (beyond the unique sequences when denoising),
+    which are instead spilled to sorted run files in tmp_dir and combined
+    with an external merge for each pass over the data. The output is the
+    same as when working in memory, but not supported with BIOM output.
+    The limit excludes the sequence counts dict for each input file as it
+    is loaded (one per CPU when loading in parallel), and when denoising,
+    the total abundance for each unique sequence.
     """
     if isinstance(inputs, str):
         inputs = [inputs]
@@ -113,20 +370,66 @@ def main(
     del marker_definitions
     assert marker
 
-    totals: dict[str, int] = Counter()
-    counts: dict[tuple[str, str], int] = Counter()
+    existing_samples: dict[str, tuple[dict[str, str], dict[str, int]]] = {}
+    if existing:
+        if denoise_algorithm != "-" or total_min_abundance:
+            sys.exit(
+                "ERROR: Adding to an existing tally does not support"
+                " denoising or a total abundance threshold."
+            )
+        existing_samples = load_existing_tally(existing, marker, min_length, max_length)
+        sys.stderr.write(
+            f"Loaded {len(existing_samples)} samples from existing tally {existing}\n"
+        )
+        for filename in inputs:
+            if file_to_sample_name(filename) in existing_samples:
+                sys.exit(f"ERROR: Sample from {filename} already in {existing}")
+        # Any controls in the existing tally still apply to their pools:
+        for sample, (headers, _) in existing_samples.items():
+            if headers.get("control") in ("Negative", "Neg/Synth"):
+                negative_controls.append(sample)
+            if headers.get("control") in ("Synthetic", "Neg/Synth"):
+                synthetic_controls.append(sample)
+        controls = set(negative_controls + synthetic_controls)
+
+    spill: SpilledCounts | None = None
+    if max_memory:
+        if biom:
+            sys.exit("ERROR: BIOM output is not supported with a memory limit.")
+        if tmp_dir:
+            # Up to the user to remove the files
+            tmp_obj = None
+            shared_tmp = tmp_dir
+        else:
+            tmp_obj = tempfile.TemporaryDirectory()
+            shared_tmp = tmp_obj.name
+        if debug:
+            sys.stderr.write(f"DEBUG: Spilling counts to {shared_tmp}\n")
+        max_bytes = max_memory * 1024 * 1024
+        spill = SpilledCounts(shared_tmp, "counts", max_bytes)
+
+    samples: list[str] = sorted(
+        [file_to_sample_name(_) for _ in inputs] + list(existing_samples)
+    )
+    sample_index = {sample: i for i, sample in enumerate(samples)}
+    # Sparse count matrix of sequence and sample integer IDs (COO format),
+    # using a NumPy array chunk per sample:
+    seqs: list[str] = []  # sequence ID to sequence
+    seq_index: dict[str, int] = {}
+    chunks: list[tuple[np.ndarray, np.ndarray, np.ndarray]] = []
     sample_cutadapt: dict[str, int] = {}  # before any thresholds
-    samples: set[str] | list[str] = set()
     sample_pool: dict[str, str] = {}
     sample_headers: dict[str, dict] = {}
-    for filename in inputs:
+    # Parsing the FASTA files can be done in parallel, results in input order:
+    for filename, file_counts in zip(
+        inputs,
+        abundance_counts_in_fastas(inputs, min_length, max_length, cpu=cpu),
+    ):
         # Assuming FASTA for now
         if debug:
             sys.stderr.write(f"DEBUG: Parsing {filename}\n")
         sample = file_to_sample_name(filename)
-        assert sample not in samples, f"ERROR: Duplicate stem from {filename}"
-        assert isinstance(samples, set)  # will later turn it into a list
-        samples.add(sample)
+        assert sample not in sample_headers, f"ERROR: Duplicate stem from {filename}"
         sample_headers[sample] = load_fasta_header(filename)
         if not sample_headers[sample]:
             if min_abundance_fraction or synthetic_controls:
@@ -146,18 +449,80 @@ def main(
             assert "raw_fastq" in sample_headers[sample], sample_headers[sample]
             sample_cutadapt[sample] = int(sample_headers[sample]["cutadapt"])
         sample_pool[sample] = sample_headers[sample].get("threshold_pool", "default")
-        with open(filename) as handle:
-            for _, seq in SimpleFastaParser(handle):
-                seq = seq.upper()
-                if min_length <= len(seq) <= max_length:
-                    a = abundance_from_read_name(_.split(None, 1)[0])
-                    totals[seq] += a
-                    counts[seq, sample] += a
-
-    if totals:
+        if spill is not None:
+            for seq, a in file_counts.items():
+                spill.add(md5seq(seq), seq, {sample_index[sample]: a})
+            continue
+        chunks.append(
+            (
+                intern_seqs(file_counts, seq_index, seqs),
+                np.full(len(file_counts), sample_index[sample], np.int32),
+                np.fromiter(file_counts.values(), np.int64, len(file_counts)),
+            )
+        )
+    del file_counts
+    # Match to new samples' pool names which may have a common prefix:
+    pool_names = match_threshold_pools(
+        {
+            headers["threshold_pool"]
+            for headers, _ in existing_samples.values()
+            if "threshold_pool" in headers
+        },
+        set(sample_pool.values()),
+    )
+    for sample, (headers, file_counts) in existing_samples.items():
+        if "cutadapt" not in headers:
+            if min_abundance_fraction or synthetic_controls:
+                sys.exit(
+                    f"ERROR: Missing Cutadapt value for {sample} in {existing}, "
+                    "required for fractional abundance threshold\n"
+                )
+            sample_cutadapt[sample] = 0
+        else:
+            sample_cutadapt[sample] = int(headers["cutadapt"])
+        if "threshold_pool" in headers:
+            headers["threshold_pool"] = pool_names[headers["threshold_pool"]]
+        sample_pool[sample] = headers.get("threshold_pool", "default")
+        sample_headers[sample] = headers
+        if spill is not None:
+            for seq, a in file_counts.items():
+                spill.add(md5seq(seq), seq, {sample_index[sample]: a})
+            continue
+        chunks.append(
+            (
+                intern_seqs(file_counts, seq_index, seqs),
+                np.full(len(file_counts), sample_index[sample], np.int32),
+                np.fromiter(file_counts.values(), np.int64, len(file_counts)),
+            )
+        )
+    del seq_index, existing_samples, pool_names
+    # Sequence totals, only kept as a dict when working on disk if denoising:
+    seq_total: dict[str, int] = {}
+    if spill is None:
+        seq_ids, sample_ids, values = sum_duplicates(
+            *(np.concatenate(arrays) for arrays in zip(*chunks))
+        )
+        totals = seq_totals(seq_ids, values, len(seqs))
+        unique, grand_total, max_total = (
+            len(seqs),
+            int(totals.sum()),
+            int(totals.max(initial=0)),
+        )
+    else:
+        unique = grand_total = max_total = 0
+        for _, seq, seq_counts in spill:
+            total = sum(seq_counts.values())
+            unique += 1
+            grand_total += total
+            max_total = max(max_total, total)
+            if denoise_algorithm != "-":
+                seq_total[seq] = total
+    del chunks
+
+    if unique:
         sys.stderr.write(
-            f"Loaded {len(totals)} unique sequences from {sum(totals.values())}"
-            f" in total within length range, max abundance {max(totals.values())}\n"
+            f"Loaded {unique} unique sequences from {grand_total}"
+            f" in total within length range, max abundance {max_total}\n"
         )
     else:
         sys.stderr.write("WARNING: Loaded zero sequences within length range\n")
@@ -170,38 +535,78 @@ def main(
             )
         corrections, chimeras = read_correction(
             denoise_algorithm,
-            totals,
+            seq_total if spill is not None else dict(zip(seqs, totals.tolist())),
             unoise_alpha=unoise_alpha,
             unoise_gamma=unoise_gamma,
             tmp_dir=tmp_dir,
             debug=debug,
             cpu=cpu,
         )
-        new_counts: dict[tuple[str, str], int] = defaultdict(int)
-        new_totals: dict[str, int] = defaultdict(int)
-        for (seq, sample), a in counts.items():
+        if spill is not None:
+            # Re-sort the counts under the centroid sequences:
+            denoised = SpilledCounts(shared_tmp, "denoised", max_bytes)
+            for _, seq, seq_counts in spill:
+                if seq not in corrections:
+                    # Should have been ignored as per UNOISE algorithm
+                    if unoise_gamma:
+                        assert seq_total[seq] < unoise_gamma, (
+                            f"{md5seq(seq)} total {seq_total[seq]} vs {unoise_gamma}"
+                        )
+                    continue
+                seq = corrections[seq]
+                denoised.add(md5seq(seq), seq, seq_counts)
+            spill = denoised
+            centroid_total: dict[str, int] = {}
+            for seq, total in seq_total.items():
+                if seq in corrections:
+                    seq = corrections[seq]
+                    centroid_total[seq] = centroid_total.get(seq, 0) + total
+            sys.stderr.write(
+                f"{denoise_algorithm.upper()} reduced unique ASVs from "
+                f"{unique} to {len(centroid_total)}, "
+                f"max abundance now {max(centroid_total.values(), default=0)}\n"
+            )
+            if chimeras:
+                sys.stderr.write(
+                    f"{denoise_algorithm.upper()} flagged {len(chimeras)} as chimeras\n"
+                )
+            del denoised, centroid_total, seq_total, corrections
+    if denoise_algorithm != "-" and spill is None:
+        # Map each sequence ID to its centroid's new sequence ID, or -1 to drop:
+        new_seqs: list[str] = []
+        seq_index = {}
+        remap = np.full(len(seqs), -1, np.int32)
+        for seq_id, seq in enumerate(seqs):
             if seq not in corrections:
                 # Should have been ignored as per UNOISE algorithm
                 if unoise_gamma:
-                    assert totals[seq] < unoise_gamma, (
-                        f"{md5seq(seq)} total {totals[seq]} vs {unoise_gamma}"
+                    assert totals[seq_id] < unoise_gamma, (
+                        f"{md5seq(seq)} total {totals[seq_id]} vs {unoise_gamma}"
                     )
                 continue
             seq = corrections[seq]
-            new_counts[seq, sample] += a
-            new_totals[seq] += a
+            try:
+                remap[seq_id] = seq_index[seq]
+            except KeyError:
+                remap[seq_id] = seq_index[seq] = len(new_seqs)
+                new_seqs.append(seq)
+        seq_ids = remap[seq_ids]
+        keep = seq_ids >= 0
+        seq_ids, sample_ids, values = sum_duplicates(
+            seq_ids[keep], sample_ids[keep], values[keep]
+        )
+        totals = seq_totals(seq_ids, values, len(new_seqs))
         sys.stderr.write(
             f"{denoise_algorithm.upper()} reduced unique ASVs from "
-            f"{len(totals)} to {len(new_totals)}, "
-            f"max abundance now {max(new_totals.values(), default=0)}\n"
+            f"{len(seqs)} to {len(new_seqs)}, "
+            f"max abundance now {totals.max(initial=0)}\n"
         )
         if chimeras:
             sys.stderr.write(
                 f"{denoise_algorithm.upper()} flagged {len(chimeras)} as chimeras\n"
             )
-        counts = new_counts
-        totals = new_totals
-        del new_totals, new_counts, corrections
+        seqs = new_seqs
+        del new_seqs, seq_index, remap, keep, corrections
 
     # Drop entries so low in abundance that they'll never be accepted, nor
     # increase the pool threshold. Drop before bothering to check if spikes.
@@ -210,70 +615,113 @@ def main(
     # raising the max non-spike in counts and this the automatic fractional
     # threshold)
     ultra_low = ceil(0.5 * min_abundance)
-    if ultra_low > 1:
+    if spill is None and ultra_low > 1:
         if debug:
             sys.stderr.write("DEBUG: Dropping ultra low abundance entries\n")
-        new_counts = defaultdict(int)
-        new_totals = defaultdict(int)
-        before = len(totals)
-        del totals
-        while counts:
-            (seq, sample), a = counts.popitem()
-            if a >= ultra_low:
-                new_counts[seq, sample] = a
-                new_totals[seq] += a
-        if debug or len(new_totals) < before:
+        before = len(np.unique(seq_ids))
+        keep = values >= ultra_low
+        seq_ids, sample_ids, values = seq_ids[keep], sample_ids[keep], values[keep]
+        totals = seq_totals(seq_ids, values, len(seqs))
+        after = len(np.unique(seq_ids))
+        if debug or after < before:
             sys.stderr.write(
                 "Excluding ultra-low abundance entries reduced unique ASVs "
-                f"from {before} to {len(new_totals)}.\n"
+                f"from {before} to {after}.\n"
             )
-        del before
-        counts = new_counts
-        totals = new_totals
-        del new_totals, new_counts
+        del before, after, keep
 
     pool_absolute_threshold: dict[str, int] = {}
     pool_fraction_threshold: dict[str, float] = {}
-    max_spike_abundance = dict.fromkeys(samples, 0)  # exporting in metadata
-    max_non_spike_abundance = dict.fromkeys(samples, 0)  # exporting in metadata
-    if spikes:
+    # Per-sample maximums, indexed by sample ID (exported in the metadata):
+    max_spike = np.zeros(len(samples), dtype=np.int64)
+    max_non_spike = np.zeros(len(samples), dtype=np.int64)
+    if spill is not None:
+        # Single pass over the merged counts, dropping ultra low abundance
+        # entries while tagging spike-in sequences (in MD5 order, so unlike
+        # the in memory approach can't stop early). Using lists, not arrays,
+        # as will mostly be looking at single values:
+        spike_list = [0] * len(samples)
+        non_spike_list = [0] * len(samples)
+        spike_index = spike_kmer_index(spikes) if spikes else {}
+        before = after = 0
+        for _, seq, seq_counts in spill:
+            before += 1
+            seq_counts = {s: a for s, a in seq_counts.items() if a >= ultra_low}
+            if not seq_counts:
+                continue
+            after += 1
+            if not spikes:
+                target = non_spike_list
+            elif all(
+                a <= min(spike_list[s], non_spike_list[s])
+                for s, a in seq_counts.items()
+            ):
+                # Can't raise the max (non-)spike-in abundance
+                continue
+            elif is_spike_in(seq, spikes, spike_index):
+                target = spike_list
+            else:
+                target = non_spike_list
+            for s, a in seq_counts.items():
+                if target[s] < a:
+                    target[s] = a
+        if ultra_low > 1 and (debug or after < before):
+            sys.stderr.write(
+                "Excluding ultra-low abundance entries reduced unique ASVs "
+                f"from {before} to {after}.\n"
+            )
+        max_spike[:] = spike_list
+        max_non_spike[:] = non_spike_list
+        unique = after  # those passing the ultra low abundance filter
+        del spike_list, non_spike_list, spike_index, before, after
+    elif spikes:
         if debug:
             sys.stderr.write(
                 "DEBUG: About to identify spike-in synthetic sequences...\n"
             )
         start = time()
-        for seq in totals:
-            # Calling is_spike_in is relatively expensive, but will be of less
-            # interest on the tail end low abundance samples.
-            # Should we sort totals by count?
-            assert totals[seq] >= ultra_low, seq
-            if totals[seq] < min(max_spike_abundance.values()) and totals[seq] < min(
-                max_non_spike_abundance.values()
-            ):
-                # Note counts[seq, sample] <= totals[seq] so will not be able to exceed
-                continue
-            if any(
-                min(max_spike_abundance[sample], max_non_spike_abundance[sample])
-                < counts[seq, sample]
-                for sample in samples
-            ):
+        spike_index = spike_kmer_index(spikes)
+        # Rows of the count matrix are contiguous, sorted by sequence ID:
+        row_starts = np.searchsorted(seq_ids, np.arange(len(seqs) + 1))
+        # A count can only matter if above the lower of the two maximums
+        # for that sample (both of which only go up):
+        floor = np.zeros(len(samples), dtype=np.int64)
+        min_floor = 0
+        # Calling is_spike_in is relatively expensive, but will be of less
+        # interest on the tail end low abundance samples. Taking the highest
+        # total abundance first means we can stop early:
+        for seq_id in np.argsort(-totals, kind="stable").tolist():
+            if totals[seq_id] < min_floor:
+                # Note counts[seq, sample] <= totals[seq] so will not be able
+                # to exceed, nor will any lower total abundance sequence
+                break
+            row = slice(row_starts[seq_id], row_starts[seq_id + 1])
+            if row.start == row.stop:
+                # Dropped as too low abundance (and so are all the rest)
+                break
+            assert totals[seq_id] >= ultra_low, seqs[seq_id]
+            # Only need the non-zero counts, since the maximums start at zero:
+            cols = sample_ids[row]
+            counts = values[row]
+            if (floor[cols] < counts).any():
                 # This could raise the max (non-)spike-in abundance
-                if is_spike_in(seq, spikes):
-                    for sample in samples:
-                        if max_spike_abundance[sample] < counts[seq, sample]:
-                            max_spike_abundance[sample] = counts[seq, sample]
+                if is_spike_in(seqs[seq_id], spikes, spike_index):
+                    max_spike[cols] = np.maximum(max_spike[cols], counts)
                 else:
-                    for sample in samples:
-                        if max_non_spike_abundance[sample] < counts[seq, sample]:
-                            max_non_spike_abundance[sample] = counts[seq, sample]
+                    max_non_spike[cols] = np.maximum(max_non_spike[cols], counts)
+                floor[cols] = np.minimum(max_spike[cols], max_non_spike[cols])
+                min_floor = floor.min()
+        del row_starts, spike_index, floor
         time_spike_tagging = time() - start
         if debug:
             sys.stderr.write(
                 f"DEBUG: Spent {time_spike_tagging:0.1f}s tagging spike-in sequences.\n"
             )
     else:
-        for (_, sample), a in counts.items():
-            max_non_spike_abundance[sample] = max(max_non_spike_abundance[sample], a)
+        np.maximum.at(max_non_spike, sample_ids, values)
+    max_spike_abundance = dict(zip(samples, max_spike.tolist()))
+    max_non_spike_abundance = dict(zip(samples, max_non_spike.tolist()))
+    del max_spike, max_non_spike
 
     start = time()
     sample_threshold: dict[str, int] = {}
@@ -385,39 +833,60 @@ def main(
     del pool_absolute_threshold
     del pool_fraction_threshold
 
-    new_counts = defaultdict(int)
-    new_totals = defaultdict(int)
-    before = len(totals)
-    del totals
-    while counts:
-        (seq, sample), a = counts.popitem()
-        if a >= sample_threshold[sample]:
-            new_counts[seq, sample] = a
-            new_totals[seq] += a
-    sys.stderr.write(
-        f"Sample pool abundance thresholds reduced unique ASVs from {before} to "
-        f"{len(new_totals)}.\n"
-    )
-    counts = new_counts
-    totals = new_totals
-    del new_totals, new_counts
-
-    if total_min_abundance:
-        new_counts = defaultdict(int)
-        new_totals = defaultdict(int)
-        while counts:
-            (seq, sample), a = counts.popitem()
-            if totals[seq] >= total_min_abundance:
-                new_counts[seq, sample] = a
-                new_totals[seq] += a
-        if debug or len(new_totals) < len(totals):
+    if spill is not None:
+        # Final pass over the merged counts applying the thresholds, and
+        # re-sorting the survivors by decreasing total then sequence:
+        thresholds = [max(ultra_low, sample_threshold[_]) for _ in samples]
+        output_spill = SpilledCounts(shared_tmp, "output", max_bytes)
+        before = unique
+        after = after_total = 0
+        kept_chimeras = {}
+        for _, seq, seq_counts in spill:
+            seq_counts = {s: a for s, a in seq_counts.items() if a >= thresholds[s]}
+            if not seq_counts:
+                continue
+            after += 1
+            total = sum(seq_counts.values())
+            if total < total_min_abundance:
+                continue
+            after_total += 1
+            output_spill.add(f"{_MAX_TOTAL - total:019d}", seq, seq_counts)
+            if md5seq(seq) in chimeras:
+                kept_chimeras[md5seq(seq)] = chimeras[md5seq(seq)]
+        sys.stderr.write(
+            f"Sample pool abundance thresholds reduced unique ASVs from {before} to "
+            f"{after}.\n"
+        )
+        if total_min_abundance and (debug or after_total < after):
             sys.stderr.write(
                 f"Total abundance threshold {total_min_abundance} reduced "
-                f"unique ASVs from {len(totals)} to {len(new_totals)}.\n"
+                f"unique ASVs from {after} to {after_total}.\n"
             )
-        counts = new_counts
-        totals = new_totals
-        del new_totals, new_counts
+        spill = output_spill
+        del thresholds, output_spill, after_total
+    else:
+        before = len(np.unique(seq_ids))
+        keep = values >= np.array([sample_threshold[_] for _ in samples])[sample_ids]
+        seq_ids, sample_ids, values = seq_ids[keep], sample_ids[keep], values[keep]
+        totals = seq_totals(seq_ids, values, len(seqs))
+        after = len(np.unique(seq_ids))
+        sys.stderr.write(
+            f"Sample pool abundance thresholds reduced unique ASVs from {before} to "
+            f"{after}.\n"
+        )
+        if total_min_abundance:
+            before = after
+            keep = totals[seq_ids] >= total_min_abundance
+            seq_ids, sample_ids, values = seq_ids[keep], sample_ids[keep], values[keep]
+            totals = seq_totals(seq_ids, values, len(seqs))
+            after = len(np.unique(seq_ids))
+            if debug or after < before:
+                sys.stderr.write(
+                    f"Total abundance threshold {total_min_abundance} reduced "
+                    f"unique ASVs from {before} to {after}.\n"
+                )
+        del keep
+    del after
 
     if debug:
         time_thresholds = time() - start
@@ -428,11 +897,14 @@ def main(
     if chimeras:
         # Filter the chimeras list to drop low abundance entries
         # Would be better to call VSEARCH chimera detection here?
-        chimeras = {
-            md5seq(seq): chimeras[md5seq(seq)]
-            for seq in totals
-            if md5seq(seq) in chimeras
-        }
+        if spill is not None:
+            chimeras = kept_chimeras
+        else:
+            chimeras = {
+                md5seq(seqs[seq_id]): chimeras[md5seq(seqs[seq_id])]
+                for seq_id in np.unique(seq_ids).tolist()
+                if md5seq(seqs[seq_id]) in chimeras
+            }
         sys.stderr.write(
             f"Have {len(chimeras)} chimeras passing the abundance thresholds.\n"
         )
@@ -446,13 +918,44 @@ def main(
         if max_non_spike_abundance[sample] < sample_threshold[sample]:
             max_non_spike_abundance[sample] = 0
 
-    samples = sorted(samples)  # converting from set to list
-    count_seq = sorted(
-        ((count, seq) for seq, count in totals.items()),
-        # (sort by marker), then put the highest abundance entries first:
-        key=lambda x: (-x[0], x[1]),
-    )
-    del totals
+    # Total, sequence, and counts for each sample in output order:
+    rows: Iterable[tuple[int, str, list[int]]]
+    if spill is not None:
+        # Already sorted by decreasing abundance, then sequence
+        rows = (
+            (
+                sum(seq_counts.values()),
+                seq,
+                [seq_counts.get(_, 0) for _ in range(len(samples))],
+            )
+            for _, seq, seq_counts in spill
+        )
+    else:
+        # Rows of the count matrix are contiguous, sorted by sequence ID:
+        row_starts = np.searchsorted(seq_ids, np.arange(len(seqs) + 1)).tolist()
+        count_seq = sorted(
+            (
+                (int(totals[seq_id]), seqs[seq_id], seq_id)
+                for seq_id in np.unique(seq_ids).tolist()
+            ),
+            # (sort by marker), then put the highest abundance entries first:
+            key=lambda x: (-x[0], x[1]),
+        )
+        rows = (
+            (
+                count,
+                seq,
+                dense_row(
+                    sample_ids,
+                    values,
+                    slice(row_starts[seq_id], row_starts[seq_id + 1]),
+                    len(samples),
+                ),
+            )
+            for count, seq, seq_id in count_seq
+        )
+        del totals
+    del seqs
 
     if debug:
         sys.stderr.write("DEBUG: Sorted, about to start output...\n")
@@ -511,7 +1014,11 @@ def main(
             ]
             # Try to remove any common folder prefix like raw_data/
             # or C:/Users/... or /tmp/... - note making str type explicit:
-            common = os.path.commonpath([str(_) for _ in stat_values])
+            try:
+                common = os.path.commonpath([str(_) for _ in stat_values])
+            except ValueError:
+                # Mix of absolute and relative paths, e.g. from existing tally
+                common = ""
             if set(stat_values) == {None}:
                 stat_values = [None] * len(stat_values)
             elif len(set(stat_values)) > 1 and common:
@@ -551,15 +1058,23 @@ def main(
         if export_sample_biom(
             tmp_biom,
             # Created expected marker based sequence dict using md5:
-            {(marker, md5seq(seq)): seq for total, seq in count_seq},
+            {(marker, md5seq(seq)): seq for total, seq, seq_id in count_seq},
             {
-                (marker, md5seq(seq)): {} for total, seq in count_seq
+                (marker, md5seq(seq)): {} for total, seq, seq_id in count_seq
             },  # no sequence metadata
             sample_stats,  # internal sample metadata from FASTQ processing
             {
-                (marker, md5seq(seq), sample): counts.get((seq, sample), 0)
-                for sample in samples
-                for (total, seq) in count_seq
+                (marker, md5seq(seq), sample): a
+                for total, seq, seq_id in count_seq
+                for sample, a in zip(
+                    samples,
+                    dense_row(
+                        sample_ids,
+                        values,
+                        slice(row_starts[seq_id], row_starts[seq_id + 1]),
+                        len(samples),
+                    ),
+                )
             },
         ):
             # Move our temp file into position...
@@ -622,10 +1137,8 @@ def main(
         fasta_handle = open(fasta, "w")
     else:
         fasta_handle = None
-    for count, seq in count_seq:
-        # This is the last time we'll use the counts[seq, *] values,
-        # so use pop to gradually reduce the data held in memory.
-        data = "\t".join(str(counts.pop((seq, sample), 0)) for sample in samples)
+    for count, seq, abundances in rows:
+        data = "\t".join(str(a) for a in abundances)
         md5 = md5seq(seq)
         if md5 in chimeras:
             out_handle.write(
@@ -656,3 +1169,6 @@ def main(
     if debug:
         time_output = time() - start
         sys.stderr.write(f"DEBUG: Spent {time_output:0.1f}s writing TSV output file\n")
+
+    if spill is not None and tmp_obj is not None:
+        tmp_obj.cleanup()
@@ -14,10 +14,14 @@ import subprocess
 import sys
 import time
 from collections import Counter
+from collections import deque
 from collections.abc import Iterator
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
 from keyword import iskeyword
 
 from Bio.Data.IUPACData import ambiguous_dna_values
+from Bio.Seq import reverse_complement
 from Bio.SeqIO.FastaIO import SimpleFastaParser
 
 KMER_LENGTH = 31
@@ -226,6 +230,45 @@ def md5_hexdigest(filename: str, chunk_size: int = 1024) -> str:
     return hash_md5.hexdigest()
 
 
+def md5_from_sidecars(file_list: list[str], strict: bool = False) -> dict[str, str]:
+    """Return a dict mapping filenames to MD5 digests from checksum files.
+
+    Looks for an ``example.fastq.gz.md5`` file next to each file, and for
+    ``MD5SUM.txt`` in the same folder, as often provided by sequencing
+    centres. Any files without a recorded checksum are omitted.
+
+    By default blank or unparseable lines, and entries for files in other
+    folders, are ignored - the caller can fall back on ``md5_hexdigest``.
+    With ``strict=True`` these are treated as errors instead.
+    """
+    answer = {}
+    checksum_files = {_ + ".md5" for _ in file_list}
+    checksum_files.update(
+        os.path.join(os.path.split(_)[0], "MD5SUM.txt") for _ in file_list
+    )
+    for cache in checksum_files:
+        if os.path.isfile(cache):
+            with open(cache) as handle:
+                for line in handle:
+                    if strict:
+                        md5, filename = line.strip().split()
+                        # If MD5 file contains relative path, interpret it
+                        assert "/" not in filename, filename
+                    else:
+                        parts = line.strip().split(None, 1)
+                        if len(parts) != 2 or len(parts[0]) != 32:
+                            continue
+                        md5, filename = parts
+                        # md5sum uses a leading asterisk for binary mode
+                        filename = filename.removeprefix("*")
+                        if "/" in filename:
+                            continue
+                    filename = os.path.join(os.path.split(cache)[0], filename)
+                    if filename in file_list:
+                        answer[filename] = md5
+    return answer
+
+
 def cmd_as_string(cmd):
     """Express a list command as a suitably quoted string.
 
@@ -363,6 +406,69 @@ def abundance_filter_fasta(
                 out_handle.write(f">{title}\n{seq}\n")
 
 
+def abundance_counts_in_fasta(
+    fasta_file: str,
+    min_length: int = 0,
+    max_length: int = sys.maxsize,
+    revcomp: bool = False,
+) -> dict[str, int]:
+    """Return dict of upper case sequences and their total abundance.
+
+    The abundance is taken from SWARM style read names. Sequences outside the
+    length range are ignored, and the others optionally reverse complemented.
+    """
+    counts: dict[str, int] = Counter()
+    with open(fasta_file) as handle:
+        for title, seq in SimpleFastaParser(handle):
+            if min_length <= len(seq) <= max_length:
+                seq = seq.upper()
+                if revcomp:
+                    seq = reverse_complement(seq)
+                counts[seq] += abundance_from_read_name(title.split(None, 1)[0])
+    return counts
+
+
+def abundance_counts_in_fastas(
+    fasta_files: list[str],
+    min_length: int = 0,
+    max_length: int = sys.maxsize,
+    revcomp: bool | list[bool] = False,
+    cpu: int = 0,
+) -> Iterator[dict[str, int]]:
+    """Yield abundance_counts_in_fasta dicts for each file, in the given order.
+
+    Argument revcomp can be a single boolean, or one for each file. Given more
+    than one CPU and more than one file, the files are parsed in parallel
+    using a pool of worker processes. Either way the results are the same.
+    Only as many files as there are workers are submitted ahead of the one
+    being yielded, so finished dicts do not pile up while the caller is busy.
+    """
+    if isinstance(revcomp, bool):
+        revcomp = [revcomp] * len(fasta_files)
+    assert len(revcomp) == len(fasta_files)
+    if cpu <= 1 or len(fasta_files) <= 1:
+        for fasta_file, flag in zip(fasta_files, revcomp):
+            yield abundance_counts_in_fasta(fasta_file, min_length, max_length, flag)
+        return
+    workers = min(cpu, len(fasta_files))
+    executor = ProcessPoolExecutor(max_workers=workers)
+    pending: deque[Future] = deque()
+    try:
+        for fasta_file, flag in zip(fasta_files, revcomp):
+            pending.append(
+                executor.submit(
+                    abundance_counts_in_fasta, fasta_file, min_length, max_length, flag
+                )
+            )
+            if len(pending) > workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # If there was an error, don't start any more files:
+        executor.shutdown(cancel_futures=True)
+
+
 def file_to_sample_name(filename: str) -> str:
     """Given filename (with or without a directory name), return sample name only.
 
@@ -1032,18 +1138,50 @@ def kmers(sequence: str, k: int = KMER_LENGTH) -> set[str]:
     return {sequence[i : i + k] for i in range(len(sequence) - k + 1)}
 
 
-def is_spike_in(sequence: str, spikes: list[tuple[str, str, set[str]]]) -> str:
-    """Return spike-in name if sequence matches, else empty string."""
-    for spike_name, spike_seq, spike_kmers in spikes:
+def spike_kmer_index(spikes: list[tuple[str, str, set[str]]]) -> dict[str, list[int]]:
+    """Make dict of kmers to the (sorted) indices of the spike-ins containing them.
+
+    >>> spike_kmer_index([("A", "", {"ACGT", "CGTA"}), ("B", "", {"CGTA"})])
+    {'ACGT': [0], 'CGTA': [0, 1]}
+    """
+    index: dict[str, list[int]] = {}
+    for i, (_, _, spike_kmers) in enumerate(spikes):
+        for kmer in sorted(spike_kmers):
+            index.setdefault(kmer, []).append(i)
+    return index
+
+
+def is_spike_in(
+    sequence: str,
+    spikes: list[tuple[str, str, set[str]]],
+    kmer_index: dict[str, list[int]] | None = None,
+) -> str:
+    """Return spike-in name if sequence matches, else empty string.
+
+    Matches if identical to a spike-in, or if enough of the sequence's kmers
+    are in the spike-in (at least a third of the number of spike-in kmers).
+    If multiple spike-ins match, returns the first in the list. For speed,
+    the query kmers are counted against all the spike-ins at once using an
+    index from spike_kmer_index, which if calling this repeatedly with the
+    same spike-ins should be built once and passed in.
+
+    >>> spikes = [("C1", "ACGTACGTAA", kmers("ACGTACGTAA"))]
+    >>> is_spike_in("ACGTACGTAA", spikes)
+    'C1'
+    >>> is_spike_in("ACGTACGTAC", spikes)
+    ''
+    """
+    if kmer_index is None:
+        kmer_index = spike_kmer_index(spikes)
+    counts = [0] * len(spikes)
+    for i in range(len(sequence) - KMER_LENGTH + 1):
+        for spike in kmer_index.get(sequence[i : i + KMER_LENGTH], ()):
+            counts[spike] += 1
+    for count, (spike_name, spike_seq, _) in zip(counts, spikes):
         if sequence == spike_seq:
             return spike_name
         # This will not work when len(spike) <~ kmer length
         # (fail gracefully with an impossible to meet value of 10)
-        threshold = max((len(spike_seq) - KMER_LENGTH) / 3, 10)
-        count = 0
-        for i in range(len(sequence) - KMER_LENGTH + 1):
-            if sequence[i : i + KMER_LENGTH] in spike_kmers:
-                count += 1
-                if count >= threshold:
-                    return spike_name
+        if count >= max((len(spike_seq) - KMER_LENGTH) / 3, 10):
+            return spike_name
     return ""